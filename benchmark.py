@@ -0,0 +1,539 @@
+"""Offline benchmark: the whole pipeline on a synthetic corpus with fake LLM and embedding backends.
+
+    python benchmark.py                                  # writes .cache/benchmarks/<commit>.json
+    python benchmark.py --compare .cache/benchmarks/abc1234.json
+
+For each corpus size a library of synthetic yoga manuals is written as PDFs and indexed
+with indexer.update_index. The recorded conversations in benchmark_questions.json are then
+replayed through the QA stack, pipeline.run_turn, get_pose_benefits, create_sequence and
+the export formatters. The embeddings are hashed bags of words and the chat model replays
+the recorded function calls and replies, so runs make no network calls and the same
+commit gives the same answers.
+
+Reported per size: index build and load time, search latency, recall@k against the pose
+labels of the corpus, end-to-end turn latency with per-stage percentiles (telemetry.py),
+and the memory high-water mark. `--compare` flags metrics that got worse than a stored
+result and exits non-zero, so regressions show up before anything is deployed.
+
+The run happens in a scratch directory, so the app's relative paths (faiss_index, .cache)
+point there and the real index and caches are never touched.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from keyword_index import tokenize
+from pose_lexicon import SEED_POSES, slugify
+
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS_FILE = os.path.join(REPO_DIR, "benchmark_questions.json")
+RESULTS_DIR = os.path.join(REPO_DIR, ".cache", "benchmarks")
+DEFAULT_SIZES = (200, 1000, 4000)  # pages; one page is about one chunk
+PAGES_PER_BOOK = 100
+RECALL_AT = (1, 3, 5, 10)
+EMBEDDING_DIM = 384
+REGRESSION_TOLERANCE = 0.3  # relative slowdown tolerated before a metric is flagged
+VARIANT_COUNT = 100  # sequences generated in the bulk planning run
+NOISE_FLOOR_MS = 1.0  # absolute differences below this are never flagged
+
+CATEGORIES = ["standing", "seated", "backbend", "forward bend", "inversion", "balancing", "restorative", "twist"]
+BENEFITS = [
+    "strengthens the legs and ankles", "opens the hips and groin", "stretches the hamstrings and calves",
+    "improves balance and focus", "lengthens the spine", "opens the chest and shoulders",
+    "calms the nervous system", "relieves mild back pain", "stimulates digestion", "builds core strength",
+    "improves posture", "eases tension in the neck", "increases circulation to the legs", "soothes anxiety",
+]
+CONTRAINDICATIONS = [
+    "knee injuries", "recent hip surgery", "high blood pressure", "glaucoma", "neck injuries",
+    "late pregnancy", "sacroiliac pain", "wrist injuries", "low blood pressure", "migraine",
+]
+CUES = [
+    "Press evenly through both feet.", "Keep the breath slow and steady.", "Draw the navel gently toward the spine.",
+    "Soften the shoulders away from the ears.", "Use a block or bolster for support.",
+    "Keep the front knee over the ankle.", "Lengthen through the crown of the head.",
+]
+TOPICS = {
+    "anatomy": ["The psoas connects the lumbar spine to the femur.", "The hamstrings cross both hip and knee.",
+                "Fascia responds to long, gentle loading.", "The diaphragm sits beneath the lungs."],
+    "philosophy": ["The Yoga Sutras describe eight limbs of practice.", "Ahimsa asks for non-harming.",
+                   "Santosha is contentment with what is.", "Pranayama refines the breath."],
+    "practice": ["Warm up before deep holds.", "Props make poses accessible.", "Rest between strong poses.",
+                 "Practise on an empty stomach."],
+}
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic embeddings: signed feature hashing of the keyword tokens, L2-normalised."""
+    model = f"hashing-{EMBEDDING_DIM}"
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def _embed(self, text: str):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model replaying the recorded conversations in benchmark_questions.json.
+
+    Requests offering tools get the recorded tool calls or reply for the question they contain,
+    follow-up calls with tool results get the recorded follow-up answer, rewrite requests return
+    the question unchanged, and everything else (pose summaries, conversation summaries) gets
+    the recorded summary text.
+    """
+    recordings: dict = {}  # question -> recorded turn
+    summary_reply: str = ""
+    model_name: str = "gpt-4"
+    latency: float = 0.0  # seconds before the first chunk, to mimic the API round-trip
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-fake"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": self.model_name}
+
+    def _recorded_turn(self, text: str):
+        return next((turn for question, turn in self.recordings.items() if question in text), None)
+
+    def _reply(self, messages, tools=None) -> AIMessage:
+        if isinstance(messages[-1], ToolMessage):
+            question = next(str(message.content) for message in reversed(messages) if isinstance(message, HumanMessage))
+            return AIMessage(content=(self._recorded_turn(question) or {}).get("follow_up", ""))
+        turn = self._recorded_turn(str(messages[-1].content))
+        if turn is None:
+            return AIMessage(content=self.summary_reply)
+        if not tools:
+            return AIMessage(content=turn["question"])
+        if "tool_calls" in turn:
+            calls = [{"index": i, "id": f"call_{i}", "type": "function",
+                      "function": {"name": call["name"], "arguments": json.dumps(call["arguments"])}}
+                     for i, call in enumerate(turn["tool_calls"])]
+            return AIMessage(content="", additional_kwargs={"tool_calls": calls})
+        return AIMessage(content=turn["reply"])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._reply(messages, kwargs.get("tools")))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        message = self._reply(messages, kwargs.get("tools"))
+        if message.additional_kwargs:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs=message.additional_kwargs))
+            return
+        for word in message.content.split(" "):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def load_questions(path: str = QUESTIONS_FILE) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _pose_page(rng: random.Random, pose, other) -> str:
+    name, sanskrit, aliases = pose
+    title = rng.choice([f"{name} ({sanskrit})", name, sanskrit, f"{sanskrit}, {name}"])
+    mention = rng.choice([name, aliases[0]]) if aliases else name
+    sentences = [
+        f"{title} is a {rng.choice(CATEGORIES)} posture.",
+        f"Practised regularly, {mention.lower()} {rng.choice(BENEFITS)} and {rng.choice(BENEFITS)}.",
+        f"Avoid it or modify it with {rng.choice(CONTRAINDICATIONS)} or {rng.choice(CONTRAINDICATIONS)}.",
+        rng.choice(CUES),
+        f"Hold for {rng.choice([5, 8, 10])} breaths, then move into {other[0]}.",
+    ]
+    return " ".join(sentences)
+
+
+def _topic_page(rng: random.Random) -> str:
+    topic = rng.choice(sorted(TOPICS))
+    return f"On {topic}: " + " ".join(rng.sample(TOPICS[topic], 3)) + " " + rng.choice(CUES)
+
+
+def write_corpus(data_dir: str, pages: int, seed: int = 0) -> dict:
+    """Write `pages` pages of synthetic manuals as PDFs; returns {filename: {page: pose id}} for pose pages."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    labels = {}
+    for book in range(math.ceil(pages / PAGES_PER_BOOK)):
+        filename = f"manual-{book:03d}.pdf"
+        labels[filename] = {}
+        pdf = canvas.Canvas(os.path.join(data_dir, filename), pagesize=A4)
+        for page in range(min(PAGES_PER_BOOK, pages - book * PAGES_PER_BOOK)):
+            # Three pages in four describe a pose, cycling through the lexicon so every pose is covered
+            if rng.random() < 0.75:
+                pose = SEED_POSES[(book * PAGES_PER_BOOK + page) % len(SEED_POSES)]
+                text = _pose_page(rng, pose, rng.choice(SEED_POSES))
+                labels[filename][page] = slugify(pose[0])
+            else:
+                text = _topic_page(rng)
+            y = 800
+            for line in textwrap.wrap(text, 90):
+                pdf.drawString(40, y, line)
+                y -= 14
+            pdf.showPage()
+        pdf.save()
+    return labels
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {}
+    values = np.array(values)
+    return {
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p90": round(float(np.percentile(values, 90)), 3),
+        "mean": round(float(values.mean()), 3),
+    }
+
+
+def max_rss_mb() -> dict:
+    """Peak resident memory of this process and of its finished children (the PDF parsing pool)."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB on Linux
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def recall_at_k(docs, relevant: set, ks=RECALL_AT) -> dict:
+    """Share of relevant (file, page) pairs in the top k, out of the most that could fit there."""
+    hits = [(os.path.basename(doc.metadata.get("source", "")), doc.metadata.get("page")) in relevant for doc in docs]
+    return {k: sum(hits[:k]) / min(k, len(relevant)) for k in ks}
+
+
+def benchmark_size(pages: int, workdir: str, recorded: dict, args) -> dict:
+    from compact_index import load_compact_index, load_compact_info
+    from embedder import CachedBatchEmbeddings, EmbeddingCache
+    from indexer import update_index
+    from keyword_index import KeywordIndex
+    from context import ConversationSummary
+    from pipeline import TurnRequest, run_turn
+    from pose_cache import PoseSummaryCache
+    from retriever import HybridRetriever, RETRIEVER_K, RETRIEVER_FETCH_K, build_qa_stack
+    from shards import ShardedVectorStore, load_shard_manifest, sharded_index_exists
+    from telemetry import telemetry, usage_callback
+    from sequence_engine import STYLES, clear_timings, create_sequence, generate_variants
+    from utils import EXPORT_FORMATS, IncrementalChatPdf, export_chat, get_pose_benefits
+    from utils import get_pose_lexicon, pose_summary_cache
+
+    data_dir = os.path.join(workdir, f"data-{pages}")
+    index_dir = os.path.join(workdir, f"index-{pages}")
+    labels = write_corpus(data_dir, pages, args.seed)
+
+    embeddings = CachedBatchEmbeddings(HashingEmbeddings(), cache=EmbeddingCache(os.path.join(index_dir + ".sqlite")))
+    manifest, build_ms = _timed(update_index, data_dir, index_dir, embeddings=embeddings, rebuild=True,
+                                layout=args.layout, shard_key=args.shard_key)
+    if sharded_index_exists(index_dir):
+        vector_store, load_ms = _timed(ShardedVectorStore.load, index_dir, embeddings)
+        index_version = load_shard_manifest(index_dir).get("fingerprint")
+    else:
+        vector_store, load_ms = _timed(load_compact_index, index_dir, embeddings)
+        index_version = load_compact_info(index_dir).get("fingerprint")
+
+    llm = FakeChatModel(recordings=recorded["turns"], summary_reply=recorded["summary_reply"],
+                        latency=args.llm_latency, callbacks=[usage_callback])
+    stack = build_qa_stack(embeddings, vector_store, index_version, llm, llm, index_dir=index_dir)
+
+    turns = [turn for conversation in recorded["conversations"] for turn in conversation]
+
+    # Retrieval quality against the pose pages of the corpus: plain vector search, and the
+    # hybrid (vector + BM25) fusion without reranking, and the hybrid search restricted to the
+    # chunks tagged with the question's poses or to a single manual (taking turns between them)
+    lexicon = get_pose_lexicon()
+    max_k = max(RECALL_AT)
+    hybrid = HybridRetriever(vector_store=vector_store, keyword_index=KeywordIndex.load(index_dir), k=max_k,
+                             fetch_k=max(RETRIEVER_FETCH_K, max_k), rerank="none")
+    recall = {"vector": [], "hybrid": [], "filtered": [], "book": []}
+    books = sorted(labels)
+    for i, turn in enumerate(turns):
+        pose_ids = {lexicon.canonical_id(pose) for pose in turn.get("relevant_poses", [])}
+        relevant = {(filename, page) for filename, book in labels.items()
+                    for page, pose_id in book.items() if pose_id in pose_ids}
+        if not relevant:
+            continue
+        recall["vector"].append(recall_at_k(vector_store.similarity_search(turn["question"], k=max_k), relevant))
+        recall["hybrid"].append(recall_at_k(hybrid.get_relevant_documents(turn["question"]), relevant))
+        recall["filtered"].append(recall_at_k(
+            hybrid.get_relevant_documents(turn["question"], filter={"pose_ids": sorted(pose_ids)}), relevant))
+        book = books[i % len(books)]
+        in_book = {(filename, page) for filename, page in relevant if filename == book}
+        if in_book:
+            recall["book"].append(recall_at_k(
+                hybrid.get_relevant_documents(turn["question"], filter={"book": [book]}), in_book))
+    recall = {mode: {f"@{k}": round(float(np.mean([row[k] for row in rows])), 3) for k in RECALL_AT}
+              for mode, rows in recall.items() if rows}
+
+    # Search latency with the app's own retriever settings
+    vector_ms, retriever_ms = [], []
+    for _ in range(args.repeat):
+        for turn in turns:
+            vector_ms.append(_timed(vector_store.similarity_search, turn["question"], k=RETRIEVER_K)[1])
+            retriever_ms.append(_timed(stack.retriever.get_relevant_documents, turn["question"])[1])
+
+    # End to end: replay each conversation through the pipeline; pose summaries are recomputed every pass
+    telemetry.reset()
+    turn_ms, transcript = [], []
+    for _ in range(args.repeat):
+        pose_summary_cache.clear()
+        clear_timings()
+        transcript = []
+        for conversation in recorded["conversations"]:
+            history, summary = [], None
+            for turn in conversation:
+                style = next((call["arguments"]["style"] for call in turn.get("tool_calls", [])
+                              if "style" in call["arguments"]), "hatha")
+                request = TurnRequest(question=turn["question"], history=list(history), summary=summary,
+                                      style=style, user_id="benchmark")
+                start = time.perf_counter()
+                done = next(event for event in run_turn(request, stack) if event["event"] == "done")
+                turn_ms.append((time.perf_counter() - start) * 1000)
+                history += [("user", turn["question"]), ("bot", done["reply"])]
+                summary = ConversationSummary(**done["summary"])
+            transcript += history
+    stages = telemetry.summary()
+
+    # The tools on their own
+    pose_ms, sequence_ms = [], []
+    calls = [call for turn in turns for call in turn.get("tool_calls", [])]
+    for _ in range(args.repeat):
+        for call in calls:
+            if call["name"] == "get_pose_benefits":
+                pose_ms.append(_timed(get_pose_benefits, call["arguments"]["pose_names"], stack.retriever, llm,
+                                      index_version, cache=PoseSummaryCache(), use_store=False)[1])
+            elif call["name"] == "create_yoga_sequence":
+                clear_timings()
+                sequence_ms.append(_timed(create_sequence, call["arguments"], vector_store,
+                                          style=call["arguments"].get("style", "hatha"),
+                                          index_version=index_version)[1])
+    # Class planning: many variants from the pool of every recorded sequence pose, resolved once per pass
+    pool = sorted({pose for call in calls if call["name"] == "create_yoga_sequence"
+                   for pose in call["arguments"]["poses"]})
+    variants_ms = []
+    for _ in range(args.repeat):
+        clear_timings()
+        variants_ms.append(_timed(generate_variants, pool, VARIANT_COUNT, STYLES, (20, 45), 8,
+                                  vector_store=vector_store, index_version=index_version)[1])
+    export_ms = {}
+    for export_format in EXPORT_FORMATS:
+        export_ms[export_format] = percentiles(
+            [_timed(export_chat, transcript, export_format, IncrementalChatPdf())[1] for _ in range(args.repeat)])
+
+    turn_stage = stages.get("turn", {})
+    return {
+        "pages": pages,
+        "chunks": len(vector_store.docstore),
+        "layout": args.layout,
+        "shard_key": args.shard_key,
+        "build_seconds": round(build_ms / 1000, 3),
+        "load_ms": round(load_ms, 3),
+        "vector_search_ms": percentiles(vector_ms),
+        "retriever_ms": percentiles(retriever_ms),
+        "recall": recall,
+        "turn_ms": percentiles(turn_ms),
+        "tokens_per_turn": round(turn_stage.get("tokens", 0) / max(turn_stage.get("count", 1), 1), 1),
+        "cost_per_turn": round(turn_stage.get("cost", 0.0) / max(turn_stage.get("count", 1), 1), 5),
+        "pose_benefits_ms": percentiles(pose_ms),
+        "sequence_ms": percentiles(sequence_ms),
+        "variants_ms": percentiles(variants_ms),
+        "export_ms": export_ms,
+        "stages": stages,
+        "max_rss_mb": max_rss_mb(),
+        "indexed_files": len(manifest.get("files", {})),
+    }
+
+
+def git_commit() -> str:
+    """Short hash of HEAD, with "-dirty" when tracked files have uncommitted changes."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def _comparable_metrics(result: dict) -> dict:
+    """Flat {name: (value, higher_is_better)} of the metrics that are compared between runs."""
+    metrics = {}
+    for size, run in result["sizes"].items():
+        metrics[f"{size}.build_seconds"] = (run["build_seconds"], False)
+        metrics[f"{size}.load_ms"] = (run["load_ms"], False)
+        for name in ("vector_search_ms", "retriever_ms", "turn_ms", "pose_benefits_ms", "sequence_ms",
+                     "variants_ms"):
+            for stat in ("p50", "p90"):
+                if stat in run.get(name, {}):
+                    metrics[f"{size}.{name}.{stat}"] = (run[name][stat], False)
+        for export_format, stats in run["export_ms"].items():
+            metrics[f"{size}.export_ms.{export_format}.p50"] = (stats["p50"], False)
+        for mode, values in run["recall"].items():
+            for k, value in values.items():
+                metrics[f"{size}.recall.{mode}{k}"] = (value, True)
+        metrics[f"{size}.tokens_per_turn"] = (run["tokens_per_turn"], False)
+        metrics[f"{size}.max_rss_mb"] = (run["max_rss_mb"]["self"], False)
+    return metrics
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float = REGRESSION_TOLERANCE):
+    """(metric, baseline, current) for every metric that regressed beyond the tolerance."""
+    old = _comparable_metrics(baseline)
+    regressions = []
+    for name, (value, higher_is_better) in _comparable_metrics(current).items():
+        if name not in old:
+            continue
+        before = old[name][0]
+        if higher_is_better:
+            worse = value < before - 0.01
+        else:
+            noise = NOISE_FLOOR_MS / 1000 if name.endswith("seconds") else NOISE_FLOOR_MS
+            worse = value > before * (1 + tolerance) and value - before > noise
+        if worse:
+            regressions.append((name, before, value))
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"Benchmark of {result['commit']} ({result['settings']['layout']} layout, "
+          f"{result['settings']['repeat']} passes)")
+    for size, run in result["sizes"].items():
+        print(f"\n{size} pages, {run['chunks']} chunks")
+        print(f"  build {run['build_seconds']:.2f}s, load {run['load_ms']:.1f} ms, "
+              f"peak RSS {run['max_rss_mb']['self']} MB (PDF workers {run['max_rss_mb']['children']} MB)")
+        print(f"  vector search p50 {run['vector_search_ms']['p50']:.2f} ms, "
+              f"retriever p50 {run['retriever_ms']['p50']:.2f} ms")
+        for mode, values in run["recall"].items():
+            print(f"  recall {mode}: " + ", ".join(f"{k} {value:.2f}" for k, value in values.items()))
+        print(f"  turn p50 {run['turn_ms']['p50']:.1f} ms, p90 {run['turn_ms']['p90']:.1f} ms, "
+              f"{run['tokens_per_turn']} tokens/turn")
+        print(f"  sequence p50 {run['sequence_ms']['p50']:.1f} ms, "
+              f"{VARIANT_COUNT} variants p50 {run['variants_ms']['p50']:.1f} ms")
+        for name, stage in run["stages"].items():
+            print(f"    {name:<16} p50 {stage['p50'] * 1000:8.2f} ms  p90 {stage['p90'] * 1000:8.2f} ms  "
+                  f"x{stage['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of indexing, retrieval and chat turns.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated corpus sizes in pages")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the recorded questions")
+    parser.add_argument("--layout", default=None, help="Compact index layout (default: INDEX_LAYOUT)")
+    parser.add_argument("--shard-key", default=None, choices=("topic", "book", "none"),
+                        help="Tag the index is sharded by (default: SHARD_KEY)")
+    parser.add_argument("--llm-latency", type=float, default=0.0,
+                        help="Seconds each fake model call waits, to mimic the API round-trip")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus")
+    parser.add_argument("--questions", default=QUESTIONS_FILE, help="Recorded conversations")
+    parser.add_argument("--output", default=None, help="Result file (default: .cache/benchmarks/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier result file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="Relative slowdown allowed before a metric counts as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    questions_path = os.path.abspath(args.questions)
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, f"{commit}.json"))
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    fixture = load_questions(questions_path)
+    with open(questions_path, "rb") as f:
+        questions_digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    recorded = {
+        "conversations": fixture["conversations"],
+        "summary_reply": fixture["summary_reply"],
+        "turns": {turn["question"]: turn for conversation in fixture["conversations"] for turn in conversation},
+    }
+
+    with tempfile.TemporaryDirectory(prefix="yoga-benchmark-") as workdir:
+        os.chdir(workdir)
+        try:
+            from compact_index import INDEX_LAYOUT
+            from shards import SHARD_KEY
+
+            args.layout = args.layout or INDEX_LAYOUT
+            args.shard_key = args.shard_key or SHARD_KEY
+            result = {
+                "commit": commit,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "settings": {"sizes": sizes, "repeat": args.repeat, "layout": args.layout,
+                             "shard_key": args.shard_key, "llm_latency": args.llm_latency, "seed": args.seed,
+                             "questions": questions_digest},
+                "sizes": {},
+            }
+            for pages in sizes:
+                logger.info(f"Benchmarking {pages} pages")
+                result["sizes"][str(pages)] = benchmark_size(pages, workdir, recorded, args)
+        finally:
+            os.chdir(REPO_DIR)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print_report(result)
+    print(f"\nResults written to {output}")
+
+    if baseline is not None:
+        if baseline.get("settings") != result["settings"]:
+            print(f"Note: {args.compare} was run with different settings: {baseline.get('settings')}")
+        regressions = compare_results(baseline, result, args.tolerance)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before} -> {after}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {baseline.get('commit', args.compare)}")
+
+
+if __name__ == "__main__":
+    main()
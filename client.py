@@ -0,0 +1,99 @@
+"""How the Streamlit page reaches the chat pipeline.
+
+With YOGA_SERVICE_URL set the page is a thin client of service.py and never loads the
+index itself; without it the pipeline runs inside the Streamlit process as before.
+Both clients yield the same pipeline events (see pipeline.py).
+
+`run_turn` takes the address the page was requested from; OpenAI quotas are kept per
+address (see rate_limit.py), so opening a new tab or session does not reset them.
+"""
+import json
+import logging
+import os
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SERVICE_URL = os.getenv("YOGA_SERVICE_URL", "")
+SERVICE_CONNECT_TIMEOUT = 5
+SERVICE_READ_TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "120")) + 10
+
+
+class LocalClient:
+    """Runs turns in this process on the cached QA stack."""
+
+    def run_turn(self, request, client_address: str = None):
+        from pipeline import error_event, run_turn
+        from rate_limit import PRIORITY_INTERACTIVE, request_context
+        from retriever import get_qa_stack, get_response_cache
+
+        try:
+            # Without an address (a browser on this machine) the session id generated by the app is used
+            with request_context(client_address or request.user_id, PRIORITY_INTERACTIVE):
+                yield from run_turn(request, get_qa_stack(), get_response_cache())
+        except Exception as e:
+            logger.exception(f"Turn failed for user '{request.user_id}'")
+            yield error_event(e)
+
+    def stats(self) -> dict:
+        from rate_limit import rate_limit_stats
+        from retriever import get_qa_stack, get_response_cache
+        from shards import tag_values
+        from telemetry import telemetry
+        from utils import pose_summary_cache
+
+        return {"books": tag_values(get_qa_stack().vector_store, "book"),
+                "pose_cache": pose_summary_cache.stats, "answer_cache": get_response_cache().stats,
+                "rate_limits": rate_limit_stats(), "telemetry": telemetry.summary()}
+
+    def reload(self):
+        from retriever import reload_qa_stack
+
+        return reload_qa_stack().index_version
+
+
+class HttpClient:
+    """Sends turns to a running query service and streams its events back."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def run_turn(self, request, client_address: str = None):
+        headers = {"X-Forwarded-For": client_address} if client_address else None
+        try:
+            response = self.session.post(f"{self.base_url}/turn", json=request.to_dict(), stream=True,
+                                         headers=headers, timeout=(SERVICE_CONNECT_TIMEOUT, SERVICE_READ_TIMEOUT))
+        except requests.RequestException as e:
+            logger.error(f"Query service unreachable: {e}")
+            yield {"event": "error", "message": "The assistant is unavailable right now. Please try again."}
+            return
+        with response:
+            if response.status_code == 503:
+                yield {"event": "error", "message": "The assistant is busy right now. Please try again shortly."}
+                return
+            if not response.ok:
+                yield {"event": "error", "message": f"The assistant returned an error ({response.status_code})."}
+                return
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def stats(self) -> dict:
+        try:
+            return self.session.get(f"{self.base_url}/stats", timeout=SERVICE_CONNECT_TIMEOUT).json()
+        except requests.RequestException as e:
+            logger.warning(f"Could not read query service stats: {e}")
+            return {}
+
+    def reload(self):
+        response = self.session.post(f"{self.base_url}/reload", timeout=SERVICE_READ_TIMEOUT)
+        response.raise_for_status()
+        return response.json()["index_version"]
+
+
+def make_client(base_url: str = SERVICE_URL):
+    return HttpClient(base_url) if base_url else LocalClient()
@@ -0,0 +1,244 @@
+"""Compact, memory-mapped export of the FAISS index for the app and its workers.
+
+indexer.py keeps LangChain's FAISS store (index.faiss + pickled index.pkl) as its
+working copy for incremental updates. After every update it also exports:
+
+    vectors-<version>.faiss   FAISS index in the chosen layout, read back with mmap flags
+    chunks-<version>.sqlite   chunk ids, text and metadata (JSON), row i == FAISS id i
+    compact.json              layout, dimension, count and the two file names
+
+Both data files are immutable once written, so every process maps the same pages
+read-only instead of unpickling its own copy of the docstore.
+
+Layouts (INDEX_LAYOUT): flat | sq8 | hnsw | hnsw-sq8 | ivf | ivf-sq8 | ivf-pq.
+IVF layouts need enough vectors to train on and fall back to flat/sq8 for small corpora.
+"""
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+import faiss
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+COMPACT_FILE = "compact.json"
+INDEX_LAYOUT = os.getenv("INDEX_LAYOUT", "flat")
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "8"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+MIN_IVF_VECTORS = 1000
+MAX_TRAINING_VECTORS = 100_000
+SQLITE_MMAP_BYTES = 256 * 1024 * 1024
+
+LAYOUTS = ("flat", "sq8", "hnsw", "hnsw-sq8", "ivf", "ivf-sq8", "ivf-pq")
+_SMALL_CORPUS_LAYOUT = {"ivf": "flat", "ivf-sq8": "sq8", "ivf-pq": "sq8"}
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    """Largest divisor of the dimension giving sub-vectors of at least 16 floats."""
+    for m in range(max(1, dimension // 16), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def factory_spec(layout: str, count: int, dimension: int):
+    """(effective layout, faiss.index_factory string) for the requested layout."""
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown index layout '{layout}', expected one of: {', '.join(LAYOUTS)}")
+    if layout.startswith("ivf") and count < MIN_IVF_VECTORS:
+        fallback = _SMALL_CORPUS_LAYOUT[layout]
+        logger.info(f"Only {count} vectors, too few to train '{layout}'; using '{fallback}'")
+        layout = fallback
+
+    nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+    specs = {
+        "flat": "Flat",
+        "sq8": "SQ8",
+        "hnsw": "HNSW32",
+        "hnsw-sq8": "HNSW32,SQ8",
+        "ivf": f"IVF{nlist},Flat",
+        "ivf-sq8": f"IVF{nlist},SQ8",
+        "ivf-pq": f"IVF{nlist},PQ{_pq_subquantizers(dimension)}x8",
+    }
+    return layout, specs[layout]
+
+
+def _read_flags(layout: str) -> int:
+    # IVF inverted lists are mapped with IO_FLAG_MMAP; flat/SQ/HNSW codes need IO_FLAG_MMAP_IFC (faiss >= 1.10)
+    if layout.startswith("ivf"):
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+
+def load_compact_info(index_dir: str):
+    """Contents of compact.json, or None when no compact export exists."""
+    path = os.path.join(index_dir, COMPACT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compact_index_exists(index_dir: str) -> bool:
+    info = load_compact_info(index_dir)
+    return bool(info) and all(os.path.exists(os.path.join(index_dir, info[key])) for key in ("vectors", "chunks"))
+
+
+def compact_is_current(index_dir: str, fingerprint: str, layout: str = INDEX_LAYOUT) -> bool:
+    info = load_compact_info(index_dir)
+    return (compact_index_exists(index_dir) and info.get("fingerprint") == fingerprint
+            and info.get("requested_layout") == layout)
+
+
+class SQLiteDocstore(Docstore):
+    """Read-only chunk store; each thread gets its own connection to the immutable file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_BYTES}")
+            self._local.conn = conn
+        return conn
+
+    def search(self, search: str):
+        row = self._conn().execute("SELECT text, metadata FROM chunks WHERE id = ?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def row_for_id(self, search: str):
+        """FAISS row of a chunk id, or None when there is no such chunk."""
+        found = self._conn().execute("SELECT row FROM chunks WHERE id = ?", (search,)).fetchone()
+        return None if found is None else found[0]
+
+    def id_for_row(self, row: int):
+        found = self._conn().execute("SELECT id FROM chunks WHERE row = ?", (int(row),)).fetchone()
+        if found is None:
+            raise KeyError(row)
+        return found[0]
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+class RowIdMap(Mapping):
+    """FAISS row -> chunk id, looked up on demand instead of held in a dict."""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, row):
+        return self.docstore.id_for_row(row)
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return len(self.docstore)
+
+
+def _write_chunks(path: str, vector_store: FAISS, rows):
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("CREATE TABLE chunks (row INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, text TEXT NOT NULL,"
+                 " metadata TEXT NOT NULL)")
+
+    def chunk_rows():
+        for row, source_row in enumerate(rows):
+            doc_id = vector_store.index_to_docstore_id[source_row]
+            doc = vector_store.docstore.search(doc_id)
+            yield row, doc_id, doc.page_content, json.dumps(doc.metadata, default=str)
+
+    conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", chunk_rows())
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+def _remove_stale_exports(index_dir: str, keep):
+    # The previous export is kept so processes still mapping it are not cut off mid-request
+    for name in os.listdir(index_dir):
+        if name.startswith(("vectors-", "chunks-")) and name not in keep:
+            os.remove(os.path.join(index_dir, name))
+
+
+def export_compact_index(vector_store: FAISS, index_dir: str, fingerprint: str, layout: str = INDEX_LAYOUT,
+                         rows=None) -> dict:
+    """Write the store's vectors and chunks in the compact format; returns the new compact.json contents.
+
+    With `rows` only those rows of the store are exported, in that order (one shard, see shards.py).
+    """
+    if rows is None:
+        rows = range(vector_store.index.ntotal)
+        vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)
+    else:
+        vectors = vector_store.index.reconstruct_batch(np.asarray(rows, dtype="int64"))
+    count, dimension = vectors.shape
+    effective_layout, spec = factory_spec(layout, count, dimension)
+
+    index = faiss.index_factory(dimension, spec, vector_store.index.metric_type)
+    if not index.is_trained:
+        sample = vectors
+        if count > MAX_TRAINING_VECTORS:
+            sample = vectors[::math.ceil(count / MAX_TRAINING_VECTORS)]
+        index.train(sample)
+    index.add(vectors)
+
+    name = f"{fingerprint}-{effective_layout}"
+    vectors_file, chunks_file = f"vectors-{name}.faiss", f"chunks-{name}.sqlite"
+    tmp_path = os.path.join(index_dir, f"{vectors_file}.tmp")
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, os.path.join(index_dir, vectors_file))
+    _write_chunks(os.path.join(index_dir, chunks_file), vector_store, rows)
+
+    previous = load_compact_info(index_dir) or {}
+    info = {
+        "fingerprint": fingerprint,
+        "requested_layout": layout,
+        "layout": effective_layout,
+        "factory": spec,
+        "dimension": dimension,
+        "count": count,
+        "vectors": vectors_file,
+        "chunks": chunks_file,
+    }
+    path = os.path.join(index_dir, COMPACT_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+    _remove_stale_exports(index_dir, {vectors_file, chunks_file, previous.get("vectors"), previous.get("chunks")})
+
+    size_mb = os.path.getsize(os.path.join(index_dir, vectors_file)) / 2**20
+    logger.info(f"Compact index: {count} vectors, layout '{effective_layout}' ({spec}), {size_mb:.1f} MB")
+    return info
+
+
+def load_compact_index(index_dir: str, embeddings) -> FAISS:
+    """Memory-map the exported index into a LangChain FAISS store backed by the SQLite chunk table."""
+    info = load_compact_info(index_dir)
+    index = faiss.read_index(os.path.join(index_dir, info["vectors"]), _read_flags(info["layout"]))
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = INDEX_NPROBE
+        ivf.make_direct_map()  # row -> list position, so hits can be reconstructed (8 bytes per vector)
+    if info["layout"].startswith("hnsw"):
+        faiss.downcast_index(index).hnsw.efSearch = INDEX_EF_SEARCH
+
+    docstore = SQLiteDocstore(os.path.join(index_dir, info["chunks"]))
+    logger.info(f"Loaded compact index '{info['layout']}' with {info['count']} vectors")
+    return FAISS(embeddings, index, docstore, RowIdMap(docstore))
@@ -0,0 +1,128 @@
+"""Token-budgeted conversation context for the main chat call.
+
+Recent turns are replayed verbatim, newest first, until the token budget is spent.
+Older turns are folded into a rolling summary that is only extended when turns
+leave the window, so prompt cost stays roughly flat in long sessions.
+"""
+import logging
+import re
+from dataclasses import dataclass
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TOKEN_BUDGET = 1500
+SUMMARY_MAX_WORDS = 150
+
+# UI-only additions to bot replies that should never be sent back to the model
+_FOOTER_PATTERNS = [
+    re.compile(r"\n*🧾 \*\*Token usage:\*\*.*?(?:\n💸 \*\*Estimated cost:\*\*[^\n]*)?$", re.DOTALL),
+    re.compile(r"\n*⚡ \*Answered from cache[^\n]*$"),
+    re.compile(r"(?:\n*\[See [^\]]+ on Yoga Journal\]\([^)]*\))+\s*$"),
+    re.compile(r"\n*\*\*Sources:\*\*(?:\n- [^\n]*)+"),
+]
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and a yoga assistant.
+Keep the user's goals, constraints (injuries, level, preferred style) and the poses already discussed.
+Use at most {max_words} words.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}
+
+Updated summary:"""
+
+
+@dataclass
+class ConversationSummary:
+    """Rolling summary of every turn before `covered_turns`."""
+    text: str = ""
+    covered_turns: int = 0
+
+
+def strip_ui_footers(message: str) -> str:
+    previous = None
+    while previous != message:
+        previous = message
+        for pattern in _FOOTER_PATTERNS:
+            message = pattern.sub("", message).rstrip()
+    return message
+
+
+def _to_message(role: str, content: str):
+    return HumanMessage(content=content) if role == "user" else AIMessage(content=content)
+
+
+def _format_turns(turns) -> str:
+    return "\n".join(f"{'User' if role == 'user' else 'Assistant'}: {content}" for role, content in turns)
+
+
+def update_summary(summary: ConversationSummary, history, upto: int, llm, max_words: int = SUMMARY_MAX_WORDS):
+    """Fold turns summary.covered_turns..upto into the summary with one LLM call."""
+    if upto <= summary.covered_turns or llm is None:
+        return summary
+    new_turns = [(role, strip_ui_footers(content)) for role, content in history[summary.covered_turns:upto]]
+    prompt = SUMMARY_PROMPT.format(max_words=max_words, summary=summary.text or "(empty)", turns=_format_turns(new_turns))
+    try:
+        text = llm.invoke(prompt).content.strip()
+    except Exception as e:
+        logger.error(f"Failed to update conversation summary: {e}")
+        return summary
+    return ConversationSummary(text=text, covered_turns=upto)
+
+
+def build_context_messages(history, system_prompt: str, query: str, summary: ConversationSummary = None,
+                           summary_llm=None, budget: int = HISTORY_TOKEN_BUDGET, model: str = "gpt-4"):
+    """Messages for the main call, plus the (possibly updated) rolling summary.
+
+    `history` holds the earlier (role, message) turns, without the current query.
+    """
+    summary = summary or ConversationSummary()
+
+    window = []
+    used = 0
+    for role, content in reversed(history):
+        content = strip_ui_footers(content)
+        tokens = count_tokens(content, model) + 4
+        if window and used + tokens > budget:
+            break
+        window.append((role, content))
+        used += tokens
+    window.reverse()
+
+    first_in_window = len(history) - len(window)
+    summary = update_summary(summary, history, first_in_window, summary_llm)
+
+    # A summary that could not be brought up to date leaves a gap before the window; the
+    # newest of those turns are replayed with a budget of their own instead of being lost
+    missed = []
+    if summary.covered_turns < first_in_window:
+        missed_used = 0
+        for role, content in reversed(history[summary.covered_turns:first_in_window]):
+            content = strip_ui_footers(content)
+            tokens = count_tokens(content, model) + 4
+            if missed_used + tokens > budget:
+                break
+            missed.append((role, content))
+            missed_used += tokens
+        missed.reverse()
+        used += missed_used
+        dropped = first_in_window - summary.covered_turns - len(missed)
+        if dropped:
+            logger.warning(f"Context: {dropped} earlier turns are neither summarised nor replayed")
+
+    messages = [SystemMessage(content=system_prompt)]
+    if summary.text and summary.covered_turns:
+        messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary.text}"))
+    # Turns the summary already covers are not replayed
+    skip = max(0, summary.covered_turns - first_in_window)
+    replayed = missed + window[skip:]
+    messages.extend(_to_message(role, content) for role, content in replayed)
+    messages.append(HumanMessage(content=query))
+
+    logger.debug(f"Context: {len(replayed)} turns replayed ({used} tokens), "
+                 f"{summary.covered_turns} turns summarised")
+    return messages, summary
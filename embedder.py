@@ -0,0 +1,162 @@
+"""Batched, concurrent embedding stage with an on-disk cache.
+
+`CachedBatchEmbeddings` wraps any LangChain `Embeddings` backend (OpenAI in the app,
+`DeterministicFakeEmbedding` or similar for offline runs) and can be handed straight
+to FAISS. Vectors are stored in SQLite keyed by model name and chunk-text hash, so
+re-chunking or rebuilding the index never pays twice for the same text.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import httpx
+import numpy as np
+import openai
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from rate_limit import GovernedTransport, get_governor, submit_with_context
+from telemetry import current_span
+from dotenv import load_dotenv
+
+load_dotenv()
+openai_api_key = os.getenv("OPENAI_API_KEY")
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite")
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+MAX_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite-backed store of vectors keyed by (model, sha256 of the text)."""
+
+    def __init__(self, path: str = CACHE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.commit()
+
+    def get_many(self, model: str, hashes) -> dict:
+        found = {}
+        hashes = list(hashes)
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: dict):
+        rows = [(model, key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class CachedBatchEmbeddings(Embeddings):
+    def __init__(self, backend: Embeddings, model_name: str = None, cache: EmbeddingCache = None,
+                 batch_size: int = BATCH_SIZE, max_concurrency: int = MAX_CONCURRENCY):
+        self.backend = backend
+        self.model_name = model_name or getattr(backend, "model", None) or type(backend).__name__
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.stats = {"hits": 0, "misses": 0, "requests": 0}
+
+    def _request(self, fn, *args):
+        # Retries and backoff are left to the shared OpenAI client (get_openai_client), which
+        # knows not to retry the governor's own 429s or auth and bad-request errors
+        self.stats["requests"] += 1
+        return fn(*args)
+
+    def _embed_batch(self, texts):
+        return self._request(self.backend.embed_documents, texts)
+
+    def embed_documents(self, texts):
+        keys = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model_name, set(keys))
+
+        # Each distinct uncached text is sent once, however often it repeats
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        self.stats["hits"] += len(texts) - sum(1 for key in keys if key in missing)
+        self.stats["misses"] += len(missing)
+
+        if missing:
+            missing_keys = list(missing)
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                futures = [submit_with_context(executor, self._embed_batch, [missing[key] for key in batch])
+                           for batch in batches]
+                for batch, future in zip(batches, futures):
+                    batch_vectors = future.result()
+                    fresh = dict(zip(batch, batch_vectors))
+                    self.cache.put_many(self.model_name, fresh)
+                    vectors.update(fresh)
+            logger.info(f"Embedded {len(missing)} new chunks in {len(batches)} batches "
+                        f"({len(texts) - len(missing)} reused from cache or duplicates)")
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        key = text_hash(text)
+        cached = self.cache.get_many(self.model_name, [key])
+        span = current_span()
+        if span is not None:
+            span.cache("embedding", key in cached)
+        if key in cached:
+            self.stats["hits"] += 1
+            return cached[key]
+        self.stats["misses"] += 1
+        vector = self._request(self.backend.embed_query, text)
+        self.cache.put_many(self.model_name, {key: vector})
+        return vector
+
+
+@lru_cache(maxsize=1)
+def get_openai_client() -> openai.OpenAI:
+    """One OpenAI client, and so one pool of keep-alive connections, shared by every model in the process.
+
+    Its requests go through the process-wide rate governor (see rate_limit.py).
+    """
+    limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+    transport = GovernedTransport(httpx.HTTPTransport(limits=limits))
+    return openai.OpenAI(api_key=openai_api_key, timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES,
+                         http_client=httpx.Client(transport=transport))
+
+
+def make_embeddings(requests_per_minute: int = None, **kwargs) -> CachedBatchEmbeddings:
+    """OpenAI embeddings behind the batching and caching layer."""
+    if requests_per_minute:
+        get_governor("embeddings").set_rates(requests_per_minute=requests_per_minute)
+    backend = OpenAIEmbeddings(openai_api_key=openai_api_key, client=get_openai_client().embeddings)
+    return CachedBatchEmbeddings(backend, **kwargs)
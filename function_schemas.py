@@ -33,6 +33,10 @@ create_sequence_function = {
                 "type": "string",
                 "enum": ["hatha", "yin", "vinyasa"],
                 "description": "Yoga style to determine default pose durations"
+            },
+            "duration_minutes": {
+                "type": "number",
+                "description": "Total length of the sequence in minutes, if the user asked for one"
             }
         },
         "required": ["poses", "style"]
@@ -0,0 +1,222 @@
+"""Offline build step for the FAISS index over the PDFs in `data/`.
+
+Run it whenever manuals are added, changed or removed:
+
+    python indexer.py            # incremental update
+    python indexer.py --rebuild  # re-embed everything
+
+A manifest of per-file content hashes is kept next to the FAISS files so that
+only the PDFs that actually changed are re-chunked and re-embedded. The pickled
+FAISS store is the indexer's working copy; the app loads the memory-mapped export
+written by compact_index.py (`--layout` picks flat, HNSW, IVF or quantised variants),
+split into one index per topic or book by shards.py (`--shard-key`).
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from loader import list_pdfs, iter_pdfs, iter_chunks
+from embedder import make_embeddings
+from keyword_index import KeywordIndex, KEYWORD_INDEX_FILE
+from pose_lexicon import PoseLexicon, LEXICON_FILE
+from compact_index import INDEX_LAYOUT, LAYOUTS
+from shards import SHARD_KEY, SHARD_KEYS, export_index, index_is_current, tag_documents
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+INDEX_DIR = "faiss_index"
+MANIFEST_FILE = "manifest.json"
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 200
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def index_exists(index_dir: str = INDEX_DIR) -> bool:
+    return os.path.exists(os.path.join(index_dir, "index.faiss"))
+
+
+def load_manifest(index_dir: str = INDEX_DIR) -> dict:
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    if not index_exists(index_dir) or not os.path.exists(path):
+        return {"files": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, index_dir: str = INDEX_DIR):
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def compute_fingerprint(files: dict) -> str:
+    """Version of the index contents: changes whenever any indexed file or the chunking changes."""
+    digest = hashlib.sha256(f"{CHUNK_SIZE}:{CHUNK_OVERLAP}".encode())
+    for filename in sorted(files):
+        digest.update(f"{filename}:{files[filename]['sha256']}".encode())
+    return digest.hexdigest()[:16]
+
+
+def diff_corpus(data_dir: str, manifest: dict):
+    """Compare the PDFs on disk with the manifest; returns (current hashes, added, changed, removed)."""
+    current = {filename: file_sha256(os.path.join(data_dir, filename)) for filename in list_pdfs(data_dir)}
+    indexed = manifest.get("files", {})
+
+    added = [f for f in current if f not in indexed]
+    changed = [f for f in current if f in indexed and indexed[f]["sha256"] != current[f]]
+    removed = [f for f in indexed if f not in current]
+    return current, added, changed, removed
+
+
+def chunk_ids(sha256: str, count: int):
+    """Chunk ids are derived from the file hash so they are stable across runs."""
+    return [f"{sha256[:16]}-{i}" for i in range(count)]
+
+
+def update_index(data_dir: str = DATA_DIR, index_dir: str = INDEX_DIR, embeddings=None, rebuild: bool = False,
+                 max_workers: int = None, layout: str = INDEX_LAYOUT, shard_key: str = SHARD_KEY,
+                 rebuild_shards=()):
+    embeddings = embeddings or make_embeddings()
+    manifest = {"files": {}} if rebuild else load_manifest(index_dir)
+
+    settings = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+    if manifest.get("files") and manifest.get("settings") != settings:
+        logger.info("Chunking settings changed, rebuilding the whole index.")
+        manifest = {"files": {}}
+
+    current, added, changed, removed = diff_corpus(data_dir, manifest)
+    logger.info(f"Index diff: {len(added)} added, {len(changed)} changed, {len(removed)} removed")
+
+    derived_exist = all(os.path.exists(os.path.join(index_dir, name)) for name in (KEYWORD_INDEX_FILE, LEXICON_FILE))
+    corpus_current = not (added or changed or removed) and index_exists(index_dir) and derived_exist
+    if (corpus_current and not rebuild_shards
+            and index_is_current(index_dir, manifest.get("fingerprint"), layout, shard_key)):
+        logger.info("Index is up to date.")
+        return manifest
+
+    vector_store = None
+    keyword_index = None
+    if manifest["files"]:
+        vector_store = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+        keyword_index = KeywordIndex.load(index_dir)
+    if corpus_current:
+        # Only the export is missing, asked for in another layout or sharding, or some shards are rebuilt.
+        # Chunks indexed before they were tagged get their tags here.
+        if tag_documents(vector_store.docstore._dict.values(), PoseLexicon.load(index_dir)):
+            vector_store.save_local(index_dir)
+        manifest["fingerprint"] = manifest.get("fingerprint") or compute_fingerprint(manifest["files"])
+        export_index(vector_store, index_dir, manifest["fingerprint"], layout, shard_key, rebuild_shards)
+        save_manifest(manifest, index_dir)
+        return manifest
+    if keyword_index is None:
+        # Indexes built before the keyword index existed get one from the chunks already stored
+        keyword_index = KeywordIndex()
+        if vector_store is not None:
+            stored = vector_store.docstore._dict
+            keyword_index.add_many(stored.keys(), (doc.page_content for doc in stored.values()))
+
+    files = dict(manifest["files"])
+
+    stale_ids = [doc_id for f in changed + removed for doc_id in files[f]["ids"]]
+    if stale_ids and vector_store is not None:
+        vector_store.delete(stale_ids)
+        keyword_index.remove(stale_ids)
+    for filename in changed + removed:
+        files.pop(filename)
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    failed = []
+    # Files stream in from the loader pool one at a time and are embedded as they arrive
+    for result, chunks in iter_chunks(iter_pdfs(data_dir, added + changed, max_workers), splitter):
+        filename = result.filename
+        if not result.ok:
+            failed.append(filename)
+            continue
+        if not chunks:
+            logger.warning(f"No text extracted from '{filename}'")
+            continue
+
+        ids = chunk_ids(current[filename], len(chunks))
+        if vector_store is None:
+            vector_store = FAISS.from_documents(chunks, embeddings, ids=ids)
+        else:
+            vector_store.add_documents(chunks, ids=ids)
+        keyword_index.add_many(ids, [chunk.page_content for chunk in chunks])
+        files[filename] = {
+            "sha256": current[filename],
+            "ids": ids,
+            "pages": result.page_count,
+            "load_seconds": round(result.seconds, 3),
+        }
+        logger.info(f"Indexed '{filename}' ({len(chunks)} chunks)")
+
+    if failed:
+        logger.warning(f"{len(failed)} file(s) could not be parsed and will be retried next run: {', '.join(failed)}")
+
+    if vector_store is None:
+        logger.warning(f"No documents indexed from '{data_dir}'")
+        return manifest
+
+    # Pose names are re-harvested from the whole corpus each run, and every chunk is tagged again with
+    # the result; a regex pass is cheap next to embedding
+    os.makedirs(index_dir, exist_ok=True)
+    chunks = vector_store.docstore._dict.values()
+    lexicon = PoseLexicon.from_seed()
+    added_poses = lexicon.extend_from_corpus(doc.page_content for doc in chunks)
+    lexicon.save(index_dir)
+    logger.info(f"Pose lexicon: {len(lexicon)} poses ({added_poses} found in the corpus)")
+    retagged = tag_documents(chunks, lexicon)
+    logger.info(f"Tagged {retagged} chunk(s) with new book, topic or pose tags")
+
+    vector_store.save_local(index_dir)
+    keyword_index.save(index_dir)
+    manifest = {"settings": settings, "files": files, "fingerprint": compute_fingerprint(files)}
+    save_manifest(manifest, index_dir)
+    export_index(vector_store, index_dir, manifest["fingerprint"], layout, shard_key, rebuild_shards)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the FAISS index for the yoga manuals.")
+    parser.add_argument("--data", default=DATA_DIR, help="Folder containing the source PDFs")
+    parser.add_argument("--index", default=INDEX_DIR, help="Folder where the FAISS index is stored")
+    parser.add_argument("--rebuild", action="store_true", help="Ignore the manifest and re-embed every file")
+    parser.add_argument("--workers", type=int, default=None, help="Number of PDF parsing processes")
+    parser.add_argument("--batch-size", type=int, default=None, help="Chunks per embedding request")
+    parser.add_argument("--concurrency", type=int, default=None, help="Embedding requests in flight at once")
+    parser.add_argument("--rpm", type=int, default=None, help="Maximum embedding requests per minute")
+    parser.add_argument("--layout", choices=LAYOUTS, default=INDEX_LAYOUT,
+                        help="Layout of the memory-mapped index the app loads")
+    parser.add_argument("--shard-key", choices=SHARD_KEYS, default=SHARD_KEY,
+                        help="Tag the exported index is split by ('none' for a single index)")
+    parser.add_argument("--rebuild-shard", action="append", default=[], metavar="NAME",
+                        help="Export this shard again even if it is unchanged (repeatable)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    embedding_options = {
+        "batch_size": args.batch_size,
+        "max_concurrency": args.concurrency,
+        "requests_per_minute": args.rpm,
+    }
+    embeddings = make_embeddings(**{k: v for k, v in embedding_options.items() if v is not None})
+    manifest = update_index(args.data, args.index, embeddings, rebuild=args.rebuild, max_workers=args.workers,
+                            layout=args.layout, shard_key=args.shard_key, rebuild_shards=args.rebuild_shard)
+    logger.info(f"Index fingerprint: {manifest.get('fingerprint', 'n/a')}")
+
+
+if __name__ == "__main__":
+    main()
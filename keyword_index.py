@@ -0,0 +1,102 @@
+"""In-process BM25 keyword index over the same chunks as the FAISS store.
+
+Sanskrit pose names ("Eka Pada Rajakapotasana") embed poorly but match exactly as
+keywords, so the hybrid retriever queries this index next to the vector search.
+Diacritics are folded so "Rājakapotāsana" and "Rajakapotasana" are the same term.
+"""
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+KEYWORD_INDEX_FILE = "keywords.json"
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in",
+    "into", "is", "it", "its", "me", "my", "of", "on", "or", "that", "the", "their", "this", "to", "what",
+    "when", "which", "with", "you", "your", "tell", "about", "pose", "yoga",
+}
+
+
+def tokenize(text: str):
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    return [token for token in re.findall(r"[a-z0-9]+", text) if len(token) > 1 and token not in STOPWORDS]
+
+
+class KeywordIndex:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {doc_id: term frequency}
+        self.doc_lengths = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, doc_id: str, text: str):
+        if doc_id in self.doc_lengths:
+            self.remove([doc_id])
+        terms = Counter(tokenize(text))
+        for term, count in terms.items():
+            self.postings[term][doc_id] = count
+        length = sum(terms.values())
+        self.doc_lengths[doc_id] = length
+        self._total_length += length
+
+    def add_many(self, ids, texts):
+        for doc_id, text in zip(ids, texts):
+            self.add(doc_id, text)
+
+    def remove(self, doc_ids):
+        doc_ids = {doc_id for doc_id in doc_ids if doc_id in self.doc_lengths}
+        if not doc_ids:
+            return
+        for term in list(self.postings):
+            postings = self.postings[term]
+            for doc_id in doc_ids & postings.keys():
+                del postings[doc_id]
+            if not postings:
+                del self.postings[term]
+        for doc_id in doc_ids:
+            self._total_length -= self.doc_lengths.pop(doc_id)
+
+    def search(self, query: str, k: int = 10):
+        """Top-k (doc_id, BM25 score) pairs for the query."""
+        if not self.doc_lengths:
+            return []
+        n_docs = len(self.doc_lengths)
+        avg_length = self._total_length / n_docs
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self, index_dir: str):
+        path = os.path.join(index_dir, KEYWORD_INDEX_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "postings": self.postings, "doc_lengths": self.doc_lengths}, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, index_dir: str):
+        """The saved index, or None when the index folder has none yet."""
+        path = os.path.join(index_dir, KEYWORD_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            stored = json.load(f)
+        index = cls(stored["k1"], stored["b"])
+        index.postings.update(stored["postings"])
+        index.doc_lengths = stored["doc_lengths"]
+        index._total_length = sum(index.doc_lengths.values())
+        return index
@@ -1,11 +1,89 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
 from langchain_community.document_loaders import PyPDFLoader
+import logging
 import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PdfLoadResult:
+    filename: str
+    pages: list = field(default_factory=list)
+    page_count: int = 0
+    seconds: float = 0.0
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def list_pdfs(folder_path: str):
+    return sorted(filename for filename in os.listdir(folder_path) if filename.endswith('.pdf'))
+
+def load_pdf(path: str):
+    return PyPDFLoader(path).load()
+
+def _load_pdf_timed(folder_path: str, filename: str) -> PdfLoadResult:
+    # Runs in a worker process: never raise, so one corrupt PDF can't take down the whole run
+    start = time.perf_counter()
+    try:
+        pages = load_pdf(os.path.join(folder_path, filename))
+        return PdfLoadResult(filename, pages, len(pages), time.perf_counter() - start)
+    except Exception as e:
+        return PdfLoadResult(filename, [], 0, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+
+def iter_pdfs(folder_path: str, filenames=None, max_workers: int = None):
+    """Parse PDFs in a process pool and yield one PdfLoadResult per file as soon as it is parsed.
+
+    At most `max_workers` files are in flight at a time, so peak memory depends on the
+    largest few books rather than on the size of the whole library.
+    """
+    filenames = list(filenames) if filenames is not None else list_pdfs(folder_path)
+    max_workers = max_workers or min(len(filenames), os.cpu_count() or 1) or 1
+    pending = iter(filenames)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+
+        def submit_next():
+            filename = next(pending, None)
+            if filename is not None:
+                in_flight[executor.submit(_load_pdf_timed, folder_path, filename)] = filename
+
+        for _ in range(max_workers):
+            submit_next()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = PdfLoadResult(filename, error=f"{type(e).__name__}: {e}")
+
+                if result.ok:
+                    logger.info(f"Loaded '{filename}': {result.page_count} pages in {result.seconds:.2f}s")
+                else:
+                    logger.error(f"Failed to load '{filename}' after {result.seconds:.2f}s: {result.error}")
+
+                # Keep the pool busy while the caller splits and embeds this file
+                submit_next()
+                yield result
+
+def iter_chunks(results, splitter):
+    """Split each loaded file as it arrives; yields (PdfLoadResult, chunks) and keeps no pages around."""
+    for result in results:
+        chunks = splitter.split_documents(result.pages) if result.ok else []
+        result.pages = []
+        yield result, chunks
 
 def load_pdfs_from_folder(folder_path: str):
     docs = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.pdf'):
-            loader = PyPDFLoader(os.path.join(folder_path, filename))
-            pages = loader.load()
-            docs.extend(pages)
-    return docs
\ No newline at end of file
+    for result in iter_pdfs(folder_path):
+        docs.extend(result.pages)
+    return docs
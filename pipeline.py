@@ -0,0 +1,220 @@
+"""One chat turn, independent of any UI.
+
+`run_turn` takes the question, the earlier turns and the user's settings, and does the
+whole turn: answer-cache lookup, query rewrite, the main call and the tools it asks for
+(see tools.py), at most one follow-up call, and the footers. It yields plain-dict events while the reply is
+produced, so the Streamlit page and the HTTP service (service.py) render the same stream:
+
+    {"event": "delta", "text": ...}                  next piece of a free-text answer
+    {"event": "status", "text": ...}                 a tool is running
+    {"event": "sections", "count": n}                n reply sections follow (pose summaries, sequences,
+                                                     the follow-up answer)
+    {"event": "section", "position": i, "text": ...} section i so far
+    {"event": "done", "reply": ..., "summary": {...}, "cached": bool}
+    {"event": "error", "message": ...}
+
+Callers run it inside rate_limit.request_context so its OpenAI requests count against
+the user's quota at interactive priority. Each turn is a telemetry span with one child
+span per stage (see telemetry.py); its token footer is priced from the turn's totals.
+"""
+import json
+import logging
+import openai
+from dataclasses import asdict, dataclass, field
+from langchain_core.messages import AIMessage, ToolMessage
+from context import ConversationSummary, build_context_messages
+from retriever import rewrite_query, FOLDED_REWRITE_INSTRUCTION
+from shards import filter_key
+from telemetry import model_cost, telemetry
+from tools import TOOL_DEFINITIONS, ToolContext, is_direct, parse_tool_calls, run_tool_calls
+from utils import estimate_token_usage, get_yogajournal_pose_image
+
+logger = logging.getLogger(__name__)
+
+CHAT_MODEL = "gpt-4"
+
+SYSTEM_PROMPT = (
+    """
+    You are a knowledgeable and supportive yoga assistant.
+
+    Your primary goal is to provide informative, high-quality responses about yoga poses and sequences.
+
+    ✅ When the user asks about a yoga pose (e.g., "what’s a good hip opener", "tell me about pigeon pose"):
+    - Always call get_pose_benefits first to retrieve detailed textual information.
+    - Include benefits, contraindications, alignment cues, and any relevant tips in your response.
+    - Only call get_yogajournal_pose_image together with get_pose_benefits to optionally enhance your response with an image.
+    - Never call get_yogajournal_pose_image on its own, and never return an image or link without context or explanation.
+
+    ✅ When the user asks for a full sequence (e.g., "give me a morning flow", "make me a yin yoga hip sequence"):
+    - Call create_sequence, using the selected style if available (e.g., hatha, yin).
+    - If the user asks for a length (e.g., "a 20 minute flow"), pass it as duration_minutes.
+    - Do not use create_sequence for single-pose queries.
+
+    🔁 If multiple functions are needed:
+    - Call them together in the same response: get_pose_benefits, plus get_yogajournal_pose_image if a visual is appropriate.
+    - The pose summaries are shown to the user as they are; afterwards, add only what they don't cover.
+
+    🧠 Your responses should always prioritise being helpful and informative. Think like a thoughtful yoga teacher, not a search engine or image bot.
+
+    🖼️ When including images, embed the image URL naturally at the end of your explanation or in parentheses after describing the pose.
+
+    Never leave your answer as only a link or image. Your job is to teach, guide, and inspire.
+    """
+)
+
+
+@dataclass
+class TurnRequest:
+    """Everything the pipeline needs from the client for one turn."""
+    question: str
+    history: list = field(default_factory=list)  # earlier (role, message) turns, without the question
+    summary: ConversationSummary = None
+    style: str = "hatha"
+    show_images: bool = True
+    user_id: str = "anonymous"
+    filters: dict = None  # restricts every corpus search of the turn, e.g. {"book": ["manual.pdf"]}
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data["history"] = [list(turn) for turn in self.history]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        summary = data.get("summary")
+        return cls(
+            question=data["question"],
+            history=[tuple(turn) for turn in data.get("history", [])],
+            summary=ConversationSummary(**summary) if summary else None,
+            style=data.get("style", "hatha"),
+            show_images=data.get("show_images", True),
+            user_id=data.get("user_id", "anonymous"),
+            filters=data.get("filters"),
+        )
+
+
+def format_token_usage(usage: dict, cost: float) -> str:
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    total_tokens = usage.get("total_tokens", 0)
+
+    return (
+        f"\n\n🧾 **Token usage:** {total_tokens} tokens "
+        f"(Prompt: {prompt_tokens}, Completion: {completion_tokens})  \n"
+        f"💸 **Estimated cost:** ${cost:.4f}"
+    )
+
+
+def error_event(error: Exception) -> dict:
+    """Event for a turn that failed, worded for the user."""
+    if isinstance(error, openai.RateLimitError):
+        message = "The assistant is handling a lot of requests right now. Please try again in a minute."
+    else:
+        message = "Something went wrong while answering. Please try again."
+    return {"event": "error", "message": message}
+
+
+def run_turn(request: TurnRequest, stack, response_cache=None):
+    """Run one chat turn against the QA stack, yielding events (see the module docstring)."""
+    with telemetry.span("turn", user_id=request.user_id, style=request.style) as turn:
+        yield from _run_turn(request, stack, response_cache, turn)
+
+
+def _run_turn(request: TurnRequest, stack, response_cache, turn):
+    question = request.question.strip()
+
+    # Only standalone questions (the first of a conversation) are shared through the answer cache,
+    # follow-ups depend on earlier turns that another session never had
+    cache_scope = f"{request.style}|{request.show_images}|{filter_key(request.filters)}"
+    cacheable = response_cache is not None and not request.history
+    if cacheable:
+        with telemetry.span("answer_cache") as span:
+            cached_turn = response_cache.lookup(question, stack.index_version, cache_scope)
+            span.cache("answer", cached_turn is not None)
+        turn.cache("answer", cached_turn is not None)
+        if cached_turn:
+            logger.debug(f"Answer cache hit, rewritten query was: {cached_turn.rewritten_query}")
+            reply = cached_turn.reply + "\n\n⚡ *Answered from cache, no tokens used.*"
+            summary = request.summary or ConversationSummary()
+            yield {"event": "done", "reply": reply, "summary": asdict(summary), "cached": True}
+            return
+
+    # Rewrite the raw user input first (skipped or folded into the prompt depending on REWRITE_MODE)
+    rewritten_query = rewrite_query(question, stack)
+    logger.debug(f"Rewritten query: {rewritten_query}")
+
+    system_prompt = SYSTEM_PROMPT
+    if stack.rewrite_mode == "fold":
+        system_prompt += "\n" + FOLDED_REWRITE_INSTRUCTION
+    # Recent turns within a token budget, older ones folded into a rolling summary
+    with telemetry.span("context", turns=len(request.history)):
+        messages, summary = build_context_messages(
+            request.history,
+            system_prompt,
+            rewritten_query,
+            summary=request.summary,
+            summary_llm=stack.query_rewrite_chain.llm,
+            model=CHAT_MODEL,
+        )
+
+    # Main call with every tool on offer; free-text answers are passed on piece by piece as they arrive
+    response = None
+    with telemetry.span("function_call", model=CHAT_MODEL) as call_span:
+        for chunk in stack.llm.stream(messages, tools=TOOL_DEFINITIONS, tool_choice="auto"):
+            response = chunk if response is None else response + chunk
+            if chunk.content and not response.additional_kwargs.get("tool_calls"):
+                yield {"event": "delta", "text": chunk.content}
+        calls = parse_tool_calls(response)
+        call_span.attributes["tools"] = [call.name for call in calls]
+
+    bot_reply = response.content
+    if calls:
+        logger.debug(f"Tools called: {', '.join(call.name for call in calls)}")
+        yield {"event": "status", "text": "🤖 Thinking deeply about your yoga request..."}
+
+        # Independent calls run side by side; a follow-up call is only needed for tools that
+        # don't write their own part of the reply, and then there is exactly one
+        follow_up = not all(is_direct(call) for call in calls)
+        context = ToolContext(question, stack, request.style, request.show_images, filters=request.filters)
+        with telemetry.span("tools", calls=len(calls)):
+            results, sections = yield from run_tool_calls(calls, context, reserve=1 if follow_up else 0)
+
+        if follow_up:
+            follow_up_messages = messages + [
+                AIMessage(content=response.content, additional_kwargs={"tool_calls": [call.to_dict() for call in calls]}),
+                *[ToolMessage(content=result.content, tool_call_id=call.id) for call, result in zip(calls, results)],
+            ]
+            position = len(sections) - 1
+            with telemetry.span("follow_up", model=CHAT_MODEL):
+                for chunk in stack.llm.stream(follow_up_messages):
+                    sections[position] += chunk.content
+                    yield {"event": "section", "position": position, "text": sections[position]}
+        # Text the model wrote before its tool calls was already streamed to the user, so it stays in the reply
+        bot_reply = "\n\n".join(part for part in [response.content.strip(), *sections] if part)
+
+        # Yoga Journal links for the poses covered, unless the answer already links them
+        pose_names = [pose for result in results for pose in result.pose_names]
+        if pose_names and request.show_images:
+            links = [f"[See {pose.title()} on Yoga Journal]({get_yogajournal_pose_image(pose)})"
+                     for pose in pose_names if get_yogajournal_pose_image(pose) not in bot_reply]
+            if links:
+                bot_reply += "\n\n" + "\n\n".join(links)
+
+    # A reply patched over a failed or timed-out tool would be served again for a whole TTL
+    tool_failed = calls and any(result.error for result in results)
+    if cacheable and bot_reply and not tool_failed:
+        response_cache.add(question, rewritten_query, [call.to_dict() for call in calls], bot_reply,
+                           stack.index_version, cache_scope)
+
+    # Every chat model call of the turn (rewrite, summaries, sequence) is counted on the turn span;
+    # without it, fall back to a local tiktoken count of the main call alone
+    if turn.totals["llm_calls"]:
+        usage, cost = turn.totals, turn.totals["cost"]
+    else:
+        completion = response.content or json.dumps(response.additional_kwargs.get("tool_calls") or [])
+        usage = estimate_token_usage(messages, completion, CHAT_MODEL)
+        cost = model_cost(CHAT_MODEL, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    if usage:
+        bot_reply += format_token_usage(usage, cost)
+
+    yield {"event": "done", "reply": bot_reply, "summary": asdict(summary), "cached": False}
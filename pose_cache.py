@@ -0,0 +1,114 @@
+"""Process-wide LRU/TTL cache for generated pose summaries.
+
+Entries are keyed on the normalised (or canonical, see `key_fn`) pose name plus the
+index fingerprint, so a rebuilt corpus never serves summaries written from the old one.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+POSE_CACHE_PATH = os.getenv("POSE_CACHE_PATH", ".cache/pose_summaries.json")
+POSE_CACHE_MAX_ENTRIES = int(os.getenv("POSE_CACHE_MAX_ENTRIES", "512"))
+POSE_CACHE_TTL_SECONDS = int(os.getenv("POSE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+def normalise_pose_name(pose: str) -> str:
+    """'Pigeon Pose', 'pigeon-pose ' and 'pigeon' all map to 'pigeon'."""
+    text = unicodedata.normalize("NFKD", pose).encode("ascii", "ignore").decode("ascii").lower()
+    text = re.sub(r"[^a-z0-9]+", " ", text).strip()
+    text = re.sub(r"\s+pose$", "", text)
+    return text
+
+
+class PoseSummaryCache:
+    def __init__(self, max_entries: int = POSE_CACHE_MAX_ENTRIES, ttl_seconds: int = POSE_CACHE_TTL_SECONDS,
+                 path: str = None, key_fn=normalise_pose_name):
+        self.key_fn = key_fn
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    def make_key(self, pose: str, index_version: str) -> str:
+        return f"{index_version or 'unversioned'}:{self.key_fn(pose)}"
+
+    def _expired(self, stored_at: float) -> bool:
+        return bool(self.ttl_seconds) and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, pose: str, index_version: str = None):
+        key = self.make_key(pose, index_version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[0]):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, pose: str, index_version: str, value):
+        key = self.make_key(pose, index_version)
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if self.path:
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            self._save()
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable pose cache '{self.path}': {e}")
+            return
+        for key, (stored_at, value) in stored.items():
+            if not self._expired(stored_at):
+                self._entries[key] = (stored_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        with self._lock:
+            snapshot = {key: list(entry) for key, entry in self._entries.items()}
+        try:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not persist pose cache to '{self.path}': {e}")
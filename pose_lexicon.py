@@ -0,0 +1,228 @@
+"""Pose-name dictionary with English/Sanskrit aliases and a fast local matcher.
+
+The lexicon starts from a curated seed list and is extended at index time with pose
+names found in the corpus (Sanskrit "...asana" words and "X Pose" phrases). Text is
+matched against it with a token trie (longest match wins) and a fuzzy fallback for
+misspelled Sanskrit, so poses are detected and canonicalised without an LLM call.
+"""
+import difflib
+import json
+import os
+import re
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass, field, asdict
+
+LEXICON_FILE = "pose_lexicon.json"
+FUZZY_CUTOFF = 0.85
+# Capitalised words that start sentences rather than pose names ("This Pose strengthens...")
+_NOT_POSE_WORDS = {"the", "this", "that", "each", "every", "any", "a", "an", "next", "final", "first", "last", "one", "your"}
+
+# (English name, Sanskrit name, extra aliases). Single everyday words ("chair", "bow")
+# only appear together with "pose" so ordinary sentences don't trigger them.
+SEED_POSES = [
+    ("Mountain Pose", "Tadasana", ["mountain pose"]),
+    ("Tree Pose", "Vrksasana", ["tree pose", "vriksasana"]),
+    ("Downward-Facing Dog", "Adho Mukha Svanasana", ["downward dog", "down dog", "downdog"]),
+    ("Upward-Facing Dog", "Urdhva Mukha Svanasana", ["upward dog", "up dog", "updog"]),
+    ("Child's Pose", "Balasana", ["childs pose", "child pose"]),
+    ("Cobra Pose", "Bhujangasana", ["cobra"]),
+    ("Pigeon Pose", "Eka Pada Rajakapotasana", ["pigeon", "one legged king pigeon", "king pigeon"]),
+    ("Warrior I", "Virabhadrasana I", ["warrior 1", "warrior one", "virabhadrasana 1"]),
+    ("Warrior II", "Virabhadrasana II", ["warrior 2", "warrior two", "virabhadrasana 2"]),
+    ("Warrior III", "Virabhadrasana III", ["warrior 3", "warrior three", "virabhadrasana 3"]),
+    ("Triangle Pose", "Trikonasana", ["triangle pose", "utthita trikonasana", "extended triangle"]),
+    ("Chair Pose", "Utkatasana", ["chair pose"]),
+    ("Bridge Pose", "Setu Bandha Sarvangasana", ["bridge pose"]),
+    ("Shoulderstand", "Salamba Sarvangasana", ["shoulder stand", "sarvangasana"]),
+    ("Headstand", "Salamba Sirsasana", ["head stand", "sirsasana", "shirshasana"]),
+    ("Plow Pose", "Halasana", ["plow pose", "plough pose"]),
+    ("Seated Forward Bend", "Paschimottanasana", ["seated forward fold"]),
+    ("Standing Forward Bend", "Uttanasana", ["standing forward fold", "forward fold"]),
+    ("Bound Angle Pose", "Baddha Konasana", ["bound angle", "butterfly pose", "cobbler pose"]),
+    ("Garland Pose", "Malasana", ["garland pose", "yogi squat"]),
+    ("Boat Pose", "Navasana", ["boat pose", "paripurna navasana"]),
+    ("Bow Pose", "Dhanurasana", ["bow pose"]),
+    ("Camel Pose", "Ustrasana", ["camel pose"]),
+    ("Corpse Pose", "Savasana", ["corpse pose", "shavasana"]),
+    ("Cat Pose", "Marjaryasana", ["cat pose"]),
+    ("Cow Pose", "Bitilasana", ["cow pose"]),
+    ("Cat-Cow", "Marjaryasana Bitilasana", ["cat cow"]),
+    ("Four-Limbed Staff Pose", "Chaturanga Dandasana", ["chaturanga", "low plank"]),
+    ("Plank Pose", "Phalakasana", ["plank pose", "high plank"]),
+    ("Crow Pose", "Kakasana", ["crow pose"]),
+    ("Crane Pose", "Bakasana", ["crane pose"]),
+    ("Eagle Pose", "Garudasana", ["eagle pose"]),
+    ("Dancer Pose", "Natarajasana", ["dancer pose", "lord of the dance"]),
+    ("Low Lunge", "Anjaneyasana", ["crescent lunge"]),
+    ("High Lunge", "Ashta Chandrasana", ["crescent pose"]),
+    ("Easy Pose", "Sukhasana", ["easy pose", "cross legged"]),
+    ("Lotus Pose", "Padmasana", ["lotus pose", "full lotus"]),
+    ("Cow Face Pose", "Gomukhasana", ["cow face pose", "cow face"]),
+    ("Half Lord of the Fishes", "Ardha Matsyendrasana", ["seated twist", "half spinal twist"]),
+    ("Fish Pose", "Matsyasana", ["fish pose"]),
+    ("Reclining Bound Angle", "Supta Baddha Konasana", ["reclined butterfly", "reclining butterfly"]),
+    ("Happy Baby", "Ananda Balasana", ["happy baby pose"]),
+    ("Legs Up the Wall", "Viparita Karani", ["legs up the wall pose"]),
+    ("Locust Pose", "Salabhasana", ["locust pose", "shalabhasana"]),
+    ("Head-to-Knee Forward Bend", "Janu Sirsasana", ["head to knee"]),
+    ("Pyramid Pose", "Parsvottanasana", ["pyramid pose", "intense side stretch"]),
+    ("Wide-Legged Forward Bend", "Prasarita Padottanasana", ["wide legged forward fold"]),
+    ("Wheel Pose", "Urdhva Dhanurasana", ["wheel pose", "full wheel", "upward bow"]),
+    ("Wild Thing", "Camatkarasana", ["wild thing pose"]),
+    ("Side Plank", "Vasisthasana", ["side plank pose"]),
+    ("Frog Pose", "Mandukasana", ["frog pose"]),
+    ("Extended Side Angle", "Utthita Parsvakonasana", ["side angle pose", "side angle"]),
+    ("Half Moon Pose", "Ardha Chandrasana", ["half moon", "half moon pose"]),
+    ("Hero Pose", "Virasana", ["hero pose"]),
+    ("Thunderbolt Pose", "Vajrasana", ["thunderbolt pose", "diamond pose"]),
+    ("Staff Pose", "Dandasana", ["staff pose"]),
+    ("Reclining Hand-to-Big-Toe", "Supta Padangusthasana", ["reclining hand to big toe"]),
+    ("Sphinx Pose", "Salamba Bhujangasana", ["sphinx", "sphinx pose"]),
+    ("Puppy Pose", "Uttana Shishosana", ["puppy pose", "extended puppy"]),
+    ("Lizard Pose", "Utthan Pristhasana", ["lizard lunge", "lizard pose"]),
+]
+
+
+def fold(text: str) -> str:
+    """Lowercase ASCII form: diacritics removed, apostrophes dropped."""
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    return text.replace("'", "")
+
+
+def tokens(text: str):
+    return re.findall(r"[a-z0-9]+", fold(text))
+
+
+def slugify(text: str) -> str:
+    return "-".join(tokens(text))
+
+
+@dataclass
+class Pose:
+    id: str
+    name: str
+    sanskrit: str = ""
+    aliases: list = field(default_factory=list)
+    from_corpus: bool = False
+
+    @property
+    def slug(self) -> str:
+        return slugify(self.name)
+
+    def all_names(self):
+        return [self.name, self.sanskrit, *self.aliases]
+
+
+class PoseLexicon:
+    def __init__(self, poses=()):
+        self.poses = {}
+        self._trie = {}
+        self._single_tokens = {}  # one-word Sanskrit alias -> pose id, used by the fuzzy fallback
+        self._fuzzy_cache = {}
+        for pose in poses:
+            self.add(pose)
+
+    def __len__(self):
+        return len(self.poses)
+
+    @classmethod
+    def from_seed(cls):
+        return cls(Pose(slugify(name), name, sanskrit, list(aliases)) for name, sanskrit, aliases in SEED_POSES)
+
+    def add(self, pose: Pose):
+        self.poses[pose.id] = pose
+        for alias in pose.all_names():
+            alias_tokens = tokens(alias)
+            if not alias_tokens:
+                continue
+            node = self._trie
+            for token in alias_tokens:
+                node = node.setdefault(token, {})
+            node.setdefault("$", pose.id)
+            self._fuzzy_cache.clear()
+            if len(alias_tokens) == 1 and alias_tokens[0].endswith("asana"):
+                self._single_tokens.setdefault(alias_tokens[0], pose.id)
+
+    def _fuzzy_match(self, word: str):
+        # Words repeat a lot across questions, so remember the (slow) difflib answer per word
+        if word not in self._fuzzy_cache:
+            if len(self._fuzzy_cache) > 50_000:
+                self._fuzzy_cache.clear()
+            close = difflib.get_close_matches(word, self._single_tokens, n=1, cutoff=FUZZY_CUTOFF)
+            self._fuzzy_cache[word] = self._single_tokens[close[0]] if close else None
+        return self._fuzzy_cache[word]
+
+    def find(self, text: str, fuzzy: bool = True):
+        """Pose ids mentioned in the text, in order of first mention."""
+        words = tokens(text)
+        found = []
+        i = 0
+        while i < len(words):
+            node = self._trie
+            match_id, match_end = None, i
+            j = i
+            while j < len(words) and words[j] in node:
+                node = node[words[j]]
+                j += 1
+                if "$" in node:
+                    match_id, match_end = node["$"], j
+            if match_id is None and fuzzy and len(words[i]) >= 7:
+                match_id = self._fuzzy_match(words[i])
+                match_end = i + 1
+            if match_id is not None:
+                if match_id not in found:
+                    found.append(match_id)
+                i = match_end
+            else:
+                i += 1
+        return found
+
+    def match(self, text: str):
+        return [self.poses[pose_id] for pose_id in self.find(text)]
+
+    def resolve(self, name: str):
+        """The Pose a single name refers to, or None when it is not in the lexicon."""
+        found = self.find(name)
+        return self.poses[found[0]] if found else None
+
+    def canonical_id(self, name: str) -> str:
+        """Stable id for a pose name; synonyms share it, unknown names fall back to their slug."""
+        pose = self.resolve(name)
+        return pose.id if pose else slugify(re.sub(r"\bpose\b", "", fold(name))) or slugify(name)
+
+    def extend_from_corpus(self, texts, min_count: int = 2):
+        """Add pose names that appear in the corpus but not in the lexicon yet."""
+        counts = Counter()
+        for text in texts:
+            for word in re.findall(r"\b[A-Z][a-zA-ZĀ-ſ]+asana\b", unicodedata.normalize("NFC", text)):
+                counts[word] += 1
+            for phrase in re.findall(r"\b((?:[A-Z][a-z]+[- ]){0,2}[A-Z][a-z]+) Pose\b", text):
+                words = [word for word in tokens(phrase) if word not in _NOT_POSE_WORDS]
+                if words:
+                    counts[f"{' '.join(words).title()} Pose"] += 1
+
+        added = 0
+        for name, count in counts.items():
+            if count < min_count or self.find(name, fuzzy=False):
+                continue
+            is_sanskrit = name.endswith("asana")
+            self.add(Pose(slugify(name), name, sanskrit=name if is_sanskrit else "", from_corpus=True))
+            added += 1
+        return added
+
+    def save(self, index_dir: str):
+        path = os.path.join(index_dir, LEXICON_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([asdict(pose) for pose in self.poses.values()], f, indent=1, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, index_dir: str):
+        """Lexicon saved by the indexer, or the seed lexicon when there is none."""
+        path = os.path.join(index_dir, LEXICON_FILE)
+        if not os.path.exists(path):
+            return cls.from_seed()
+        with open(path, encoding="utf-8") as f:
+            return cls(Pose(**pose) for pose in json.load(f))
@@ -0,0 +1,284 @@
+"""Precomputed per-pose knowledge, extracted from the corpus once at index time.
+
+    python pose_store.py          # extract every lexicon pose missing for the current index
+    python pose_store.py --force  # re-extract everything
+
+Each pose gets its Description / How to perform / Benefits / Contraindications fields
+and source citations stored in SQLite next to the FAISS index. The app answers known
+poses with a lookup and only falls back to live RAG for poses that are not stored.
+
+The hold time and the poses the books move into next are read from the same retrieved
+text with regular expressions (no extra LLM call); sequence_engine.py uses them for timings.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+POSE_STORE_FILE = "poses.sqlite"
+BREATH_SECONDS = 6  # one slow breath, for holds given in breaths
+
+# "hold for 5 breaths", "hold 30-60 seconds", "holding it for 3 to 5 minutes"
+HOLD_PATTERN = re.compile(
+    r"\bhold(?:ing)?(?: it| the pose| here)?(?: for)?(?: about| around| up to)? (\d+)(?:\s*(?:-|–|to)\s*(\d+))?"
+    r" (breath|second|sec|minute|min)s?\b",
+    re.IGNORECASE,
+)
+HOLD_UNIT_SECONDS = {"breath": BREATH_SECONDS, "second": 1, "sec": 1, "minute": 60, "min": 60}
+# "then move into Tree Pose", "step back to Downward Dog"
+TRANSITION_PATTERN = re.compile(
+    r"\b(?:move|moving|come|coming|flow|flowing|transition|step|stepping|lower|lowering)"
+    r"(?: back| forward| down| up)? (?:in)?to ([^.;:!?]+)",
+    re.IGNORECASE,
+)
+MAX_TRANSITIONS = 3
+
+EXTRACTION_PROMPT = """
+You are a yoga expert assistant.
+
+Using only the text below, extract what it says about the yoga pose '{pose}' ({sanskrit}).
+Answer with a single JSON object with these keys:
+  "description": one or two sentences on the pose and its purpose,
+  "how_to": list of short step-by-step instructions,
+  "benefits": list of main benefits,
+  "contraindications": list of main contraindications.
+Use an empty string or empty lists for anything the text does not cover. Use simple language.
+
+Text:
+{text}
+"""
+
+
+@dataclass
+class PoseFacts:
+    pose_id: str
+    name: str
+    sanskrit: str = ""
+    description: str = ""
+    how_to: list = field(default_factory=list)
+    benefits: list = field(default_factory=list)
+    contraindications: list = field(default_factory=list)
+    sources: list = field(default_factory=list)
+    index_version: str = None
+    hold_seconds: float = None  # typical hold the sources give, None when they don't say
+    transitions: list = field(default_factory=list)  # ids of the poses the sources move into next
+
+    @property
+    def is_empty(self):
+        return not (self.description or self.how_to or self.benefits)
+
+    def to_markdown(self, title: str = None) -> str:
+        """Same layout as the live summaries written by get_pose_benefits."""
+        title = title or self.name
+        steps = "\n".join(f"{i}. {step}" for i, step in enumerate(self.how_to, 1))
+        benefits = "\n".join(f"- {item}" for item in self.benefits)
+        contraindications = "\n".join(f"- {item}" for item in self.contraindications) or "- None noted in the sources."
+        sources = "\n".join(f"- {src}" for src in self.sources)
+        return (
+            f"### 🧘‍♀️ {title.title()}\n\n"
+            f"Description:\n{self.description}\n\n"
+            f"How to perform:\n{steps}\n\n"
+            f"Benefits:\n{benefits}\n\n"
+            f"Contraindications:\n{contraindications}"
+            f"\n\n**Sources:**\n{sources}"
+        )
+
+
+_COLUMNS = ("pose_id, name, sanskrit, description, how_to, benefits, contraindications, sources,"
+            " index_version, hold_seconds, transitions")
+
+
+class PoseStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS poses ("
+            " pose_id TEXT PRIMARY KEY, name TEXT NOT NULL, sanskrit TEXT, description TEXT,"
+            " how_to TEXT, benefits TEXT, contraindications TEXT, sources TEXT,"
+            " index_version TEXT, updated_at REAL, hold_seconds REAL, transitions TEXT)"
+        )
+        # Stores written before the timing columns existed get them added, empty
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(poses)")}
+        for column, kind in (("hold_seconds", "REAL"), ("transitions", "TEXT")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE poses ADD COLUMN {column} {kind}")
+        self._conn.commit()
+
+    @classmethod
+    def open(cls, index_dir: str):
+        """The store next to an index, or None when it has not been built yet."""
+        path = os.path.join(index_dir, POSE_STORE_FILE)
+        return cls(path) if os.path.exists(path) else None
+
+    @staticmethod
+    def _facts(row) -> PoseFacts:
+        return PoseFacts(row[0], row[1], row[2] or "", row[3] or "", json.loads(row[4]), json.loads(row[5]),
+                         json.loads(row[6]), json.loads(row[7]), row[8], row[9], json.loads(row[10] or "[]"))
+
+    def get(self, pose_id: str, index_version: str = None):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_COLUMNS} FROM poses WHERE pose_id = ?", (pose_id,)).fetchone()
+        if row is None or (index_version and row[8] != index_version):
+            return None
+        return self._facts(row)
+
+    def get_many(self, pose_ids, index_version: str = None) -> dict:
+        """{pose id: facts} for the stored poses among `pose_ids`, in one query."""
+        pose_ids = list(dict.fromkeys(pose_ids))
+        if not pose_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM poses WHERE pose_id IN ({', '.join('?' * len(pose_ids))})", pose_ids
+            ).fetchall()
+        return {row[0]: self._facts(row) for row in rows if not index_version or row[8] == index_version}
+
+    def put(self, facts: PoseFacts):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO poses ({_COLUMNS}, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (facts.pose_id, facts.name, facts.sanskrit, facts.description, json.dumps(facts.how_to),
+                 json.dumps(facts.benefits), json.dumps(facts.contraindications), json.dumps(facts.sources),
+                 facts.index_version, facts.hold_seconds, json.dumps(facts.transitions), time.time()),
+            )
+            self._conn.commit()
+
+    def versions(self) -> dict:
+        with self._lock:
+            return dict(self._conn.execute("SELECT pose_id, index_version FROM poses").fetchall())
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM poses").fetchone()[0]
+
+
+def _parse_json_object(text: str) -> dict:
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        raise ValueError("no JSON object in the model output")
+    return json.loads(match.group(0), strict=False)
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        return [line.strip("-• ").strip() for line in value.splitlines() if line.strip()]
+    return [str(item).strip() for item in value or [] if str(item).strip()]
+
+
+def parse_hold_seconds(text: str):
+    """Hold times mentioned in the text, in seconds (the middle of a range)."""
+    holds = []
+    for low, high, unit in HOLD_PATTERN.findall(text):
+        value = (int(low) + int(high)) / 2 if high else int(low)
+        holds.append(value * HOLD_UNIT_SECONDS[unit.lower()])
+    return holds
+
+
+def corpus_timings(pose_id: str, docs, lexicon=None):
+    """(typical hold in seconds or None, ids of the poses moved into next) for a pose, from retrieved chunks.
+
+    With a lexicon only chunks whose first pose mention is this pose count, so a page about
+    another pose that merely moves into this one doesn't lend it its hold time.
+    """
+    texts = [doc.page_content for doc in docs]
+    if lexicon is not None:
+        about = [text for text in texts if lexicon.find(text, fuzzy=False)[:1] == [pose_id]]
+        texts = about or [text for text in texts if pose_id in lexicon.find(text, fuzzy=False)]
+    holds = [hold for text in texts for hold in parse_hold_seconds(text)]
+    transitions = Counter()
+    if lexicon is not None:
+        for text in texts:
+            for phrase in TRANSITION_PATTERN.findall(text):
+                found = [found_id for found_id in lexicon.find(phrase, fuzzy=False) if found_id != pose_id]
+                if found:
+                    transitions[found[0]] += 1
+    hold = statistics.median(holds) if holds else None
+    return hold, [found_id for found_id, _ in transitions.most_common(MAX_TRANSITIONS)]
+
+
+def extract_pose_facts(pose, retriever, llm, index_version: str = None, lexicon=None) -> PoseFacts:
+    """Retrieve context for one lexicon pose and have the LLM pull out the structured fields."""
+    query = f"Tell me the benefits and contraindications of the yoga pose '{pose.name}' ({pose.sanskrit})."
+    # Chunks tagged with the pose at index time, or the whole corpus when none are
+    docs = retriever.get_relevant_documents(query, filter={"pose_ids": [pose.id]})[:3]
+    docs = docs or retriever.get_relevant_documents(query)[:3]
+    facts = PoseFacts(pose.id, pose.name, pose.sanskrit, index_version=index_version)
+    if not docs:
+        return facts
+
+    text = "\n\n".join(doc.page_content for doc in docs)
+    response = llm.invoke(EXTRACTION_PROMPT.format(pose=pose.name, sanskrit=pose.sanskrit or "-", text=text))
+    fields = _parse_json_object(response.content)
+
+    facts.description = str(fields.get("description") or "").strip()
+    facts.how_to = _as_list(fields.get("how_to"))
+    facts.benefits = _as_list(fields.get("benefits"))
+    facts.contraindications = _as_list(fields.get("contraindications"))
+    facts.sources = sorted({doc.metadata.get("source", "Unknown source") for doc in docs})
+    facts.hold_seconds, facts.transitions = corpus_timings(pose.id, docs, lexicon)
+    return facts
+
+
+def build_pose_store(lexicon, retriever, llm, index_dir: str, index_version: str = None, force: bool = False,
+                     max_workers: int = 4) -> PoseStore:
+    store = PoseStore(os.path.join(index_dir, POSE_STORE_FILE))
+    stored_versions = store.versions()
+    todo = [
+        pose for pose in lexicon.poses.values()
+        if force or stored_versions.get(pose.id) != index_version
+    ]
+    logger.info(f"Extracting {len(todo)} of {len(lexicon)} poses ({len(lexicon) - len(todo)} already stored)")
+
+    stored, empty, failed = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(extract_pose_facts, pose, retriever, llm, index_version, lexicon): pose
+                   for pose in todo}
+        for future in as_completed(futures):
+            pose = futures[future]
+            try:
+                facts = future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(f"Failed to extract '{pose.name}': {e}")
+                continue
+            if facts.is_empty:
+                empty += 1
+                logger.info(f"No information on '{pose.name}' in the corpus")
+                continue
+            store.put(facts)
+            stored += 1
+
+    logger.info(f"Pose store: {stored} stored, {empty} without information, {failed} failed")
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute structured pose information from the indexed corpus.")
+    parser.add_argument("--force", action="store_true", help="Re-extract poses that are already stored")
+    parser.add_argument("--workers", type=int, default=4, help="Poses extracted in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from indexer import INDEX_DIR
+    from retriever import load_qa_stack
+    from utils import get_pose_lexicon
+
+    stack = load_qa_stack()
+    build_pose_store(get_pose_lexicon(), stack.retriever, stack.llm, INDEX_DIR, stack.index_version,
+                     force=args.force, max_workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
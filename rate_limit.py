@@ -0,0 +1,346 @@
+"""Process-wide governor for OpenAI requests.
+
+Every request made through the shared OpenAI client (embedder.get_openai_client) goes
+through `GovernedTransport`. That covers chat, rewrite, summary and embedding calls from
+all sessions, and they draw from one budget:
+
+- requests-per-minute and tokens-per-minute token buckets, plus a cap on requests in flight;
+- per-client request and token quotas, so one busy client cannot starve the others. They are
+  keyed by what the server knows of the caller (its address in service.py, see client.py),
+  never by an id the client picks, and a quota that has refilled completely is dropped;
+- a priority queue, so interactive turns go ahead of background work such as index builds;
+- adaptive backoff: a 429 pauses the pool for its retry-after and halves the rate, which
+  then recovers step by step while requests succeed.
+
+Callers wait instead of being warned. Only a request that cannot be admitted within
+RATE_LIMIT_MAX_WAIT fails, with a 429 that the OpenAI client does not retry.
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import httpx
+
+logger = logging.getLogger(__name__)
+
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "80000"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+EMBED_REQUESTS_PER_MINUTE = int(os.getenv("EMBED_REQUESTS_PER_MINUTE", "500"))
+EMBED_TOKENS_PER_MINUTE = int(os.getenv("EMBED_TOKENS_PER_MINUTE", "1000000"))
+USER_REQUESTS_PER_MINUTE = int(os.getenv("USER_REQUESTS_PER_MINUTE", "30"))
+USER_TOKENS_PER_MINUTE = int(os.getenv("USER_TOKENS_PER_MINUTE", "40000"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "120"))
+
+BURST_SECONDS = 10  # buckets hold at most this many seconds of budget
+USER_SWEEP_SECONDS = 60  # how often per-user buckets that refilled completely are dropped
+DEFAULT_COMPLETION_TOKENS = 500  # reserved for replies when the request sets no max_tokens
+MIN_RATE_SCALE = 0.1
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# (user id, priority) of the code currently making requests; background work has no user
+_request_context = contextvars.ContextVar("rate_limit_request_context", default=(None, PRIORITY_BACKGROUND))
+
+
+@contextmanager
+def request_context(user_id: str = None, priority: int = PRIORITY_INTERACTIVE):
+    """Attribute the OpenAI requests made inside the block to a user and priority."""
+    token = _request_context.set((user_id, priority))
+    try:
+        yield
+    finally:
+        _request_context.reset(token)
+
+
+def submit_with_context(executor, fn, *args):
+    """executor.submit that keeps the caller's request context in the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = max(1.0, per_minute * BURST_SECONDS / 60)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float, scale: float = 1.0):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_minute / 60 * scale)
+        self.updated = now
+
+    def wait_time(self, amount: float, scale: float = 1.0) -> float:
+        """Seconds until `amount` can be taken; requests above capacity only need a full bucket."""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / (self.per_minute / 60 * scale))
+
+    def take(self, amount: float):
+        self.level -= amount
+
+
+class RateGovernor:
+    """Admits requests in priority order within global and per-user budgets."""
+
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int = None,
+                 user_requests_per_minute: int = None, user_tokens_per_minute: int = None,
+                 max_wait: float = RATE_LIMIT_MAX_WAIT):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.user_requests_per_minute = user_requests_per_minute
+        self.user_tokens_per_minute = user_tokens_per_minute
+        self.max_wait = max_wait
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self.scale = 1.0
+        self.paused_until = 0.0
+        self.stats = {"granted": 0, "waited": 0, "wait_seconds": 0.0, "throttled": 0, "rejected": 0}
+        self._users = {}  # user id -> (request bucket, token bucket)
+        self._swept = time.monotonic()
+        self._waiting = []  # heap of (priority, sequence, tokens, user id)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def set_rates(self, requests_per_minute: int = None, tokens_per_minute: int = None):
+        with self._cond:
+            if requests_per_minute:
+                self.requests = TokenBucket(requests_per_minute)
+            if tokens_per_minute:
+                self.tokens = TokenBucket(tokens_per_minute)
+            self._cond.notify_all()
+
+    def _user_buckets(self, user_id):
+        if user_id is None or not (self.user_requests_per_minute and self.user_tokens_per_minute):
+            return None
+        if user_id not in self._users:
+            self._users[user_id] = (TokenBucket(self.user_requests_per_minute),
+                                    TokenBucket(self.user_tokens_per_minute))
+        return self._users[user_id]
+
+    def _sweep_users(self, now):
+        """Drop the buckets of users back at their full quota; a new user starts with full buckets anyway."""
+        if now - self._swept < USER_SWEEP_SECONDS:
+            return
+        self._swept = now
+        waiting = {entry[3] for entry in self._waiting}
+        for user_id, buckets in list(self._users.items()):
+            if user_id in waiting:
+                continue
+            for bucket in buckets:
+                bucket.refill(now)
+            if all(bucket.level >= bucket.capacity for bucket in buckets):
+                del self._users[user_id]
+
+    def _user_wait(self, tokens, user_id, now) -> float:
+        buckets = self._user_buckets(user_id)
+        if buckets is None:
+            return 0.0
+        for bucket in buckets:
+            bucket.refill(now)
+        return max(buckets[0].wait_time(1), buckets[1].wait_time(tokens))
+
+    def _global_wait(self, tokens, now):
+        """Seconds until the pool can take the request; None while every slot is in flight."""
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            return None
+        self.requests.refill(now, self.scale)
+        self.tokens.refill(now, self.scale)
+        return max(self.paused_until - now, self.requests.wait_time(1, self.scale),
+                   self.tokens.wait_time(tokens, self.scale))
+
+    def _admission_wait(self, entry, now):
+        _, _, tokens, user_id = entry
+        user_wait = self._user_wait(tokens, user_id, now)
+        if user_wait > 0:
+            return user_wait
+        # Waiters held back only by their own quota do not block the queue behind them
+        for other in sorted(self._waiting):
+            if other is entry:
+                break
+            if self._user_wait(other[2], other[3], now) == 0:
+                return None
+        return self._global_wait(tokens, now)
+
+    def acquire(self, tokens: int, user_id: str = None, priority: int = PRIORITY_BACKGROUND) -> bool:
+        """Block until the request may be sent; False when it could not be admitted within max_wait."""
+        start = time.monotonic()
+        entry = (priority, next(self._sequence), tokens, user_id)
+        with self._cond:
+            self._sweep_users(start)
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._admission_wait(entry, now)
+                    if wait == 0:
+                        break
+                    remaining = start + self.max_wait - now
+                    if remaining <= 0:
+                        self.stats["rejected"] += 1
+                        logger.warning(f"{self.name}: request for user '{user_id}' not admitted "
+                                       f"within {self.max_wait:.0f}s")
+                        return False
+                    self._cond.wait(min(wait if wait is not None else 1.0, remaining, 1.0))
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            buckets = self._user_buckets(user_id)
+            if buckets is not None:
+                buckets[0].take(1)
+                buckets[1].take(tokens)
+            self.in_flight += 1
+            self.stats["granted"] += 1
+
+        waited = time.monotonic() - start
+        if waited > 0.05:
+            self.stats["waited"] += 1
+            self.stats["wait_seconds"] += waited
+            logger.debug(f"{self.name}: waited {waited:.2f}s for a slot (user '{user_id}', priority {priority})")
+        return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def observe(self, status_code: int, headers):
+        """Adapt to the API's answer: back off on 429, follow its remaining budget, recover on success."""
+        with self._cond:
+            now = time.monotonic()
+            if status_code == 429:
+                retry_after = _retry_after_seconds(headers)
+                self.paused_until = max(self.paused_until, now + retry_after)
+                self.scale = max(MIN_RATE_SCALE, self.scale / 2)
+                self.stats["throttled"] += 1
+                logger.warning(f"{self.name}: rate limited by the API, pausing {retry_after:.1f}s "
+                               f"and running at {self.scale:.0%} of the configured rate")
+                return
+            if status_code < 400:
+                self.scale = min(1.0, self.scale + 0.05)
+            for header, bucket in (("x-ratelimit-remaining-requests", self.requests),
+                                   ("x-ratelimit-remaining-tokens", self.tokens)):
+                remaining = headers.get(header)
+                if remaining is not None and remaining.isdigit():
+                    bucket.refill(now, self.scale)
+                    bucket.level = min(bucket.level, float(remaining))
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {**self.stats, "in_flight": self.in_flight, "queued": len(self._waiting),
+                    "users": len(self._users), "rate_scale": round(self.scale, 2)}
+
+
+def _retry_after_seconds(headers) -> float:
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return 2.0
+
+
+def estimate_request_tokens(body: bytes) -> int:
+    """Rough token cost of a chat or embedding request (about 4 characters per token)."""
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        return 1
+    if "messages" in payload:
+        prompt = sum(len(str(message.get("content") or "")) // 4 + 4 for message in payload["messages"])
+        prompt += len(json.dumps(payload.get("functions") or payload.get("tools") or "")) // 4
+        return prompt + (payload.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+    inputs = payload.get("input", "")
+    if isinstance(inputs, str):
+        return max(1, len(inputs) // 4)
+    # Token-id lists (what LangChain sends) count exactly, strings are estimated
+    return max(1, sum(len(item) if isinstance(item, list) else len(str(item)) // 4 for item in inputs))
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(kind: str) -> RateGovernor:
+    """The process-wide governor for "chat" or "embeddings" requests."""
+    with _governors_lock:
+        if kind not in _governors:
+            if kind == "embeddings":
+                _governors[kind] = RateGovernor("embeddings", EMBED_REQUESTS_PER_MINUTE, EMBED_TOKENS_PER_MINUTE)
+            else:
+                _governors[kind] = RateGovernor("chat", LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE,
+                                                LLM_MAX_CONCURRENCY, USER_REQUESTS_PER_MINUTE,
+                                                USER_TOKENS_PER_MINUTE)
+        return _governors[kind]
+
+
+def rate_limit_stats() -> dict:
+    with _governors_lock:
+        governors = dict(_governors)
+    return {kind: governor.snapshot() for kind, governor in governors.items()}
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """Response body that gives the governor its slot back once the body is consumed or closed."""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+                self._on_close = None
+
+
+class GovernedTransport(httpx.BaseTransport):
+    """httpx transport that admits every OpenAI request through the matching governor."""
+
+    def __init__(self, transport: httpx.BaseTransport):
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        governor = get_governor("embeddings" if request.url.path.endswith("/embeddings") else "chat")
+        user_id, priority = _request_context.get()
+        if not governor.acquire(estimate_request_tokens(request.read()), user_id, priority):
+            # Not retried by the OpenAI client; surfaces as a RateLimitError for this request only
+            return httpx.Response(
+                429,
+                headers={"x-should-retry": "false"},
+                json={"error": {"message": "Request quota exceeded, please try again shortly.",
+                                "type": "requests", "code": "rate_limit_exceeded"}},
+                request=request,
+            )
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            governor.release()
+            raise
+        governor.observe(response.status_code, response.headers)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, governor.release),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    def close(self):
+        self._transport.close()
@@ -1,9 +1,34 @@
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+from langchain_openai import ChatOpenAI
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
 from langchain.chains import ConversationalRetrievalChain, LLMChain
 from langchain.prompts import PromptTemplate
-from loader import load_pdfs_from_folder
+from indexer import INDEX_DIR, index_exists, load_manifest
+from embedder import make_embeddings, get_openai_client
+from semantic_cache import SemanticResponseCache
+from keyword_index import KeywordIndex
+from rate_limit import submit_with_context
+from telemetry import telemetry, usage_callback
+from compact_index import compact_index_exists, load_compact_index, load_compact_info
+from shards import (
+    FILTER_FETCH_FACTOR,
+    FILTER_MAX_WIDENING,
+    ShardedVectorStore,
+    filter_key,
+    load_shard_manifest,
+    matcher,
+    chunk_vectors,
+    search_vectors,
+    sharded_index_exists,
+)
+from utils import mentions_known_pose, get_pose_lexicon, get_pose_store
+import logging
 import os
 import streamlit as st
 from dotenv import load_dotenv
@@ -11,26 +36,256 @@ from dotenv import load_dotenv
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-def build_qa_chain():
-    embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+logger = logging.getLogger(__name__)
+
+# How the user question is rewritten before the main call:
+#   "full" - separate round-trip on the main chat model
+#   "fast" - separate round-trip on the cheaper REWRITE_MODEL
+#   "fold" - no extra call, the main call is told to restate the question itself
+REWRITE_MODE = os.getenv("REWRITE_MODE", "fast")
+REWRITE_MODEL = os.getenv("REWRITE_MODEL", "gpt-3.5-turbo")
+FOLDED_REWRITE_INSTRUCTION = (
+    "Before answering, silently restate the user's latest question as a specific, clear question "
+    "about yoga (poses, sequences, anatomy or philosophy) and answer that restated question."
+)
+
+# Retrieval: "hybrid" fuses FAISS and BM25 keyword results, "similarity" is plain FAISS search
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", "3"))
+RETRIEVER_FETCH_K = int(os.getenv("RETRIEVER_FETCH_K", "12"))
+RERANK = os.getenv("RERANK", "mmr")  # none | mmr | cross-encoder
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RRF_K = 60
+
+
+def _doc_key(doc: Document):
+    return doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content
+
+
+class HybridRetriever(BaseRetriever):
+    """Vector and keyword search run side by side, fused with reciprocal-rank fusion and optionally reranked.
+
+    Without a keyword index it is plain vector search. `get_relevant_documents(query, filter={...})`
+    restricts both searches to chunks whose tags match (see shards.py).
+    """
+    vector_store: object  # FAISS or shards.ShardedVectorStore
+    keyword_index: KeywordIndex = None
+    k: int = RETRIEVER_K
+    fetch_k: int = RETRIEVER_FETCH_K
+    rerank: str = RERANK
+    cross_encoder: object = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _vector_search(self, query, filter=None):
+        """(query vector, [(document, stored vector)]) of the fetch_k nearest chunks."""
+        with telemetry.span("vector_search", k=self.fetch_k, filtered=bool(filter)):
+            query_vector = self.vector_store.embeddings.embed_query(query)
+            hits = search_vectors(self.vector_store, [query_vector], self.fetch_k, filter, with_vectors=True)[0]
+        return query_vector, [(doc, vector) for doc, _, vector in hits]
+
+    def _keyword_search(self, query, filter=None):
+        """[(document, chunk id)] of the fetch_k best keyword matches."""
+        matches = matcher(filter)
+        first_k = fetch_k = self.fetch_k * FILTER_FETCH_FACTOR if filter else self.fetch_k
+        checked = {}  # doc_id -> document, or None when it doesn't match
+        with telemetry.span("keyword_search", k=self.fetch_k, filtered=bool(filter)) as span:
+            # A filter may drop most candidates; widen until fetch_k match, the hits run out or the cap is hit
+            while True:
+                docs = []
+                results = self.keyword_index.search(query, fetch_k)
+                for doc_id, _ in results:
+                    if doc_id not in checked:
+                        doc = self.vector_store.docstore.search(doc_id)
+                        checked[doc_id] = doc if isinstance(doc, Document) and matches(doc.metadata) else None
+                    if checked[doc_id] is not None:
+                        docs.append((checked[doc_id], doc_id))
+                        if len(docs) == self.fetch_k:
+                            break
+                if len(docs) == self.fetch_k or len(results) < fetch_k:
+                    break
+                if fetch_k >= first_k * FILTER_MAX_WIDENING:
+                    logger.info(f"Keyword search stopped at {fetch_k} candidates with {len(docs)} of {self.fetch_k} "
+                                f"chunks matching {filter_key(filter)}")
+                    break
+                fetch_k *= 2
+            span.attributes.update(fetched=fetch_k, looked_up=len(checked))
+        return docs
+
+    def _rerank(self, query, docs, query_vector=None, doc_vectors=None):
+        if self.rerank == "cross-encoder" and self.cross_encoder is not None:
+            scores = self.cross_encoder.predict([(query, doc.page_content) for doc in docs])
+            ranked = sorted(zip(scores, range(len(docs))), reverse=True)
+            return [docs[i] for _, i in ranked[:self.k]]
+        if self.rerank == "mmr":
+            if query_vector is None or doc_vectors is None or any(vector is None for vector in doc_vectors):
+                # MMR only compares the vectors stored in the index; without them the fused order stands
+                return docs[:self.k]
+            selected = maximal_marginal_relevance(np.asarray(query_vector, dtype=np.float32), doc_vectors,
+                                                  lambda_mult=0.7, k=self.k)
+            return [docs[i] for i in selected]
+        return docs[:self.k]
+
+    def _get_relevant_documents(self, query, *, run_manager=None, filter: dict = None):
+        keyword_hits = []
+        if self.keyword_index is None:
+            query_vector, vector_hits = self._vector_search(query, filter)
+        else:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                vector_future = submit_with_context(executor, self._vector_search, query, filter)
+                keyword_future = submit_with_context(executor, self._keyword_search, query, filter)
+                (query_vector, vector_hits), keyword_hits = vector_future.result(), keyword_future.result()
+
+        scores = {}
+        docs_by_key = {}
+        vectors = {}  # key -> vector stored in the index
+        ids = {}  # key -> chunk id, for keyword hits
+        for hits, extra in ((vector_hits, vectors), (keyword_hits, ids)):
+            for rank, (doc, value) in enumerate(hits):
+                key = _doc_key(doc)
+                docs_by_key.setdefault(key, doc)
+                extra.setdefault(key, value)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+        keys = sorted(scores, key=scores.get, reverse=True)[:self.fetch_k]
+        if not keys:
+            return []
+        doc_vectors = None
+        if self.rerank == "mmr":
+            # Keyword-only candidates get their vectors from the index by chunk id
+            missing = [ids[key] for key in keys if vectors.get(key) is None and key in ids]
+            found = chunk_vectors(self.vector_store, missing) if missing else {}
+            doc_vectors = [vectors[key] if vectors.get(key) is not None else found.get(ids.get(key))
+                           for key in keys]
+        with telemetry.span("rerank", method=self.rerank, candidates=len(keys)):
+            return self._rerank(query, [docs_by_key[key] for key in keys], query_vector, doc_vectors)
+
+
+def load_cross_encoder():
+    """Optional local reranker; needs the sentence-transformers package."""
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        logger.warning("RERANK=cross-encoder needs sentence-transformers, falling back to MMR")
+        return None
+    return CrossEncoder(CROSS_ENCODER_MODEL)
+
+
+def build_retriever(vector_store, index_dir: str = INDEX_DIR):
+    keyword_index = KeywordIndex.load(index_dir) if RETRIEVAL_MODE == "hybrid" else None
+    if keyword_index is None:
+        if RETRIEVAL_MODE == "hybrid":
+            logger.warning("No keyword index found, run `python indexer.py`; using vector search only")
+        return HybridRetriever(vector_store=vector_store, fetch_k=RETRIEVER_K, rerank="none")
+
+    rerank = RERANK
+    cross_encoder = load_cross_encoder() if rerank == "cross-encoder" else None
+    if rerank == "cross-encoder" and cross_encoder is None:
+        rerank = "mmr"
+    return HybridRetriever(vector_store=vector_store, keyword_index=keyword_index, rerank=rerank,
+                           cross_encoder=cross_encoder)
 
-    if os.path.exists("faiss_index") and os.path.exists("faiss_index/index.faiss"):
-        vector_store = FAISS.load_local("faiss_index", embeddings, allow_dangerous_deserialization=True)
+
+@dataclass
+class QAStack:
+    """Everything a chat turn needs: the vector store, its retriever and the LLM clients."""
+    embeddings: Embeddings
+    vector_store: object  # FAISS or shards.ShardedVectorStore
+    retriever: object
+    llm: ChatOpenAI
+    query_rewrite_chain: LLMChain
+    index_version: str = None
+    rewrite_mode: str = REWRITE_MODE
+
+
+def make_chat_model(model_name: str) -> ChatOpenAI:
+    """Chat model on the process-wide pooled OpenAI client."""
+    return ChatOpenAI(model_name=model_name, temperature=0, openai_api_key=openai_api_key,
+                      client=get_openai_client().chat.completions, callbacks=[usage_callback])
+
+
+def load_qa_stack():
+    embeddings = make_embeddings()
+
+    # Embedding the corpus is an offline step (see indexer.py); the app only ever loads the result
+    if sharded_index_exists(INDEX_DIR):
+        vector_store = ShardedVectorStore.load(INDEX_DIR, embeddings)
+        index_version = load_shard_manifest(INDEX_DIR).get("fingerprint")
+    elif compact_index_exists(INDEX_DIR):
+        vector_store = load_compact_index(INDEX_DIR, embeddings)
+        index_version = load_compact_info(INDEX_DIR).get("fingerprint")
+    elif index_exists(INDEX_DIR):
+        logger.warning("No compact index found, loading the pickled FAISS store; run `python indexer.py` to export one")
+        vector_store = FAISS.load_local(INDEX_DIR, embeddings, allow_dangerous_deserialization=True)
+        index_version = load_manifest(INDEX_DIR).get("fingerprint")
     else:
-        docs = load_pdfs_from_folder("data")
-        splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=200)
-        split_docs = splitter.split_documents(docs)
-        vector_store = FAISS.from_documents(split_docs, embeddings)
-        vector_store.save_local("faiss_index")
+        raise FileNotFoundError(
+            f"No FAISS index found in '{INDEX_DIR}'. Build it first with `python indexer.py`."
+        )
+
+    chat = make_chat_model("gpt-4")
+    rewrite_llm = make_chat_model(REWRITE_MODEL) if REWRITE_MODE == "fast" else chat
+    return build_qa_stack(embeddings, vector_store, index_version, chat, rewrite_llm)
 
-    retriever = vector_store.as_retriever(search_type="similarity", search_kwargs={"k": 3})
 
-    chat = ChatOpenAI(model_name="gpt-4", temperature=0, openai_api_key=openai_api_key)
+def build_qa_stack(embeddings, vector_store, index_version, chat, rewrite_llm, index_dir: str = INDEX_DIR):
+    """QA stack over an already loaded vector store (benchmark.py passes fake models)."""
+    retriever = build_retriever(vector_store, index_dir)
 
     rewrite_prompt = PromptTemplate(
         input_variables=["question"],
         template="Rewrite the user question to be more specific and clear for yoga-related knowledge base: {question}"
     )
-    query_rewrite_chain = LLMChain(llm=chat, prompt=rewrite_prompt)
+    query_rewrite_chain = LLMChain(llm=rewrite_llm, prompt=rewrite_prompt)
+
+    return QAStack(
+        embeddings=embeddings,
+        vector_store=vector_store,
+        retriever=retriever,
+        llm=chat,
+        query_rewrite_chain=query_rewrite_chain,
+        index_version=index_version,
+        rewrite_mode=REWRITE_MODE,
+    )
+
 
-    return retriever, query_rewrite_chain
\ No newline at end of file
+@st.cache_resource(show_spinner="Loading the yoga knowledge base...")
+def get_qa_stack():
+    """Process-wide QA stack, built on first use and shared by every session and rerun."""
+    return load_qa_stack()
+
+
+@st.cache_resource
+def get_response_cache():
+    """Process-wide semantic cache of whole chat turns."""
+    return SemanticResponseCache(get_qa_stack().embeddings)
+
+
+def reload_qa_stack():
+    """Drop the cached QA stack and build a fresh one (e.g. after the index was rebuilt)."""
+    get_qa_stack.clear()
+    get_pose_lexicon.cache_clear()
+    get_pose_store.cache_clear()
+    stack = get_qa_stack()
+    # Answers written from the previous corpus must not be served any more
+    get_response_cache().invalidate(stack.index_version)
+    return stack
+
+
+def rewrite_query(question: str, stack: QAStack) -> str:
+    """Query sent to the main call: rewritten, unless folded into the prompt or already naming a pose."""
+    with telemetry.span("rewrite", mode=stack.rewrite_mode) as span:
+        if stack.rewrite_mode == "fold":
+            span.attributes["skipped"] = "fold"
+            return question
+        if mentions_known_pose(question):
+            logger.debug(f"Skipping query rewrite, question names a known pose: {question}")
+            span.attributes["skipped"] = "known pose"
+            return question
+        return stack.query_rewrite_chain.run(question)
+
+
+def build_qa_chain():
+    stack = get_qa_stack()
+    return stack.retriever, stack.query_rewrite_chain
@@ -0,0 +1,117 @@
+"""Semantic cache for whole chat turns.
+
+Incoming questions are embedded and looked up in a small dedicated FAISS index of
+previous questions. Close enough matches return the stored rewritten query,
+tool calls and reply, so the turn needs no LLM call at all.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_THRESHOLD = 0.95
+MAX_ENTRIES = 2000
+TTL_SECONDS = 24 * 3600
+
+
+@dataclass
+class CachedTurn:
+    question: str
+    rewritten_query: str
+    tool_calls: list
+    reply: str
+    index_version: str
+    scope: str
+    created_at: float = field(default_factory=time.time)
+
+
+class SemanticResponseCache:
+    def __init__(self, embeddings, threshold: float = SIMILARITY_THRESHOLD, max_entries: int = MAX_ENTRIES,
+                 ttl_seconds: int = TTL_SECONDS):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._index = None  # created on first insert, once the embedding size is known
+        self._entries = OrderedDict()  # faiss id -> CachedTurn, least recently used first
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray([self.embeddings.embed_query(question.strip().lower())], dtype=np.float32)
+        faiss.normalize_L2(vector)  # inner product on unit vectors == cosine similarity
+        return vector
+
+    def _remove(self, ids):
+        if ids:
+            self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+            for entry_id in ids:
+                self._entries.pop(entry_id, None)
+
+    def lookup(self, question: str, index_version: str = None, scope: str = ""):
+        """Return the CachedTurn for the most similar previous question, or None below the threshold."""
+        if self._index is None or not self._entries:
+            self.misses += 1
+            return None
+
+        vector = self._embed(question)
+        with self._lock:
+            scores, ids = self._index.search(vector, min(5, len(self._entries)))
+            expired = []
+            for score, entry_id in zip(scores[0], ids[0]):
+                entry = self._entries.get(int(entry_id))
+                if entry is None or score < self.threshold:
+                    continue
+                if self.ttl_seconds and time.time() - entry.created_at > self.ttl_seconds:
+                    expired.append(int(entry_id))
+                    continue
+                if entry.index_version != index_version or entry.scope != scope:
+                    continue
+                self._entries.move_to_end(int(entry_id))
+                self._remove(expired)
+                self.hits += 1
+                logger.debug(f"Semantic cache hit ({score:.3f}) for '{question}' -> '{entry.question}'")
+                return entry
+
+            self._remove(expired)
+            self.misses += 1
+            return None
+
+    def add(self, question: str, rewritten_query: str, tool_calls, reply: str, index_version: str = None,
+            scope: str = ""):
+        vector = self._embed(question)
+        entry = CachedTurn(question, rewritten_query, tool_calls, reply, index_version, scope)
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, np.asarray([entry_id], dtype=np.int64))
+            self._entries[entry_id] = entry
+
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                self._remove(list(self._entries)[:overflow])
+
+    def invalidate(self, index_version: str = None):
+        """Drop every entry built against a different corpus index (or everything when no version is given)."""
+        with self._lock:
+            if self._index is None:
+                return
+            stale = [
+                entry_id for entry_id, entry in self._entries.items()
+                if index_version is None or entry.index_version != index_version
+            ]
+            self._remove(stale)
+        logger.info(f"Semantic cache invalidated {len(stale)} entries")
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
@@ -0,0 +1,442 @@
+"""Yoga sequences with per-pose timings, computed without LLM calls.
+
+    python sequence_engine.py --poses "mountain pose,tree pose,pigeon pose,corpse pose" \
+        --styles hatha,yin --minutes 20,45 --count 40 --json plans.json
+
+All poses of a request are resolved in one pass: one query against the pose store for the
+hold times, transitions and contraindications extracted at index time, then one batched
+vector search for the poses the store doesn't cover, whose hold times and transitions are
+read from the retrieved text. Hold times per style come from the kind of pose (POSE_KINDS,
+CATEGORY_HOLDS), scaled to what the books say where they say it. Resolved timings are kept
+per index version, so `generate_variants` can plan many classes from one resolution.
+
+Sequences are plain dicts with numeric seconds; `format_duration` turns them into text.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+from dataclasses import asdict, dataclass, field
+from pose_lexicon import slugify
+from pose_store import corpus_timings
+from shards import filter_key, search_vectors
+from telemetry import telemetry
+from utils import get_pose_lexicon, get_pose_store
+
+logger = logging.getLogger(__name__)
+
+SEQUENCE_SEARCH_K = int(os.getenv("SEQUENCE_SEARCH_K", "4"))  # chunks read per pose missing from the store
+MIN_HOLD_SECONDS = 5
+TIMING_CACHE_SIZE = 10_000
+
+STYLES = ("hatha", "yin", "vinyasa")
+DEFAULT_HOLD_TIMES = {
+    "hatha": 30,
+    "yin": 180,
+    "vinyasa": 5 * 6  # ~5 breaths
+}
+TRANSITION_SECONDS = {"hatha": 10, "yin": 20, "vinyasa": 5}  # into the next pose, or over to the other side
+LEVEL_CHANGE_SECONDS = 10  # extra when getting up or down (standing, kneeling, seated, lying, inverted)
+
+# Seconds per side for each kind of pose: hatha, yin, vinyasa
+CATEGORY_HOLDS = {
+    "warm_up": {"hatha": 45, "yin": 60, "vinyasa": 30},
+    "seated": {"hatha": 60, "yin": 180, "vinyasa": 30},
+    "standing": {"hatha": 30, "yin": 60, "vinyasa": 15},
+    "balance": {"hatha": 30, "yin": 45, "vinyasa": 20},
+    "arm_support": {"hatha": 30, "yin": 45, "vinyasa": 15},
+    "arm_balance": {"hatha": 20, "yin": 30, "vinyasa": 10},
+    "core": {"hatha": 30, "yin": 45, "vinyasa": 15},
+    "backbend": {"hatha": 30, "yin": 120, "vinyasa": 15},
+    "inversion": {"hatha": 60, "yin": 120, "vinyasa": 30},
+    "twist": {"hatha": 30, "yin": 150, "vinyasa": 15},
+    "forward_bend": {"hatha": 45, "yin": 180, "vinyasa": 20},
+    "hip_opener": {"hatha": 45, "yin": 240, "vinyasa": 20},
+    "restorative": {"hatha": 60, "yin": 300, "vinyasa": 30},
+    "final": {"hatha": 300, "yin": 480, "vinyasa": 180},
+}
+# Place of each kind of pose in the arc of a class, used when variants are ordered
+CATEGORY_PHASES = {
+    "seated": 0, "warm_up": 0, "standing": 1, "arm_support": 1, "balance": 2, "arm_balance": 3, "core": 3,
+    "backbend": 4, "inversion": 5, "twist": 6, "forward_bend": 6, "hip_opener": 6, "restorative": 7, "final": 8,
+}
+UNKNOWN_PHASE = 4
+
+# (English name as in the lexicon seed list, kind of pose, level, sides held)
+POSE_KINDS = [
+    ("Mountain Pose", "standing", "standing", 1),
+    ("Tree Pose", "balance", "standing", 2),
+    ("Downward-Facing Dog", "arm_support", "hands", 1),
+    ("Upward-Facing Dog", "backbend", "prone", 1),
+    ("Child's Pose", "restorative", "kneeling", 1),
+    ("Cobra Pose", "backbend", "prone", 1),
+    ("Pigeon Pose", "hip_opener", "seated", 2),
+    ("Warrior I", "standing", "standing", 2),
+    ("Warrior II", "standing", "standing", 2),
+    ("Warrior III", "balance", "standing", 2),
+    ("Triangle Pose", "standing", "standing", 2),
+    ("Chair Pose", "standing", "standing", 1),
+    ("Bridge Pose", "backbend", "supine", 1),
+    ("Shoulderstand", "inversion", "inverted", 1),
+    ("Headstand", "inversion", "inverted", 1),
+    ("Plow Pose", "inversion", "inverted", 1),
+    ("Seated Forward Bend", "forward_bend", "seated", 1),
+    ("Standing Forward Bend", "forward_bend", "standing", 1),
+    ("Bound Angle Pose", "hip_opener", "seated", 1),
+    ("Garland Pose", "hip_opener", "standing", 1),
+    ("Boat Pose", "core", "seated", 1),
+    ("Bow Pose", "backbend", "prone", 1),
+    ("Camel Pose", "backbend", "kneeling", 1),
+    ("Corpse Pose", "final", "supine", 1),
+    ("Cat Pose", "warm_up", "hands", 1),
+    ("Cow Pose", "warm_up", "hands", 1),
+    ("Cat-Cow", "warm_up", "hands", 1),
+    ("Four-Limbed Staff Pose", "arm_support", "hands", 1),
+    ("Plank Pose", "arm_support", "hands", 1),
+    ("Crow Pose", "arm_balance", "hands", 1),
+    ("Crane Pose", "arm_balance", "hands", 1),
+    ("Eagle Pose", "balance", "standing", 2),
+    ("Dancer Pose", "balance", "standing", 2),
+    ("Low Lunge", "hip_opener", "kneeling", 2),
+    ("High Lunge", "standing", "standing", 2),
+    ("Easy Pose", "seated", "seated", 1),
+    ("Lotus Pose", "seated", "seated", 1),
+    ("Cow Face Pose", "hip_opener", "seated", 2),
+    ("Half Lord of the Fishes", "twist", "seated", 2),
+    ("Fish Pose", "backbend", "supine", 1),
+    ("Reclining Bound Angle", "restorative", "supine", 1),
+    ("Happy Baby", "hip_opener", "supine", 1),
+    ("Legs Up the Wall", "restorative", "supine", 1),
+    ("Locust Pose", "backbend", "prone", 1),
+    ("Head-to-Knee Forward Bend", "forward_bend", "seated", 2),
+    ("Pyramid Pose", "forward_bend", "standing", 2),
+    ("Wide-Legged Forward Bend", "forward_bend", "standing", 1),
+    ("Wheel Pose", "backbend", "supine", 1),
+    ("Wild Thing", "backbend", "hands", 2),
+    ("Side Plank", "arm_support", "hands", 2),
+    ("Frog Pose", "hip_opener", "hands", 1),
+    ("Extended Side Angle", "standing", "standing", 2),
+    ("Half Moon Pose", "balance", "standing", 2),
+    ("Hero Pose", "seated", "kneeling", 1),
+    ("Thunderbolt Pose", "seated", "kneeling", 1),
+    ("Staff Pose", "seated", "seated", 1),
+    ("Reclining Hand-to-Big-Toe", "forward_bend", "supine", 2),
+    ("Sphinx Pose", "backbend", "prone", 1),
+    ("Puppy Pose", "backbend", "kneeling", 1),
+    ("Lizard Pose", "hip_opener", "hands", 2),
+]
+POSE_TABLE = {slugify(name): (category, level, sides) for name, category, level, sides in POSE_KINDS}
+
+
+def _round_hold(seconds: float) -> int:
+    return max(MIN_HOLD_SECONDS, int(round(seconds / 5) * 5))
+
+
+def format_duration(seconds: float) -> str:
+    """45 -> "45 s", 150 -> "2 min 30 s", 3900 -> "1 h 5 min"."""
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    parts = [f"{hours} h"] * bool(hours) + [f"{minutes} min"] * bool(minutes) + [f"{seconds} s"] * bool(seconds)
+    return " ".join(parts[:2]) or "0 s"
+
+
+@dataclass
+class PoseTiming:
+    pose_id: str
+    name: str
+    category: str = None  # key of CATEGORY_HOLDS, None for poses outside the table
+    level: str = None
+    sides: int = 1
+    corpus_hold: float = None  # what the sources say (read as a hatha hold), None when they don't
+    transitions: list = field(default_factory=list)  # pose ids the sources move into next
+    contraindications: list = field(default_factory=list)
+    source: str = "default"  # "pose store", "corpus" or "default"
+
+    def hold_for(self, style: str) -> int:
+        """Seconds per side in the given style.
+
+        A hold from the sources is scaled by the style, but kept within half and double of the
+        style's default for this kind of pose (a yin book's five minutes is not a hatha hold).
+        """
+        holds = CATEGORY_HOLDS.get(self.category) or DEFAULT_HOLD_TIMES
+        base = holds.get(style, holds["hatha"])
+        if self.corpus_hold:
+            scaled = self.corpus_hold * base / holds["hatha"]
+            return _round_hold(min(max(scaled, base / 2), base * 2))
+        return base
+
+
+@dataclass
+class SequencePose:
+    pose_id: str
+    name: str
+    hold_seconds: int  # per side
+    sides: int = 1
+    transition_seconds: int = 0  # getting into the pose from the previous one, and over to the other side
+    contraindications: list = field(default_factory=list)
+    source: str = "default"
+
+    @property
+    def total_seconds(self) -> int:
+        return self.hold_seconds * self.sides + self.transition_seconds
+
+
+@dataclass
+class Sequence:
+    sequence_name: str
+    style: str
+    poses: list = field(default_factory=list)
+    error: str = None
+
+    @property
+    def total_seconds(self) -> int:
+        return sum(pose.total_seconds for pose in self.poses)
+
+    def contraindications(self) -> dict:
+        """{condition: names of the poses it applies to}, in order of first appearance."""
+        conditions = {}
+        for pose in self.poses:
+            for condition in pose.contraindications:
+                names = conditions.setdefault(condition, [])
+                if pose.name not in names:
+                    names.append(pose.name)
+        return conditions
+
+    def to_dict(self) -> dict:
+        data = {
+            "sequence_name": self.sequence_name,
+            "style": self.style,
+            "poses": [{**asdict(pose), "total_seconds": pose.total_seconds} for pose in self.poses],
+            "hold_seconds": sum(pose.hold_seconds * pose.sides for pose in self.poses),
+            "transition_seconds": sum(pose.transition_seconds for pose in self.poses),
+            "total_seconds": self.total_seconds,
+            "contraindications": self.contraindications(),
+        }
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+_timings = {}  # (index version, pose id) -> PoseTiming
+_timings_lock = threading.Lock()
+
+
+def clear_timings():
+    with _timings_lock:
+        _timings.clear()
+
+
+def batch_search(vector_store, queries, k: int = SEQUENCE_SEARCH_K, filter: dict = None) -> list:
+    """Top-k documents for each query, with one embedding call and one index search (per shard) for all."""
+    vectors = vector_store.embeddings.embed_documents(list(queries))
+    return [[doc for doc, _ in hits] for hits in search_vectors(vector_store, vectors, k, filter)]
+
+
+def resolve_poses(pose_names, vector_store=None, index_version: str = None, store=None, lexicon=None,
+                  filters: dict = None) -> list:
+    """PoseTiming for each name, in order; synonyms share one resolution.
+
+    Poses are looked up in the pose store together, and whatever the store can't time is
+    read from one batched vector search over the chunks tagged with those poses (and matching
+    `filters`). Without a vector store those poses get the defaults of their kind.
+    """
+    lexicon = lexicon or get_pose_lexicon()
+    store = store if store is not None else get_pose_store()
+    poses = [lexicon.resolve(name) for name in pose_names]
+    pose_ids = [pose.id if pose else lexicon.canonical_id(name) for name, pose in zip(pose_names, poses)]
+
+    version = f"{index_version}|{filter_key(filters)}" if filters else index_version
+    with telemetry.span("pose_timings", poses=len(pose_ids)) as span:
+        with _timings_lock:
+            resolved = {pose_id: _timings[(version, pose_id)] for pose_id in pose_ids
+                        if (version, pose_id) in _timings}
+        missing = {pose_id: (name, pose) for name, pose, pose_id in zip(pose_names, poses, pose_ids)
+                   if pose_id not in resolved}
+        span.cache("pose_timings", not missing)
+
+        if missing:
+            stored = store.get_many(missing, index_version) if store is not None else {}
+            fresh = {}
+            for pose_id, (name, pose) in missing.items():
+                category, level, sides = POSE_TABLE.get(pose_id, (None, None, 1))
+                timing = PoseTiming(pose_id, pose.name if pose else name.title(), category, level, sides)
+                facts = stored.get(pose_id)
+                if facts is not None:
+                    timing.contraindications = facts.contraindications
+                    if not filters:
+                        # The store reads the whole corpus; filtered holds come from the search below
+                        timing.corpus_hold, timing.transitions = facts.hold_seconds, facts.transitions
+                        timing.source = "pose store"
+                fresh[pose_id] = timing
+
+            # Stores extracted before hold times were recorded have none, so those are searched too
+            failed = []  # poses whose search failed keep default holds for this call only
+            to_search = [pose_id for pose_id, timing in fresh.items() if timing.corpus_hold is None]
+            if to_search and vector_store is not None:
+                queries = []
+                for pose_id in to_search:
+                    name, pose = missing[pose_id]
+                    queries.append(f"How long to hold {pose.name} ({pose.sanskrit})" if pose
+                                   else f"How long to hold {name}")
+                # Chunks about at least one of the poses; unknown names have no tag to filter on
+                search_filter = dict(filters or {})
+                if all(missing[pose_id][1] for pose_id in to_search):
+                    search_filter["pose_ids"] = to_search
+                try:
+                    for pose_id, docs in zip(to_search, batch_search(vector_store, queries,
+                                                                     filter=search_filter or None)):
+                        hold, transitions = corpus_timings(pose_id, docs, lexicon)
+                        timing = fresh[pose_id]
+                        if hold is not None:
+                            timing.corpus_hold = hold
+                            timing.source = "corpus" if timing.source == "default" else timing.source
+                        timing.transitions = timing.transitions or transitions
+                except Exception as e:
+                    logger.warning(f"Pose timing search failed, using default holds: {e}")
+                    failed = to_search
+            span.attributes.update(stored=len(stored), searched=len(to_search))
+
+            with _timings_lock:
+                if len(_timings) + len(fresh) > TIMING_CACHE_SIZE:
+                    _timings.clear()
+                _timings.update(((version, pose_id), timing) for pose_id, timing in fresh.items()
+                                if pose_id not in failed)
+            resolved.update(fresh)
+    return [resolved[pose_id] for pose_id in pose_ids]
+
+
+def build_sequence(sequence_name: str, timings, style: str = "hatha", minutes: float = None) -> Sequence:
+    """Lay out resolved poses in the given order; with `minutes` the holds are scaled to fill that time."""
+    sequence = Sequence(sequence_name, style)
+    previous = None
+    for timing in timings:
+        transition = 0
+        if previous is not None:
+            transition = TRANSITION_SECONDS[style]
+            if timing.level and previous.level and timing.level != previous.level:
+                transition += LEVEL_CHANGE_SECONDS
+        transition += (timing.sides - 1) * TRANSITION_SECONDS[style]
+        sequence.poses.append(SequencePose(timing.pose_id, timing.name, timing.hold_for(style), timing.sides,
+                                           transition, list(timing.contraindications), timing.source))
+        previous = timing
+
+    if minutes and sequence.poses:
+        holding = sum(pose.hold_seconds * pose.sides for pose in sequence.poses)
+        moving = sum(pose.transition_seconds for pose in sequence.poses)
+        scale = max(minutes * 60 - moving, 0) / holding
+        for pose in sequence.poses:
+            pose.hold_seconds = _round_hold(pose.hold_seconds * scale)
+    return sequence
+
+
+def create_sequence(params, vector_store=None, style="hatha", index_version: str = None, filters: dict = None) -> dict:
+    """Sequence for a create_yoga_sequence call, with numeric durations in seconds."""
+    try:
+        poses = params.get("poses", [])
+        sequence_name = params.get("sequence_name", None)
+        minutes = params.get("duration_minutes")
+        style = (style or "hatha").lower()
+
+        if not isinstance(poses, list) or not poses:
+            raise ValueError("Invalid or missing 'poses' list.")
+        if style not in STYLES:
+            raise ValueError(f"Unknown style '{style}'.")
+        if minutes is not None and (not isinstance(minutes, (int, float)) or minutes <= 0):
+            raise ValueError("'duration_minutes' must be a positive number.")
+
+        timings = resolve_poses([str(pose) for pose in poses], vector_store, index_version, filters=filters)
+        sequence = build_sequence(sequence_name or f"{style.title()} Yoga Sequence", timings, style, minutes)
+        return sequence.to_dict()
+
+    except Exception as e:
+        logger.error(f"Error creating sequence: {e}")
+        return Sequence("Error", style, error=str(e)).to_dict()
+
+
+def _class_order(timings, rng: random.Random) -> list:
+    """Order poses along the arc of a class; within a phase, follow the transitions the sources give."""
+    phases = {}
+    for timing in timings:
+        phases.setdefault(CATEGORY_PHASES.get(timing.category, UNKNOWN_PHASE), []).append(timing)
+    ordered = []
+    for phase in sorted(phases):
+        remaining = phases[phase]
+        rng.shuffle(remaining)
+        while remaining:
+            previous = ordered[-1] if ordered else None
+            follow = next((timing for timing in remaining if previous and timing.pose_id in previous.transitions),
+                          remaining[0])
+            remaining.remove(follow)
+            ordered.append(follow)
+    return ordered
+
+
+def generate_variants(pose_names, count: int, styles=("hatha",), minutes=(None,), poses_per_sequence: int = None,
+                      seed: int = 0, name: str = "Variant", vector_store=None, index_version: str = None,
+                      filters: dict = None) -> list:
+    """Many sequences drawn from one pool of poses, e.g. to plan a term of classes.
+
+    The pool is resolved once; each variant picks `poses_per_sequence` poses (all of them by
+    default, always keeping the final relaxation), orders them along the arc of a class and
+    cycles through the styles and target lengths. No LLM call is made.
+    """
+    timings = list({timing.pose_id: timing for timing in
+                    resolve_poses(pose_names, vector_store, index_version, filters=filters)}.values())
+    if not timings:
+        return []
+    finals = [timing for timing in timings if timing.category == "final"]
+    others = [timing for timing in timings if timing.category != "final"]
+    size = min(poses_per_sequence or len(timings), len(timings))
+
+    rng = random.Random(seed)
+    variants = []
+    for i in range(count):
+        style = styles[i % len(styles)]
+        target = minutes[(i // len(styles)) % len(minutes)]
+        chosen = finals[:size] + rng.sample(others, max(size - len(finals), 0))
+        title = f"{name} {i + 1}" + (f" ({target} min {style})" if target else f" ({style})")
+        variants.append(build_sequence(title, _class_order(chosen, rng), style, target).to_dict())
+    return variants
+
+
+def _csv(value: str) -> list:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate timed yoga sequences in bulk, without LLM calls.")
+    parser.add_argument("--poses", required=True, help="Comma-separated pool of pose names")
+    parser.add_argument("--count", type=int, default=10, help="Number of sequences")
+    parser.add_argument("--styles", default="hatha", help="Comma-separated styles to cycle through")
+    parser.add_argument("--minutes", default="", help="Comma-separated target lengths in minutes")
+    parser.add_argument("--per-sequence", type=int, default=None, help="Poses per sequence (default: the whole pool)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--name", default="Variant")
+    parser.add_argument("--json", default=None, help="Write the sequences to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from retriever import load_qa_stack
+
+    stack = load_qa_stack()
+    styles = _csv(args.styles)
+    unknown = [style for style in styles if style not in STYLES]
+    if unknown:
+        parser.error(f"unknown style(s): {', '.join(unknown)}")
+    minutes = [float(value) for value in _csv(args.minutes)] or [None]
+    variants = generate_variants(_csv(args.poses), args.count, styles, minutes, args.per_sequence, args.seed,
+                                 args.name, stack.vector_store, stack.index_version)
+    for variant in variants:
+        poses = ", ".join(pose["name"] for pose in variant["poses"])
+        print(f"{variant['sequence_name']}: {format_duration(variant['total_seconds'])} — {poses}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(variants, f, indent=1, ensure_ascii=False)
+        logger.info(f"Wrote {len(variants)} sequences to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Headless query service: the chat pipeline behind a local async HTTP endpoint.
+
+    python service.py                     # http://127.0.0.1:8765
+    YOGA_SERVICE_URL=http://127.0.0.1:8765 streamlit run app.py
+
+    POST /turn    TurnRequest as JSON -> newline-delimited JSON pipeline events
+    GET  /health  liveness and current load
+    GET  /stats   pose summary and answer cache statistics
+    GET  /metrics per-stage latency percentiles, tokens, cost and cache hit rates
+    POST /reload  reload the index and invalidate cached answers
+
+Turns run on a bounded worker pool; once SERVICE_MAX_PENDING turns are running or
+waiting, new ones are refused with 503 so callers back off instead of piling up.
+
+OpenAI quotas (rate_limit.py) are per client address, not per the user_id in the request
+body. Requests from SERVICE_TRUSTED_PROXIES (the Streamlit app on this host by default)
+are counted against the address they forward in X-Forwarded-For.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from dotenv import load_dotenv
+from pipeline import TurnRequest, error_event, run_turn
+from rate_limit import PRIORITY_INTERACTIVE, rate_limit_stats, request_context
+from telemetry import telemetry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SERVICE_HOST = os.getenv("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8765"))
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "8"))
+SERVICE_MAX_PENDING = int(os.getenv("SERVICE_MAX_PENDING", "32"))
+SERVICE_TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "120"))
+SERVICE_TRUSTED_PROXIES = {address.strip() for address in os.getenv("SERVICE_TRUSTED_PROXIES", "127.0.0.1,::1")
+                           .split(",") if address.strip()}
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class QueryService:
+    """Runs pipeline turns on a worker pool and hands their events to asyncio callers."""
+
+    def __init__(self, stack=None, response_cache=None, max_workers: int = SERVICE_WORKERS,
+                 max_pending: int = SERVICE_MAX_PENDING, timeout: float = SERVICE_TIMEOUT):
+        self.stack = stack
+        self.response_cache = response_cache
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.active = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="turn")
+
+    async def start(self):
+        if self.stack is None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._load)
+
+    def _load(self):
+        from retriever import load_qa_stack
+        from semantic_cache import SemanticResponseCache
+        from utils import get_pose_lexicon, get_pose_store
+
+        get_pose_lexicon.cache_clear()
+        get_pose_store.cache_clear()
+        self.stack = load_qa_stack()
+        if self.response_cache is None:
+            self.response_cache = SemanticResponseCache(self.stack.embeddings)
+        else:
+            # Answers written from the previous corpus must not be served any more
+            self.response_cache.invalidate(self.stack.index_version)
+        logger.info(f"Query service ready, index version {self.stack.index_version}")
+
+    async def reload(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._load)
+        return self.stack.index_version
+
+    @property
+    def busy(self) -> bool:
+        return self.active >= self.max_pending
+
+    async def stream_turn(self, request: TurnRequest, quota_key: str = None):
+        """Async iterator over the events of one turn; raises ServiceBusy when the queue is full.
+
+        OpenAI requests of the turn count against the quota of `quota_key` (default: the user id).
+        """
+        if self.busy:
+            raise ServiceBusy(f"{self.active} turns already in progress")
+        self.active += 1
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        abandoned = threading.Event()
+        stack, response_cache = self.stack, self.response_cache
+
+        def work():
+            try:
+                with request_context(quota_key or request.user_id, PRIORITY_INTERACTIVE):
+                    for event in run_turn(request, stack, response_cache):
+                        if abandoned.is_set():
+                            return
+                        loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as e:
+                logger.exception(f"Turn failed for user '{request.user_id}'")
+                loop.call_soon_threadsafe(events.put_nowait, error_event(e))
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+        loop.run_in_executor(self._executor, work)
+        deadline = loop.time() + self.timeout
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    logger.warning(f"Turn for user '{request.user_id}' timed out after {self.timeout}s")
+                    yield {"event": "error", "message": "The request took too long. Please try again."}
+                    return
+                if event is None:
+                    return
+                yield event
+        finally:
+            # A worker still running after a timeout or disconnect stops at its next event
+            abandoned.set()
+            self.active -= 1
+
+    def stats(self) -> dict:
+        from shards import tag_values
+        from utils import pose_summary_cache
+
+        return {
+            "books": tag_values(self.stack.vector_store, "book") if self.stack is not None else [],
+            "pose_cache": pose_summary_cache.stats,
+            "answer_cache": self.response_cache.stats if self.response_cache is not None else {},
+            "active_turns": self.active,
+            "rate_limits": rate_limit_stats(),
+            "telemetry": telemetry.summary(),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def client_address(request: web.Request) -> str:
+    """Address the turn's quota is kept under: the peer, or the one a trusted proxy forwards for it."""
+    remote = request.remote or "unknown"
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and remote in SERVICE_TRUSTED_PROXIES:
+        # The trusted proxy appends the address it saw last
+        return forwarded.split(",")[-1].strip() or remote
+    return remote
+
+
+async def handle_turn(request: web.Request):
+    service = request.app["service"]
+    try:
+        turn = TurnRequest.from_dict(await request.json())
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        raise web.HTTPBadRequest(text=f"Invalid turn request: {e}")
+    events = service.stream_turn(turn, client_address(request))
+    try:
+        # Admission happens on the first event, before any response headers are sent
+        first = await events.__anext__()
+    except ServiceBusy:
+        raise web.HTTPServiceUnavailable(text="The assistant is busy, please retry shortly.",
+                                         headers={"Retry-After": "2"})
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    try:
+        await response.prepare(request)
+        await response.write(json.dumps(first).encode("utf-8") + b"\n")
+        async for event in events:
+            await response.write(json.dumps(event).encode("utf-8") + b"\n")
+    finally:
+        await events.aclose()
+    await response.write_eof()
+    return response
+
+
+async def handle_health(request: web.Request):
+    service = request.app["service"]
+    return web.json_response({"ok": service.stack is not None, "active_turns": service.active,
+                              "max_pending": service.max_pending})
+
+
+async def handle_stats(request: web.Request):
+    return web.json_response(request.app["service"].stats())
+
+
+async def handle_metrics(request: web.Request):
+    return web.json_response(telemetry.summary())
+
+
+async def handle_reload(request: web.Request):
+    index_version = await request.app["service"].reload()
+    return web.json_response({"index_version": index_version})
+
+
+def make_app(service: QueryService = None) -> web.Application:
+    app = web.Application()
+    app["service"] = service or QueryService()
+
+    async def on_startup(app):
+        await app["service"].start()
+
+    async def on_cleanup(app):
+        app["service"].shutdown()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/turn", handle_turn)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_post("/reload", handle_reload)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the yoga chat pipeline over local HTTP.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS, help="Turns processed in parallel")
+    parser.add_argument("--max-pending", type=int, default=SERVICE_MAX_PENDING,
+                        help="Turns running or queued before new ones are refused")
+    parser.add_argument("--timeout", type=float, default=SERVICE_TIMEOUT, help="Seconds allowed per turn")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    service = QueryService(max_workers=args.workers, max_pending=args.max_pending, timeout=args.timeout)
+    web.run_app(make_app(service), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
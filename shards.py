@@ -0,0 +1,489 @@
+"""Metadata tags on chunks, and per-shard FAISS indexes that are searched side by side.
+
+At index time every chunk is tagged with its book, its topic (asana, anatomy, philosophy or
+general) and the ids of the poses it mentions. The compact export is then split by one of
+those tags (SHARD_KEY, topic by default) into one memory-mapped index per shard:
+
+    shards.json               shard key, corpus fingerprint and, per shard, its directory,
+                              content fingerprint, chunk count and the tag values it holds
+    shards/<name>/            a compact export as written by compact_index.py, plus
+                              tag_rows.json: the shard rows holding each tag value
+
+A shard is only exported again when its own chunks or tags changed, so with SHARD_KEY=book
+adding a manual writes one new shard and leaves the others alone. `python indexer.py
+--rebuild-shard NAME` re-exports a single shard on request. SHARD_KEY=none keeps the single
+compact index.
+
+Searches take a metadata filter such as {"pose_ids": ["pigeon-pose"], "book": ["a.pdf"]}:
+a chunk matches when, for every key, its value (or one of its values) is among the wanted
+ones. Shards whose tag values can't match are skipped, the others are searched in parallel
+and their hits merged by distance. Within a shard the rows matching the tag keys of the
+filter are passed to FAISS as an IDSelectorBatch, so only matching chunks are scored and
+looked up. Other keys (and unsharded stores) are checked on the candidates instead, with
+the candidate list widened up to FILTER_MAX_WIDENING times; searches that still come back
+short of k are logged.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from compact_index import (
+    INDEX_LAYOUT,
+    compact_index_exists,
+    compact_is_current,
+    export_compact_index,
+    load_compact_index,
+)
+from pose_lexicon import slugify, tokens
+from rate_limit import submit_with_context
+from telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+SHARD_KEY = os.getenv("SHARD_KEY", "topic")  # topic | book | none
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", "4"))
+FILTER_FETCH_FACTOR = 4  # candidates fetched per hit wanted when a filter may drop some of them
+FILTER_MAX_WIDENING = 8  # the candidate list grows to at most this many times its first size
+SHARDS_FILE = "shards.json"
+SHARDS_DIR = "shards"
+TAG_ROWS_FILE = "tag_rows.json"
+
+SHARD_KEYS = ("topic", "book", "none")
+TAG_KEYS = ("book", "topic", "pose_ids")
+_NO_ROWS = np.empty(0, dtype="int64")
+TOPIC_WORDS = {
+    "asana": {"pose", "poses", "posture", "postures", "asana", "asanas", "hold", "breaths", "stretch", "stretches",
+              "inhale", "exhale", "alignment", "step", "press"},
+    "anatomy": {"anatomy", "muscle", "muscles", "bone", "bones", "joint", "joints", "spine", "spinal", "vertebrae",
+                "pelvis", "femur", "psoas", "hamstrings", "quadriceps", "fascia", "ligament", "ligaments", "tendon",
+                "diaphragm", "lungs", "nervous", "tissue", "sacrum", "lumbar", "cervical", "thoracic"},
+    "philosophy": {"philosophy", "sutra", "sutras", "patanjali", "limbs", "yama", "yamas", "niyama", "niyamas",
+                   "ahimsa", "satya", "santosha", "dharma", "karma", "samadhi", "dhyana", "dharana", "mantra",
+                   "chakra", "chakras", "consciousness", "vedanta", "gita", "upanishads", "pranayama"},
+}
+POSE_MENTION_WEIGHT = 2  # a named pose counts for as much as two asana words
+
+
+def classify_topic(text: str, pose_ids=()) -> str:
+    """asana, anatomy or philosophy by keyword counts; general when nothing points anywhere."""
+    words = tokens(text)
+    scores = {topic: sum(word in vocabulary for word in words) for topic, vocabulary in TOPIC_WORDS.items()}
+    scores["asana"] += POSE_MENTION_WEIGHT * len(pose_ids)
+    topic = max(scores, key=scores.get)  # ties go to the earlier topic, asana first
+    return topic if scores[topic] else "general"
+
+
+def tag_document(doc: Document, lexicon) -> bool:
+    """Set the book, topic and pose_ids tags of a chunk; returns whether they changed."""
+    pose_ids = lexicon.find(doc.page_content, fuzzy=False)
+    tags = {
+        "book": os.path.basename(str(doc.metadata.get("source", ""))) or "unknown",
+        "topic": classify_topic(doc.page_content, pose_ids),
+        "pose_ids": pose_ids,
+    }
+    changed = any(doc.metadata.get(key) != value for key, value in tags.items())
+    doc.metadata.update(tags)
+    return changed
+
+
+def tag_documents(docs, lexicon) -> int:
+    return sum(tag_document(doc, lexicon) for doc in docs)
+
+
+def matcher(filter: dict):
+    """Predicate over chunk metadata for a filter (see the module docstring)."""
+    wanted = {key: set(value) if isinstance(value, (list, tuple, set)) else {value}
+              for key, value in (filter or {}).items()}
+
+    def matches(metadata: dict) -> bool:
+        for key, values in wanted.items():
+            value = metadata.get(key)
+            if isinstance(value, list):
+                if not values.intersection(value):
+                    return False
+            elif value not in values:
+                return False
+        return True
+
+    return matches
+
+
+def filter_key(filter: dict) -> str:
+    """Stable text form of a filter, for cache keys."""
+    if not filter:
+        return ""
+    return json.dumps({key: sorted(value) if isinstance(value, (list, tuple, set)) else value
+                       for key, value in filter.items()}, sort_keys=True)
+
+
+def shard_name(metadata: dict, key: str = SHARD_KEY) -> str:
+    return slugify(str(metadata.get(key) or "")) or "untagged"
+
+
+def load_shard_manifest(index_dir: str):
+    """Contents of shards.json, or None when the index is not sharded."""
+    path = os.path.join(index_dir, SHARDS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def sharded_index_exists(index_dir: str) -> bool:
+    manifest = load_shard_manifest(index_dir)
+    return bool(manifest) and all(compact_index_exists(os.path.join(index_dir, shard["dir"]))
+                                  for shard in manifest["shards"].values())
+
+
+def index_is_current(index_dir: str, fingerprint: str, layout: str = INDEX_LAYOUT, key: str = SHARD_KEY) -> bool:
+    """Whether the export the app loads matches the corpus fingerprint, layout and shard key."""
+    if key == "none":
+        return compact_is_current(index_dir, fingerprint, layout) and load_shard_manifest(index_dir) is None
+    manifest = load_shard_manifest(index_dir)
+    return (sharded_index_exists(index_dir) and manifest["key"] == key and manifest["fingerprint"] == fingerprint
+            and manifest["layout"] == layout
+            and all(os.path.exists(os.path.join(index_dir, shard["dir"], TAG_ROWS_FILE))
+                    for shard in manifest["shards"].values()))
+
+
+def load_tag_rows(shard_dir: str):
+    """Contents of a shard's tag_rows.json, or None when it has none."""
+    path = os.path.join(shard_dir, TAG_ROWS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_tag_rows(shard_dir: str, fingerprint: str, tag_rows: dict):
+    path = os.path.join(shard_dir, TAG_ROWS_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "tags": tag_rows}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def export_shards(vector_store, index_dir: str, fingerprint: str, layout: str = INDEX_LAYOUT, key: str = SHARD_KEY,
+                  force=()) -> dict:
+    """Split the store by the `key` tag and export each shard whose chunks changed (or is in `force`)."""
+    rows = defaultdict(list)  # shard -> rows of the full index
+    digests = {}
+    tag_rows = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))  # shard -> tag -> value -> shard rows
+    for row in range(vector_store.index.ntotal):
+        doc_id = vector_store.index_to_docstore_id[row]
+        doc = vector_store.docstore.search(doc_id)
+        name = shard_name(doc.metadata, key)
+        doc_tags = {tag: doc.metadata.get(tag) for tag in TAG_KEYS}
+        digests.setdefault(name, hashlib.sha256()).update(f"{doc_id}:{json.dumps(doc_tags)}\n".encode())
+        for tag, value in doc_tags.items():
+            for tag_value in value if isinstance(value, list) else [value] if value is not None else []:
+                tag_rows[name][tag][tag_value].append(len(rows[name]))
+        rows[name].append(row)
+
+    previous = load_shard_manifest(index_dir) or {}
+    shards, exported = {}, []
+    for name in sorted(rows):
+        shard_dir = os.path.join(SHARDS_DIR, name)
+        shard_fingerprint = digests[name].hexdigest()[:16]
+        shard_path = os.path.join(index_dir, shard_dir)
+        if (name in force or not compact_is_current(shard_path, shard_fingerprint, layout)
+                or (load_tag_rows(shard_path) or {}).get("fingerprint") != shard_fingerprint):
+            os.makedirs(shard_path, exist_ok=True)
+            export_compact_index(vector_store, shard_path, shard_fingerprint, layout, rows=rows[name])
+            _write_tag_rows(shard_path, shard_fingerprint, {tag: tag_rows[name][tag] for tag in TAG_KEYS})
+            exported.append(name)
+        shards[name] = {
+            "dir": shard_dir,
+            "fingerprint": shard_fingerprint,
+            "count": len(rows[name]),
+            "tags": {tag: sorted(tag_rows[name][tag]) for tag in TAG_KEYS},
+        }
+    unknown = set(force) - set(shards)
+    if unknown:
+        logger.warning(f"No shard named {', '.join(sorted(unknown))}; shards are: {', '.join(shards)}")
+
+    manifest = {"key": key, "fingerprint": fingerprint, "layout": layout, "shards": shards}
+    path = os.path.join(index_dir, SHARDS_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+    # Shards that are gone are removed once no previous manifest refers to them
+    keep = set(shards) | set(previous.get("shards", {}))
+    shards_dir = os.path.join(index_dir, SHARDS_DIR)
+    for name in os.listdir(shards_dir) if os.path.isdir(shards_dir) else ():
+        if name not in keep:
+            shutil.rmtree(os.path.join(shards_dir, name), ignore_errors=True)
+
+    logger.info(f"Shards by {key}: {len(shards)}, exported {len(exported)} "
+                f"({', '.join(exported) or 'none'}), {len(shards) - len(exported)} unchanged")
+    return manifest
+
+
+def export_index(vector_store, index_dir: str, fingerprint: str, layout: str = INDEX_LAYOUT, key: str = SHARD_KEY,
+                 force=()):
+    """Write the export the app loads: per-shard indexes, or the single compact index for key "none"."""
+    if key == "none":
+        path = os.path.join(index_dir, SHARDS_FILE)
+        if os.path.exists(path):
+            os.remove(path)
+        return export_compact_index(vector_store, index_dir, fingerprint, layout)
+    return export_shards(vector_store, index_dir, fingerprint, layout, key, force)
+
+
+def _filter_rows(tag_rows: dict, filter: dict):
+    """(shard rows matching the filter's tag keys, or None; the rest of the filter)."""
+    if not tag_rows or not filter:
+        return None, filter
+    rows, rest = None, {}
+    for key, value in filter.items():
+        if key not in tag_rows:
+            rest[key] = value
+            continue
+        wanted = value if isinstance(value, (list, tuple, set)) else [value]
+        key_rows = np.unique(np.concatenate([tag_rows[key].get(item, _NO_ROWS) for item in wanted] or [_NO_ROWS]))
+        rows = key_rows if rows is None else np.intersect1d(rows, key_rows, assume_unique=True)
+    return rows, rest
+
+
+def _search_params(index, rows):
+    """FAISS search parameters limiting the search to `rows`, keeping the index's own nprobe/efSearch."""
+    selector = faiss.IDSelectorBatch(rows)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def _reconstruct(index, rows) -> list:
+    """Stored vectors of the rows; None for each when the index can't give them back."""
+    if not len(rows):
+        return []
+    try:
+        return list(index.reconstruct_batch(np.asarray(rows, dtype="int64")))
+    except RuntimeError:
+        # An IVF index without a direct map
+        return [None] * len(rows)
+
+
+def _search_shard(name: str, store, vectors, k: int, filter: dict = None, tag_rows: dict = None,
+                  with_vectors: bool = False) -> list:
+    """[(document, score)] of the k best matching chunks of one shard, per query vector.
+
+    With `with_vectors` each hit is (document, score, stored vector or None).
+
+    Filter keys the shard has tag rows for limit the search to those rows. Other keys are
+    checked on the k*FILTER_FETCH_FACTOR nearest candidates; queries left short of k search
+    again with twice as many, up to FILTER_MAX_WIDENING times the first list, and rows
+    already checked are not looked up again.
+    """
+    rows, rest = _filter_rows(tag_rows, filter)
+    matches = matcher(rest)
+    hits = [[] for _ in vectors]
+    ntotal = store.index.ntotal if rows is None else len(rows)
+    params = None if rows is None or not ntotal else _search_params(store.index, rows)
+    first_n = k * FILTER_FETCH_FACTOR if rest else k
+    n, todo = first_n, list(range(len(vectors)))
+    checked = {}  # row -> document, or None when it doesn't match
+    capped = 0
+    with telemetry.span("shard_search", shard=name, queries=len(vectors), selected=rows is not None) as span:
+        rounds = 0
+        while todo and ntotal:
+            rounds += 1
+            n = min(n, ntotal)
+            distances, found_rows = store.index.search(vectors[todo], n, params=params)
+            short = []
+            for query, query_distances, query_rows in zip(todo, distances, found_rows):
+                found, seen = [], 0
+                for distance, row in zip(query_distances, query_rows):
+                    if row == -1:
+                        continue
+                    seen += 1
+                    row = int(row)
+                    if row not in checked:
+                        doc = store.docstore.search(store.index_to_docstore_id[row])
+                        checked[row] = doc if isinstance(doc, Document) and matches(doc.metadata) else None
+                    if checked[row] is not None:
+                        found.append((checked[row], float(distance), row))
+                        if len(found) == k:
+                            break
+                hits[query] = found
+                # Fewer rows than asked for means the index (or its probed lists) has no more
+                if len(found) < k and seen == n < ntotal:
+                    if n < first_n * FILTER_MAX_WIDENING:
+                        short.append(query)
+                    else:
+                        capped += 1
+            todo, n = short, n * 2
+        span.attributes.update(rounds=rounds, short=sum(len(found) < k for found in hits), looked_up=len(checked))
+    if capped:
+        logger.info(f"Shard {name}: {capped} of {len(vectors)} searches stopped at {first_n * FILTER_MAX_WIDENING} "
+                    f"candidates with fewer than {k} chunks matching {filter_key(rest)}")
+    results = []
+    for found in hits:
+        if with_vectors:
+            stored = _reconstruct(store.index, [row for _, _, row in found])
+            results.append([(doc, score, vector) for (doc, score, _), vector in zip(found, stored)])
+        else:
+            results.append([(doc, score) for doc, score, _ in found])
+    return results
+
+
+def search_stores(stores: dict, vectors, k: int, filter: dict = None, executor=None, tag_rows: dict = None,
+                  with_vectors: bool = False) -> list:
+    """[(document, score)] per query vector over several FAISS stores, merged by distance.
+
+    `tag_rows` maps store names to their tag rows (see load_tag_rows) for filtering by selector.
+    With `with_vectors` each hit also carries its stored vector (see _search_shard).
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    tag_rows = tag_rows or {}
+    if not stores:
+        return [[] for _ in vectors]
+    metrics = {store.index.metric_type for store in stores.values()}
+    if len(metrics) > 1:
+        raise ValueError("Shards with different distance metrics can't be merged")
+    larger_is_better = metrics.pop() == faiss.METRIC_INNER_PRODUCT
+
+    if executor is not None and len(stores) > 1:
+        futures = [submit_with_context(executor, _search_shard, name, store, vectors, k, filter, tag_rows.get(name),
+                                       with_vectors) for name, store in stores.items()]
+        results = [future.result() for future in futures]
+    else:
+        results = [_search_shard(name, store, vectors, k, filter, tag_rows.get(name), with_vectors)
+                   for name, store in stores.items()]
+
+    return [sorted((hit for shard_hits in results for hit in shard_hits[query]),
+                   key=lambda hit: hit[1], reverse=larger_is_better)[:k]
+            for query in range(len(vectors))]
+
+
+def search_vectors(vector_store, vectors, k: int, filter: dict = None, with_vectors: bool = False) -> list:
+    """Batched search over a ShardedVectorStore or a single FAISS store: [(document, score)] per vector."""
+    if isinstance(vector_store, ShardedVectorStore):
+        return vector_store.search_vectors(vectors, k, filter, with_vectors)
+    return search_stores({"all": vector_store}, vectors, k, filter, with_vectors=with_vectors)
+
+
+def similarity_search(vector_store, query: str, k: int, filter: dict = None) -> list:
+    vector = vector_store.embeddings.embed_query(query)
+    return [doc for doc, _ in search_vectors(vector_store, [vector], k, filter)[0]]
+
+
+def chunk_vectors(vector_store, doc_ids) -> dict:
+    """Stored vectors of chunks by id, for stores whose docstore knows the row of an id (compact exports)."""
+    stores = vector_store.shards if isinstance(vector_store, ShardedVectorStore) else {"all": vector_store}
+    found = {}
+    for store in stores.values():
+        row_for_id = getattr(store.docstore, "row_for_id", None)
+        if row_for_id is None:
+            continue
+        rows = {doc_id: row_for_id(doc_id) for doc_id in doc_ids if doc_id not in found}
+        rows = {doc_id: row for doc_id, row in rows.items() if row is not None}
+        for doc_id, vector in zip(rows, _reconstruct(store.index, list(rows.values()))):
+            if vector is not None:
+                found[doc_id] = vector
+    return found
+
+
+def tag_values(vector_store, tag: str) -> list:
+    """Values of a tag across the shards (e.g. every book); empty for an unsharded store."""
+    if isinstance(vector_store, ShardedVectorStore):
+        return vector_store.tag_values(tag)
+    return []
+
+
+class ShardedDocstore:
+    """Chunk lookup by id across the shards' SQLite chunk tables."""
+
+    def __init__(self, shards: dict):
+        self.shards = shards
+
+    def search(self, search: str):
+        for store in self.shards.values():
+            doc = store.docstore.search(search)
+            if isinstance(doc, Document):
+                return doc
+        return f"ID {search} not found."
+
+    def __len__(self):
+        return sum(len(store.docstore) for store in self.shards.values())
+
+
+class ShardedVectorStore:
+    """Read-only store over the per-shard compact indexes; searches skip shards a filter rules out."""
+
+    def __init__(self, shards: dict, tags: dict, embeddings, max_workers: int = SHARD_SEARCH_WORKERS,
+                 tag_rows: dict = None):
+        self.shards = shards  # name -> FAISS
+        self.tags = tags  # name -> {tag: set of values}
+        self.tag_rows = tag_rows or {}  # name -> {tag: {value: shard rows}}
+        self.embedding_function = embeddings
+        self.docstore = ShardedDocstore(shards)
+        self._executor = None
+        if len(shards) > 1 and max_workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shard-search")
+
+    @classmethod
+    def load(cls, index_dir: str, embeddings):
+        manifest = load_shard_manifest(index_dir)
+        shards = {name: load_compact_index(os.path.join(index_dir, shard["dir"]), embeddings)
+                  for name, shard in manifest["shards"].items()}
+        tags = {name: {tag: set(values) for tag, values in shard["tags"].items()}
+                for name, shard in manifest["shards"].items()}
+        tag_rows = {}
+        for name, shard in manifest["shards"].items():
+            stored = load_tag_rows(os.path.join(index_dir, shard["dir"]))
+            if stored is None:
+                logger.warning(f"Shard {name} has no {TAG_ROWS_FILE}, filters are checked chunk by chunk; "
+                               "run `python indexer.py` to export it")
+                continue
+            tag_rows[name] = {tag: {value: np.asarray(rows, dtype="int64") for value, rows in values.items()}
+                              for tag, values in stored["tags"].items()}
+        logger.info(f"Loaded {len(shards)} shards by {manifest['key']}: "
+                    + ", ".join(f"{name} ({shard['count']})" for name, shard in manifest["shards"].items()))
+        return cls(shards, tags, embeddings, tag_rows=tag_rows)
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def __len__(self):
+        return len(self.docstore)
+
+    def tag_values(self, tag: str) -> list:
+        return sorted({value for shard_tags in self.tags.values() for value in shard_tags.get(tag, ())})
+
+    def select(self, filter: dict = None) -> list:
+        """Shards that can hold a chunk matching the filter."""
+        names = []
+        for name, shard_tags in self.tags.items():
+            wanted = {key: value if isinstance(value, (list, tuple, set)) else [value]
+                      for key, value in (filter or {}).items() if key in shard_tags}
+            if all(shard_tags[key].intersection(values) for key, values in wanted.items()):
+                names.append(name)
+        return names
+
+    def search_vectors(self, vectors, k: int, filter: dict = None, with_vectors: bool = False) -> list:
+        stores = {name: self.shards[name] for name in self.select(filter)}
+        return search_stores(stores, vectors, k, filter, self._executor, self.tag_rows, with_vectors)
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, filter: dict = None, **kwargs):
+        return self.search_vectors([embedding], k, filter)[0]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
@@ -0,0 +1,269 @@
+"""Per-stage spans for chat turns: wall time, tokens, cost and cache hits.
+
+Stages open a span with `telemetry.span("rewrite")`. Spans nest through a context
+variable, and worker threads started with rate_limit.submit_with_context inherit the
+current span, so each pose summary lands under its turn. Chat models built with
+`usage_callback` add their tokens and cost to whatever span is current when they are called.
+
+Finished spans are kept in a rolling window per stage and appended to TELEMETRY_PATH as
+JSON lines. The file is written by a background thread, which rotates it once it reaches
+TELEMETRY_MAX_BYTES, so a span never waits for the disk. `telemetry.summary()` turns the
+window into percentiles; the service exposes it at GET /metrics.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_PATH = os.getenv("TELEMETRY_PATH", ".cache/spans.jsonl")  # empty to keep spans in memory only
+TELEMETRY_WINDOW = int(os.getenv("TELEMETRY_WINDOW", "2000"))  # spans per stage used for percentiles
+TELEMETRY_MAX_BYTES = int(os.getenv("TELEMETRY_MAX_BYTES", str(50 * 2**20)))  # span file size before rotating
+TELEMETRY_BACKUPS = int(os.getenv("TELEMETRY_BACKUPS", "3"))  # rotated span files kept
+
+# USD per 1K tokens: (prompt, completion)
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "text-embedding-ada-002": (0.0001, 0.0),
+    "text-embedding-3-small": (0.00002, 0.0),
+    "text-embedding-3-large": (0.00013, 0.0),
+}
+
+
+def model_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Cost in USD; dated model names ("gpt-4-0613") use the price of their family."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        family = max((name for name in MODEL_PRICES if model and model.startswith(name)), key=len, default=None)
+        if family is None:
+            return 0.0
+        prices = MODEL_PRICES[family]
+    return prompt_tokens / 1000 * prices[0] + completion_tokens / 1000 * prices[1]
+
+
+@dataclass
+class Span:
+    name: str
+    turn_id: str = None
+    user_id: str = None
+    parent: str = None
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    started_at: float = field(default_factory=time.time)
+    seconds: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    llm_calls: int = 0
+    cache_hits: dict = field(default_factory=dict)  # cache name -> True (hit) / False (miss)
+    attributes: dict = field(default_factory=dict)
+    error: str = None
+
+    def __post_init__(self):
+        self._root = None
+        self._lock = threading.Lock()
+        # Usage of the span and everything under it, kept on root spans only
+        self.totals = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost": 0.0, "llm_calls": 0}
+
+    def add_usage(self, model: str, prompt_tokens: int, completion_tokens: int):
+        cost = model_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost += cost
+            self.llm_calls += 1
+        root = self._root or self
+        with root._lock:
+            root.totals["prompt_tokens"] += prompt_tokens
+            root.totals["completion_tokens"] += completion_tokens
+            root.totals["total_tokens"] += prompt_tokens + completion_tokens
+            root.totals["cost"] += cost
+            root.totals["llm_calls"] += 1
+
+    def cache(self, name: str, hit: bool):
+        self.cache_hits[name] = hit
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        if self.totals is not None:
+            data["totals"] = dict(self.totals)
+        return data
+
+
+_current_span = contextvars.ContextVar("telemetry_current_span", default=None)
+
+
+def current_span():
+    return _current_span.get()
+
+
+class Telemetry:
+    def __init__(self, path: str = TELEMETRY_PATH, window: int = TELEMETRY_WINDOW,
+                 max_bytes: int = TELEMETRY_MAX_BYTES, backups: int = TELEMETRY_BACKUPS):
+        self.path = path
+        self._recent = defaultdict(lambda: deque(maxlen=window))  # stage -> recent spans
+        self._lock = threading.Lock()
+        self._writer = None
+        self._listener = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Spans go through a queue to a writer thread that keeps the file open and rotates it by size
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                           encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            spans = queue.SimpleQueue()
+            self._writer = logging.getLogger(f"{__name__}.spans.{uuid.uuid4().hex[:8]}")
+            self._writer.propagate = False
+            self._writer.setLevel(logging.INFO)
+            self._writer.addHandler(logging.handlers.QueueHandler(spans))
+            self._listener = logging.handlers.QueueListener(spans, handler)
+            self._listener.start()
+            atexit.register(self.close)
+
+    @contextmanager
+    def span(self, name: str, user_id: str = None, **attributes):
+        """Time a stage; the span is current inside the block and recorded when it ends."""
+        parent = _current_span.get()
+        root = parent._root or parent if parent is not None else None
+        span = Span(
+            name=name,
+            turn_id=root.turn_id if root is not None else uuid.uuid4().hex[:12],
+            user_id=user_id or (root.user_id if root is not None else None),
+            parent=parent.span_id if parent is not None else None,
+            attributes=attributes,
+        )
+        span._root = root
+        if root is not None:
+            span.totals = None
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            if not isinstance(e, GeneratorExit):
+                span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # Generator spans closed from another context
+                pass
+            self.record(span)
+
+    def record(self, span: Span):
+        data = span.to_dict()
+        with self._lock:
+            self._recent[span.name].append(data)
+        writer = self._writer
+        if writer is not None:
+            writer.info(json.dumps(data, default=str))
+
+    def close(self):
+        """Write out the spans still queued and close the file."""
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+            self._writer.handlers.clear()
+            self._writer = None
+
+    def reset(self):
+        """Forget the recent window (the JSON lines already written are kept)."""
+        with self._lock:
+            self._recent.clear()
+
+    def summary(self) -> dict:
+        """Per-stage count, latency percentiles, tokens, cost and cache hit rates over the recent window."""
+        with self._lock:
+            recent = {name: list(spans) for name, spans in self._recent.items()}
+        stages = {}
+        for name, spans in sorted(recent.items()):
+            seconds = np.array([span["seconds"] for span in spans])
+            hits = defaultdict(list)
+            for span in spans:
+                for cache_name, hit in span["cache_hits"].items():
+                    hits[cache_name].append(hit)
+            # Root spans report everything under them
+            usages = [span.get("totals") or span for span in spans]
+            stages[name] = {
+                "count": len(spans),
+                "p50": round(float(np.percentile(seconds, 50)), 3),
+                "p90": round(float(np.percentile(seconds, 90)), 3),
+                "p99": round(float(np.percentile(seconds, 99)), 3),
+                "mean": round(float(seconds.mean()), 3),
+                "tokens": sum(usage["prompt_tokens"] + usage["completion_tokens"] for usage in usages),
+                "cost": round(sum(usage["cost"] for usage in usages), 4),
+                "errors": sum(1 for span in spans if span["error"]),
+                "cache_hit_rate": {cache_name: round(sum(values) / len(values), 3)
+                                   for cache_name, values in hits.items()},
+            }
+        return stages
+
+
+class UsageCallback(BaseCallbackHandler):
+    """Adds the tokens and cost of each chat model call to the span current when the call starts.
+
+    Streamed calls carry no usage from the API, so their tokens are counted locally.
+    """
+
+    def __init__(self):
+        self._runs = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        span = current_span()
+        if span is None:
+            return
+        from utils import count_tokens
+
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name") or "unknown"
+        prompt_tokens = sum(count_tokens(str(message.content), model) + 4 for message in messages[0]) + 2
+        self._runs[run_id] = (span, model, prompt_tokens)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        span, model, prompt_tokens = run
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", prompt_tokens)
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            from utils import count_tokens
+
+            generation = response.generations[0][0] if response.generations and response.generations[0] else None
+            text = generation.text if generation is not None else ""
+            message = getattr(generation, "message", None)
+            if not text and message is not None:
+                kwargs = message.additional_kwargs
+                text = json.dumps(kwargs.get("tool_calls") or kwargs.get("function_call") or {})
+            completion_tokens = count_tokens(text, model)
+        span.add_usage(model, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._runs.pop(run_id, None)
+
+
+telemetry = Telemetry()
+usage_callback = UsageCallback()
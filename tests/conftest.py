@@ -0,0 +1,5 @@
+import os
+
+# Spans stay in memory and no OpenAI key is needed; nothing in the tests calls the API
+os.environ.setdefault("TELEMETRY_PATH", "")
+os.environ.setdefault("OPENAI_API_KEY", "test")
@@ -0,0 +1,63 @@
+import logging
+from langchain.schema import AIMessage, HumanMessage
+from context import ConversationSummary, build_context_messages
+from utils import count_tokens
+
+
+class SummaryLLM:
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def invoke(self, prompt):
+        if self.fail:
+            raise RuntimeError("rate limited")
+        return AIMessage(content="The user asked about hips.")
+
+
+def history(turns):
+    return [("user" if i % 2 == 0 else "assistant", f"message number {i} about pigeon pose") for i in range(turns)]
+
+
+def turn_budget(turns):
+    """Budget that fits exactly `turns` of the messages above."""
+    return (count_tokens("message number 10 about pigeon pose", "gpt-4") + 4) * turns
+
+
+def replayed(messages):
+    return [message.content for message in messages if isinstance(message, (HumanMessage, AIMessage))][:-1]
+
+
+def test_turns_outside_the_window_are_summarised():
+    turns = history(10)
+
+    messages, summary = build_context_messages(turns, "system", "query", summary_llm=SummaryLLM(),
+                                               budget=turn_budget(4))
+
+    assert summary.covered_turns == 6
+    assert "The user asked about hips." in messages[1].content
+    assert replayed(messages) == [content for _, content in turns[6:]]
+
+
+def test_turns_a_failed_summary_missed_are_replayed():
+    turns = history(10)
+    earlier = ConversationSummary("The user asked about hips.", covered_turns=4)
+
+    messages, summary = build_context_messages(turns, "system", "query", summary=earlier,
+                                               summary_llm=SummaryLLM(fail=True), budget=turn_budget(4))
+
+    assert summary == earlier
+    # Turns 4 and 5 fall between the old summary and the window
+    assert replayed(messages) == [content for _, content in turns[4:]]
+
+
+def test_missed_turns_beyond_the_budget_are_reported(caplog):
+    turns = history(12)
+
+    with caplog.at_level(logging.WARNING, logger="context"):
+        messages, summary = build_context_messages(turns, "system", "query", summary_llm=SummaryLLM(fail=True),
+                                                   budget=turn_budget(4))
+
+    assert summary.covered_turns == 0
+    # The newest four of the eight missed turns fit in their own budget
+    assert replayed(messages) == [content for _, content in turns[4:]]
+    assert "4 earlier turns are neither summarised nor replayed" in caplog.text
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+from langchain_core.messages import AIMessageChunk
+from pipeline import TurnRequest, run_turn
+
+
+class ScriptedLLM:
+    """Streams the given chunks for each call in turn."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+
+    def stream(self, messages, **kwargs):
+        yield from self.replies.pop(0)
+
+
+def tool_call_chunk(name):
+    return AIMessageChunk(content="", additional_kwargs={"tool_calls": [
+        {"index": 0, "id": "call-0", "type": "function", "function": {"name": name, "arguments": "{}"}}
+    ]})
+
+
+def test_text_streamed_before_the_tool_calls_stays_in_the_reply():
+    llm = ScriptedLLM(
+        [AIMessageChunk(content="Let me look that up. "), tool_call_chunk("lookup_something")],
+        [AIMessageChunk(content="Here is what I found.")],
+    )
+    stack = SimpleNamespace(llm=llm, rewrite_mode="fold", query_rewrite_chain=SimpleNamespace(llm=None),
+                            index_version="v1")
+
+    events = list(run_turn(TurnRequest(question="Tell me about crow pose"), stack))
+
+    assert [event["text"] for event in events if event["event"] == "delta"] == ["Let me look that up. "]
+    done = events[-1]
+    assert done["event"] == "done"
+    assert done["reply"].startswith("Let me look that up.\n\nHere is what I found.")
@@ -0,0 +1,42 @@
+import pytest
+from langchain_core.documents import Document
+from pose_lexicon import PoseLexicon
+from pose_store import corpus_timings, parse_hold_seconds
+
+
+@pytest.mark.parametrize("text, holds", [
+    ("Hold for 5 breaths.", [30]),
+    ("hold 30-60 seconds", [45]),
+    ("Holding it for 3 to 5 minutes softens the hips.", [240]),
+    ("Hold here for about 90 sec, then hold the pose 2 min.", [90, 120]),
+    ("Keep the spine long and breathe.", []),
+])
+def test_parse_hold_seconds(text, holds):
+    assert parse_hold_seconds(text) == holds
+
+
+def docs(*texts):
+    return [Document(page_content=text) for text in texts]
+
+
+def test_corpus_timings_reads_holds_and_transitions_of_the_pose():
+    chunks = docs(
+        "Pigeon Pose opens the hips. Hold for 10 breaths, then move into Downward-Facing Dog.",
+        "Tree Pose builds balance. Hold for 60 seconds, then step into Pigeon Pose.",
+    )
+
+    hold, transitions = corpus_timings("pigeon-pose", chunks, PoseLexicon.from_seed())
+
+    # The tree pose page only moves into pigeon; its hold belongs to tree pose
+    assert hold == 60
+    assert transitions == ["downward-facing-dog"]
+
+
+def test_corpus_timings_without_a_lexicon_uses_every_chunk():
+    chunks = docs("Hold for 10 breaths.", "Hold for 90 seconds.", "Hold for 2 minutes.")
+
+    assert corpus_timings("pigeon-pose", chunks) == (90, [])
+
+
+def test_corpus_timings_without_holds():
+    assert corpus_timings("pigeon-pose", docs("Pigeon Pose opens the hips."), PoseLexicon.from_seed()) == (None, [])
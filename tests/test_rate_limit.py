@@ -0,0 +1,40 @@
+from unittest import mock
+from aiohttp.test_utils import make_mocked_request
+import rate_limit
+from rate_limit import USER_SWEEP_SECONDS, RateGovernor
+from service import client_address
+
+
+def test_buckets_of_users_back_at_full_quota_are_dropped(monkeypatch):
+    governor = RateGovernor("test", 6000, 600_000, user_requests_per_minute=60, user_tokens_per_minute=6000)
+    now = rate_limit.time.monotonic()
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now)
+
+    def request(user_id, tokens):
+        assert governor.acquire(tokens, user_id)
+        governor.release()
+
+    request("a", 100)
+    now += USER_SWEEP_SECONDS - 5
+    request("b", 1000)  # empties b's token bucket, which refills 100 tokens a second
+    assert set(governor._users) == {"a", "b"}
+
+    # The next request sweeps: a is full again, b has only refilled half way
+    now += 5
+    request("c", 100)
+    assert set(governor._users) == {"b", "c"}
+    assert governor.snapshot()["users"] == 2
+
+
+def request_from(remote, forwarded=None):
+    transport = mock.Mock()
+    transport.get_extra_info.return_value = (remote, 50000)
+    headers = {"X-Forwarded-For": forwarded} if forwarded else {}
+    return make_mocked_request("POST", "/turn", headers=headers, transport=transport)
+
+
+def test_quotas_follow_the_client_address_not_the_request_body():
+    assert client_address(request_from("203.0.113.7")) == "203.0.113.7"
+    # Only a trusted proxy may say whom it forwards for
+    assert client_address(request_from("203.0.113.7", "198.51.100.1")) == "203.0.113.7"
+    assert client_address(request_from("127.0.0.1", "10.0.0.1, 198.51.100.1")) == "198.51.100.1"
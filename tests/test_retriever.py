@@ -0,0 +1,42 @@
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from compact_index import export_compact_index, load_compact_index
+from keyword_index import KeywordIndex
+from retriever import HybridRetriever
+
+
+class QueryOnlyEmbeddings(Embeddings):
+    """Embeds queries along the x axis; candidates must not be embedded again."""
+
+    def embed_query(self, text):
+        return [1.0, 0.0]
+
+    def embed_documents(self, texts):
+        raise AssertionError("candidates were embedded again")
+
+
+def test_mmr_reranks_with_the_vectors_stored_in_the_index(tmp_path):
+    # Chunks 0 and 1 are nearly the same; chunk 2 is further from the query but adds something new
+    vectors = np.asarray([[1.0, 0.2], [1.0, 0.25], [1.0, -0.3], [1.0, 0.28]], dtype=np.float32)
+    texts = ["crow arms", "arms and wrists", "crow balance on the hands", "wrists forward"]
+    index = faiss.IndexFlatL2(2)
+    index.add(vectors)
+    ids = [f"doc-{i}" for i in range(4)]
+    docstore = InMemoryDocstore({doc_id: Document(page_content=text) for doc_id, text in zip(ids, texts)})
+    export_compact_index(FAISS(QueryOnlyEmbeddings(), index, docstore, dict(enumerate(ids))), str(tmp_path), "v1")
+    keyword_index = KeywordIndex()
+    keyword_index.add_many(ids, texts)
+
+    retriever = HybridRetriever(vector_store=load_compact_index(str(tmp_path), QueryOnlyEmbeddings()),
+                                keyword_index=keyword_index, k=2, fetch_k=3, rerank="mmr")
+    docs = retriever.invoke("crow")
+
+    # Chunk 2 is a keyword-only candidate; its vector comes from the index by chunk id
+    assert [doc.page_content for doc in docs] == [texts[0], texts[2]]
+
+    retriever.rerank = "none"
+    assert [doc.page_content for doc in retriever.invoke("crow")] == texts[:2]
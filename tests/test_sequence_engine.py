@@ -0,0 +1,111 @@
+import pytest
+from pose_lexicon import PoseLexicon
+from sequence_engine import (
+    PoseTiming,
+    build_sequence,
+    clear_timings,
+    create_sequence,
+    format_duration,
+    resolve_poses,
+    _timings,
+)
+
+
+@pytest.mark.parametrize("seconds, text", [
+    (0, "0 s"),
+    (45, "45 s"),
+    (59.6, "1 min"),
+    (150, "2 min 30 s"),
+    (3600, "1 h"),
+    (3900, "1 h 5 min"),
+    (3930, "1 h 5 min"),  # only the two largest units are shown
+])
+def test_format_duration(seconds, text):
+    assert format_duration(seconds) == text
+
+
+def test_corpus_holds_are_scaled_by_style_within_limits():
+    pigeon = PoseTiming("pigeon-pose", "Pigeon Pose", "hip_opener", "seated", 2, corpus_hold=60)
+
+    assert pigeon.hold_for("hatha") == 60
+    assert pigeon.hold_for("yin") == 320  # 60 s of hatha is 60 * 240 / 45 in yin
+
+    long_hold = PoseTiming("pigeon-pose", "Pigeon Pose", "hip_opener", "seated", 2, corpus_hold=600)
+    assert long_hold.hold_for("hatha") == 90  # at most twice the category default
+
+
+def test_poses_without_a_corpus_hold_get_their_category_default():
+    assert PoseTiming("corpse-pose", "Corpse Pose", "final").hold_for("yin") == 480
+    assert PoseTiming("mystery", "Mystery").hold_for("hatha") == 30
+
+
+def timings():
+    return [
+        PoseTiming("mountain-pose", "Mountain Pose", "standing", "standing", 1),
+        PoseTiming("tree-pose", "Tree Pose", "balance", "standing", 2),
+        PoseTiming("child-s-pose", "Child's Pose", "restorative", "kneeling", 1),
+    ]
+
+
+def test_build_sequence_adds_transitions_sides_and_level_changes():
+    sequence = build_sequence("Test", timings(), "hatha")
+
+    assert [pose.hold_seconds for pose in sequence.poses] == [30, 30, 60]
+    # Into tree pose, then over to its other side; getting down to the floor costs extra
+    assert [pose.transition_seconds for pose in sequence.poses] == [0, 20, 20]
+    assert sequence.total_seconds == 30 + 30 * 2 + 60 + 20 + 20
+
+
+@pytest.mark.parametrize("minutes", [5, 12.5, 30])
+def test_build_sequence_scales_the_holds_to_the_requested_length(minutes):
+    sequence = build_sequence("Test", timings(), "hatha", minutes)
+
+    transitions = sum(pose.transition_seconds for pose in sequence.poses)
+    assert transitions == 40
+    # Holds are rounded to 5 s, so each side may be off by 2.5 s
+    assert abs(sequence.total_seconds - minutes * 60) <= 2.5 * 4
+    # The proportions between the poses are kept
+    holds = [pose.hold_seconds for pose in sequence.poses]
+    assert holds[0] == holds[1] and abs(holds[2] - 2 * holds[0]) <= 5
+
+
+def test_build_sequence_keeps_a_minimum_hold_when_time_is_short():
+    sequence = build_sequence("Test", timings(), "hatha", minutes=0.5)
+
+    assert all(pose.hold_seconds == 5 for pose in sequence.poses)
+
+
+@pytest.mark.parametrize("params, error", [
+    ({"poses": []}, "Invalid or missing 'poses' list."),
+    ({"poses": "tree pose"}, "Invalid or missing 'poses' list."),
+    ({"poses": ["tree pose"], "duration_minutes": -5}, "'duration_minutes' must be a positive number."),
+])
+def test_create_sequence_reports_invalid_arguments(params, error):
+    assert create_sequence(params)["error"] == error
+
+
+class EmptyStore:
+    def get_many(self, pose_ids, index_version):
+        return {}
+
+
+class FailingVectorStore:
+    class embeddings:
+        @staticmethod
+        def embed_documents(texts):
+            raise RuntimeError("rate limited")
+
+
+def test_default_holds_are_not_cached_after_a_failed_search():
+    clear_timings()
+    lexicon = PoseLexicon.from_seed()
+
+    resolved = resolve_poses(["pigeon pose"], FailingVectorStore(), "v1", store=EmptyStore(), lexicon=lexicon)
+
+    assert resolved[0].source == "default"
+    assert not _timings
+
+    # Without a vector store the defaults are all there is, so they are cached
+    resolve_poses(["pigeon pose"], None, "v1", store=EmptyStore(), lexicon=lexicon)
+    assert ("v1", "pigeon-pose") in _timings
+    clear_timings()
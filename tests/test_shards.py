@@ -0,0 +1,229 @@
+import logging
+import faiss
+import numpy as np
+import pytest
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+import shards
+from shards import (
+    ShardedVectorStore,
+    export_shards,
+    filter_key,
+    load_shard_manifest,
+    matcher,
+    search_stores,
+)
+
+
+def make_store(vectors, metadatas, metric=faiss.METRIC_L2, prefix="doc"):
+    """FAISS store over the given vectors; chunk i is "<prefix>-i" with metadatas[i]."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    index = faiss.IndexFlat(vectors.shape[1], metric)
+    index.add(vectors)
+    ids = [f"{prefix}-{i}" for i in range(len(vectors))]
+    docstore = InMemoryDocstore({doc_id: Document(page_content=doc_id, metadata=metadata)
+                                 for doc_id, metadata in zip(ids, metadatas)})
+    return FAISS(FakeEmbeddings(size=vectors.shape[1]), index, docstore, dict(enumerate(ids)))
+
+
+def contents(hits):
+    return [doc.page_content for doc, _ in hits]
+
+
+def count_lookups(docstore):
+    """Ids looked up in the docstore from now on."""
+    looked_up = []
+    search = docstore.search
+
+    def counting_search(doc_id):
+        looked_up.append(doc_id)
+        return search(doc_id)
+
+    docstore.search = counting_search
+    return looked_up
+
+
+def test_matcher_wants_every_key_and_any_value_of_list_tags():
+    matches = matcher({"book": ["a.pdf", "b.pdf"], "pose_ids": ["tree-pose"]})
+
+    assert matches({"book": "a.pdf", "pose_ids": ["mountain-pose", "tree-pose"]})
+    assert not matches({"book": "c.pdf", "pose_ids": ["tree-pose"]})
+    assert not matches({"book": "b.pdf", "pose_ids": ["mountain-pose"]})
+    assert not matches({"book": "b.pdf", "pose_ids": []})
+    assert not matches({"book": "b.pdf"})
+
+
+def test_matcher_takes_single_values_and_no_filter():
+    assert matcher({"topic": "asana"})({"topic": "asana"})
+    assert not matcher({"topic": "asana"})({"topic": "anatomy"})
+    assert matcher(None)({"anything": 1})
+
+
+def test_filter_key_ignores_order():
+    assert filter_key({"book": ["b", "a"], "topic": "asana"}) == filter_key({"topic": "asana", "book": ["a", "b"]})
+    assert filter_key(None) == filter_key({}) == ""
+
+
+def sharded(tags):
+    stores = {name: make_store([[0.0, 0.0]], [{}], prefix=name) for name in tags}
+    return ShardedVectorStore(stores, {name: {tag: set(values) for tag, values in shard_tags.items()}
+                                       for name, shard_tags in tags.items()}, embeddings=None, max_workers=1)
+
+
+def test_select_prunes_shards_whose_tags_cannot_match():
+    store = sharded({
+        "asana": {"topic": ["asana"], "book": ["a.pdf", "b.pdf"], "pose_ids": ["tree-pose"]},
+        "anatomy": {"topic": ["anatomy"], "book": ["b.pdf"], "pose_ids": []},
+    })
+
+    assert store.select() == ["asana", "anatomy"]
+    assert store.select({"topic": "anatomy"}) == ["anatomy"]
+    assert store.select({"book": ["b.pdf"]}) == ["asana", "anatomy"]
+    assert store.select({"pose_ids": ["tree-pose"], "book": "a.pdf"}) == ["asana"]
+    assert store.select({"pose_ids": ["crow-pose"]}) == []
+    # Keys the manifest has no values for can't rule a shard out
+    assert store.select({"language": "en"}) == ["asana", "anatomy"]
+    assert store.tag_values("book") == ["a.pdf", "b.pdf"]
+
+
+def test_l2_hits_are_merged_nearest_first():
+    left = make_store([[1.0, 0.0], [4.0, 0.0]], [{}, {}], prefix="left")
+    right = make_store([[2.0, 0.0], [3.0, 0.0]], [{}, {}], prefix="right")
+
+    hits = search_stores({"left": left, "right": right}, [[0.0, 0.0]], k=3)[0]
+
+    assert contents(hits) == ["left-0", "right-0", "right-1"]
+    assert [score for _, score in hits] == [1.0, 4.0, 9.0]
+
+
+def test_inner_product_hits_are_merged_largest_first():
+    left = make_store([[1.0, 0.0], [4.0, 0.0]], [{}, {}], metric=faiss.METRIC_INNER_PRODUCT, prefix="left")
+    right = make_store([[2.0, 0.0], [3.0, 0.0]], [{}, {}], metric=faiss.METRIC_INNER_PRODUCT, prefix="right")
+
+    hits = search_stores({"left": left, "right": right}, [[1.0, 0.0]], k=3)[0]
+
+    assert contents(hits) == ["left-1", "right-1", "right-0"]
+
+
+def test_shards_with_different_metrics_are_not_merged():
+    l2 = make_store([[1.0, 0.0]], [{}])
+    inner_product = make_store([[1.0, 0.0]], [{}], metric=faiss.METRIC_INNER_PRODUCT)
+
+    with pytest.raises(ValueError):
+        search_stores({"l2": l2, "ip": inner_product}, [[1.0, 0.0]], k=1)
+
+
+def test_filtered_search_widens_until_k_chunks_match():
+    # Forty near chunks from one book hide the two from the other
+    vectors = [[float(i), 0.0] for i in range(40)] + [[100.0, 0.0], [101.0, 0.0]]
+    metadatas = [{"book": "near.pdf"}] * 40 + [{"book": "far.pdf"}] * 2
+    store = make_store(vectors, metadatas)
+    looked_up = count_lookups(store.docstore)
+
+    hits = search_stores({"all": store}, [[0.0, 0.0]], k=2, filter={"book": ["far.pdf"]})[0]
+
+    assert contents(hits) == ["doc-40", "doc-41"]
+    # Rows rejected in an earlier round are not looked up again
+    assert len(looked_up) == len(set(looked_up)) == 42
+
+
+def test_widening_stops_at_its_cap_and_says_so(caplog):
+    vectors = [[float(i), 0.0] for i in range(100)] + [[200.0, 0.0]]
+    store = make_store(vectors, [{"book": "near.pdf"}] * 100 + [{"book": "far.pdf"}])
+
+    with caplog.at_level(logging.INFO, logger="shards"):
+        hits = search_stores({"all": store}, [[0.0, 0.0]], k=2, filter={"book": "far.pdf"})[0]
+
+    # Two hits want 8 candidates at first, so the search stops at 64 of the 101 rows
+    assert hits == []
+    assert "stopped at 64 candidates" in caplog.text
+
+
+def test_filtered_search_returns_fewer_hits_only_when_fewer_match():
+    store = make_store([[float(i), 0.0] for i in range(10)], [{"book": "a.pdf"}] * 9 + [{"book": "b.pdf"}])
+
+    hits = search_stores({"all": store}, [[0.0, 0.0], [9.0, 0.0]], k=3, filter={"book": "b.pdf"})
+
+    assert [contents(query_hits) for query_hits in hits] == [["doc-9"], ["doc-9"]]
+
+
+def corpus(topic_of_last="asana"):
+    metadatas = [
+        {"book": "a.pdf", "topic": "asana", "pose_ids": ["tree-pose"]},
+        {"book": "a.pdf", "topic": "anatomy", "pose_ids": []},
+        {"book": "b.pdf", "topic": topic_of_last, "pose_ids": ["crow-pose"]},
+    ]
+    return make_store([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]], metadatas)
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    """Names of the shards export_shards writes."""
+    names = []
+    export = shards.export_compact_index
+
+    def recording_export(vector_store, index_dir, *args, **kwargs):
+        names.append(index_dir.rsplit("/", 1)[-1])
+        return export(vector_store, index_dir, *args, **kwargs)
+
+    monkeypatch.setattr(shards, "export_compact_index", recording_export)
+    return names
+
+
+def test_export_shards_writes_only_the_shards_that_changed(tmp_path, exported):
+    index_dir = str(tmp_path)
+
+    manifest = export_shards(corpus(), index_dir, "v1", "flat", key="book")
+    assert sorted(exported) == ["a-pdf", "b-pdf"]
+    assert manifest["shards"]["a-pdf"]["count"] == 2
+    assert manifest["shards"]["a-pdf"]["tags"]["topic"] == ["anatomy", "asana"]
+
+    exported.clear()
+    export_shards(corpus(), index_dir, "v2", "flat", key="book")
+    assert exported == []
+
+    # A changed tag changes only its own shard
+    export_shards(corpus(topic_of_last="anatomy"), index_dir, "v3", "flat", key="book")
+    assert exported == ["b-pdf"]
+
+    exported.clear()
+    export_shards(corpus(topic_of_last="anatomy"), index_dir, "v3", "flat", key="book", force=["a-pdf"])
+    assert exported == ["a-pdf"]
+    assert load_shard_manifest(index_dir)["fingerprint"] == "v3"
+
+
+def test_exported_shards_load_and_search_together(tmp_path):
+    export_shards(corpus(), str(tmp_path), "v1", "flat", key="topic")
+
+    store = ShardedVectorStore.load(str(tmp_path), FakeEmbeddings(size=2))
+
+    assert sorted(store.shards) == ["anatomy", "asana"]
+    assert len(store) == 3
+    hits = store.search_vectors([[1.0, 0.2]], k=3, filter={"book": "a.pdf"})[0]
+    assert contents(hits) == ["doc-0", "doc-1"]
+
+
+def test_shard_tag_rows_restrict_the_search_to_matching_chunks(tmp_path):
+    vectors = [[float(i), 0.0] for i in range(200)] + [[500.0, 0.0], [501.0, 0.0]]
+    metadatas = [{"book": "near.pdf", "topic": "asana", "pose_ids": []}] * 200
+    metadatas += [{"book": "far.pdf", "topic": "asana", "pose_ids": ["crow-pose"]}] * 2
+    export_shards(make_store(vectors, metadatas), str(tmp_path), "v1", "flat", key="topic")
+    store = ShardedVectorStore.load(str(tmp_path), FakeEmbeddings(size=2))
+    looked_up = count_lookups(store.shards["asana"].docstore)
+
+    hits = store.search_vectors([[0.0, 0.0]], k=3, filter={"book": ["far.pdf"], "pose_ids": ["crow-pose"]})[0]
+
+    # Past the widening cap, but the selector only scores the two matching rows
+    assert contents(hits) == ["doc-200", "doc-201"]
+    assert sorted(looked_up) == ["doc-200", "doc-201"]
+    assert store.search_vectors([[0.0, 0.0]], k=3, filter={"book": "far.pdf", "pose_ids": ["tree-pose"]}) == [[]]
+
+
+def test_export_shards_of_an_empty_store(tmp_path):
+    empty = FAISS(FakeEmbeddings(size=2), faiss.IndexFlatL2(2), InMemoryDocstore({}), {})
+
+    manifest = export_shards(empty, str(tmp_path), "v1", "flat", key="book")
+
+    assert manifest["shards"] == {}
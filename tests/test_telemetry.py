@@ -0,0 +1,30 @@
+import json
+from telemetry import Telemetry
+
+
+def test_spans_are_written_in_the_background_and_rotated_by_size(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    telemetry = Telemetry(str(path), max_bytes=2000, backups=1)
+
+    for position in range(20):
+        with telemetry.span("stage", position=position):
+            pass
+    telemetry.close()
+
+    rotated = tmp_path / "spans.jsonl.1"
+    assert path.stat().st_size <= 2000 and rotated.exists()
+    assert not (tmp_path / "spans.jsonl.2").exists()
+    written = [json.loads(line) for file in (rotated, path) for line in file.read_text().splitlines()]
+    # The newest spans are in order at the end; the oldest went with the dropped backups
+    assert [span["attributes"]["position"] for span in written][-3:] == [17, 18, 19]
+    assert telemetry.summary()["stage"]["count"] == 20
+
+
+def test_without_a_path_spans_stay_in_memory():
+    telemetry = Telemetry("")
+
+    with telemetry.span("stage"):
+        pass
+    telemetry.close()
+
+    assert telemetry.summary()["stage"]["count"] == 1
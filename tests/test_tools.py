@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+from langchain_core.messages import AIMessage
+from tools import TOOL_TIMEOUT_TEXT, Tool, ToolCall, ToolContext, ToolResult, parse_tool_calls, run_tool_calls
+
+
+def drive(generator):
+    """(events, return value) of a run_tool_calls generator."""
+    events = []
+    while True:
+        try:
+            events.append(next(generator))
+        except StopIteration as stop:
+            return events, stop.value
+
+
+def registry(*tools):
+    return {tool.name: tool for tool in tools}
+
+
+def direct_tool(name, sections=1, text="section", delay=0.0, timeout=5.0):
+    def run(arguments, context):
+        time.sleep(delay)
+        for position in range(sections):
+            context.show(position, f"{text} {position}")
+        return ToolResult(f"{name} done")
+
+    return Tool({"name": name}, run, timeout=timeout, return_direct=True,
+                section_count=lambda arguments, question: sections)
+
+
+def plain_tool(name, run, timeout=5.0):
+    return Tool({"name": name}, run, timeout=timeout)
+
+
+def call(name, arguments=None, index=0):
+    return ToolCall(f"call-{index}", name, arguments or {})
+
+
+def test_sections_are_laid_out_in_call_order_followed_by_the_reserve():
+    tools = registry(direct_tool("two", sections=2, text="a"), direct_tool("one", text="b"),
+                     plain_tool("image", lambda arguments, context: ToolResult("url")))
+    calls = [call("two", index=0), call("image", index=1), call("one", index=2)]
+
+    events, (results, sections) = drive(run_tool_calls(calls, ToolContext("q", None), reserve=1, registry=tools))
+
+    assert events[0] == {"event": "sections", "count": 4}
+    assert sections == ["a 0", "a 1", "b 0", ""]
+    assert [result.content for result in results] == ["two done", "url", "one done"]
+
+
+def test_a_failing_tool_gets_an_error_result_and_the_others_finish():
+    def broken(arguments, context):
+        raise RuntimeError("boom")
+
+    tools = registry(plain_tool("broken", broken), direct_tool("ok"))
+    calls = [call("broken", index=0), call("ok", index=1)]
+
+    _, (results, sections) = drive(run_tool_calls(calls, ToolContext("q", None), registry=tools))
+
+    assert results[0].error == "boom"
+    assert results[0].content == "The tool failed: boom"
+    assert results[1].error is None
+    assert sections == ["section 0"]
+
+
+def test_unknown_tools_and_unparsed_arguments_are_not_run():
+    tools = registry(direct_tool("ok"))
+    bad_arguments = ToolCall("call-1", "ok", {}, error="invalid JSON arguments")
+    calls = [call("missing", index=0), bad_arguments]
+
+    events, (results, sections) = drive(run_tool_calls(calls, ToolContext("q", None), registry=tools))
+
+    assert results[0].error == "unknown tool 'missing'"
+    assert results[1].error == "invalid JSON arguments"
+    # Neither call writes sections, so none are announced
+    assert events == [] and sections == []
+
+
+def test_a_call_past_its_timeout_gives_up_without_holding_up_the_others():
+    release = threading.Event()
+
+    def stuck(arguments, context):
+        release.wait(5)
+        return ToolResult("too late")
+
+    tools = registry(Tool({"name": "stuck"}, stuck, timeout=0.2, return_direct=True), direct_tool("ok"))
+    calls = [call("stuck", index=0), call("ok", index=1)]
+    try:
+        started = time.monotonic()
+        _, (results, sections) = drive(run_tool_calls(calls, ToolContext("q", None), registry=tools))
+        elapsed = time.monotonic() - started
+    finally:
+        release.set()
+
+    assert elapsed < 2
+    assert results[0].error == "timed out"
+    assert sections == [TOOL_TIMEOUT_TEXT, "section 0"]
+    assert results[1].content == "ok done"
+
+
+def test_the_timeout_starts_when_a_worker_picks_the_call_up():
+    # With one worker the second call waits 0.3 s in the queue, longer than its own 0.2 s timeout
+    tools = registry(direct_tool("slow", delay=0.3, timeout=1.0), direct_tool("quick", delay=0.1, timeout=0.2))
+    calls = [call("slow", index=0), call("quick", index=1)]
+
+    _, (results, sections) = drive(run_tool_calls(calls, ToolContext("q", None), registry=tools, max_workers=1))
+
+    assert [result.error for result in results] == [None, None]
+    assert sections == ["section 0", "section 0"]
+
+
+def test_calls_queued_behind_a_stuck_one_give_up_with_the_batch():
+    release = threading.Event()
+
+    def stuck(arguments, context):
+        release.wait(5)
+        return ToolResult("too late")
+
+    # The stuck call keeps the only worker; the batch may take 2 rounds of the longest timeout, 0.4 s
+    tools = registry(Tool({"name": "stuck"}, stuck, timeout=0.2), direct_tool("queued", timeout=0.2))
+    calls = [call("stuck", index=0), call("queued", index=1)]
+    try:
+        started = time.monotonic()
+        _, (results, sections) = drive(run_tool_calls(calls, ToolContext("q", None), registry=tools, max_workers=1))
+        elapsed = time.monotonic() - started
+    finally:
+        release.set()
+
+    assert elapsed < 1
+    assert [result.error for result in results] == ["timed out", "timed out"]
+    assert sections == [TOOL_TIMEOUT_TEXT]
+
+
+def tool_call_message(*calls):
+    return AIMessage(content="", additional_kwargs={"tool_calls": [
+        {"id": call_id, "type": "function", "function": {"name": name, "arguments": arguments}}
+        for call_id, name, arguments in calls
+    ]})
+
+
+def test_parse_tool_calls_reads_arguments():
+    message = tool_call_message(("a", "get_pose_benefits", json.dumps({"pose_names": ["tree pose"]})),
+                                ("b", "get_yogajournal_pose_image", ""))
+
+    calls = parse_tool_calls(message)
+
+    assert [(call.id, call.name, call.arguments, call.error) for call in calls] == [
+        ("a", "get_pose_benefits", {"pose_names": ["tree pose"]}, None),
+        ("b", "get_yogajournal_pose_image", {}, None),
+    ]
+
+
+def test_parse_tool_calls_flags_malformed_arguments():
+    message = tool_call_message(("a", "get_pose_benefits", '{"pose_names": ["tree'),
+                                ("b", "get_pose_benefits", '["tree pose"]'))
+
+    truncated, not_an_object = parse_tool_calls(message)
+
+    assert truncated.arguments == {} and truncated.error.startswith("invalid JSON arguments")
+    assert not_an_object.arguments == {} and not_an_object.error == "arguments must be a JSON object"
+
+
+def test_parse_tool_calls_without_tool_calls():
+    assert parse_tool_calls(AIMessage(content="Hello")) == []
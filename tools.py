@@ -0,0 +1,283 @@
+"""Tools offered to the chat model, and how the calls of one response are run.
+
+The registry is built from the schemas in function_schemas.py. The main call offers every
+tool with parallel tool calls, so one response can ask for pose benefits and an image
+together. `run_tool_calls` runs those calls side by side, each with its own timeout.
+
+Tools with `return_direct` write sections of the reply themselves through `context.show`
+(pose summaries stream into their sections as they are written). The results of the other
+tools go back to the model in a single follow-up call, which writes the rest of the answer.
+"""
+import json
+import logging
+import math
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Callable
+from function_schemas import (
+    pose_detection_function,
+    create_sequence_function,
+    get_pose_benefits_function,
+    get_yogajournal_pose_image_function
+)
+from rate_limit import submit_with_context
+from sequence_engine import create_sequence, format_duration
+from telemetry import telemetry
+from utils import (
+    POSE_BENEFITS_TIMEOUT,
+    POSE_ERROR_TEXT,
+    POSE_TIMEOUT_TEXT,
+    extract_pose_names,
+    get_yogajournal_pose_image,
+    stream_pose_benefits,
+)
+
+logger = logging.getLogger(__name__)
+
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "4"))
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))  # seconds per call, unless the tool sets its own
+TOOL_TIMEOUT_TEXT = "This took too long to look up. Please ask again."
+
+
+@dataclass
+class ToolCall:
+    id: str
+    name: str
+    arguments: dict
+    error: str = None  # arguments that could not be parsed
+
+    def to_dict(self) -> dict:
+        """The call as the API expects it when it is sent back in the follow-up call."""
+        return {"id": self.id, "type": "function",
+                "function": {"name": self.name, "arguments": json.dumps(self.arguments)}}
+
+
+@dataclass
+class ToolResult:
+    content: str  # what the model sees in the follow-up call
+    pose_names: list = field(default_factory=list)  # poses the reply covers, for the Yoga Journal links
+    error: str = None
+
+
+@dataclass
+class ToolContext:
+    """What a tool may use while it runs: the turn's settings and a way to update its sections."""
+    question: str
+    stack: object
+    style: str = "hatha"
+    show_images: bool = True
+    show: Callable = lambda position, text: None  # show(position within the call's sections, text)
+    filters: dict = None  # metadata filter for every search of the turn (see shards.py)
+
+
+@dataclass
+class Tool:
+    schema: dict
+    run: Callable  # run(arguments, context) -> ToolResult
+    timeout: float = TOOL_TIMEOUT
+    return_direct: bool = False
+    section_count: Callable = lambda arguments, question: 1  # sections a return_direct call fills
+
+    @property
+    def name(self) -> str:
+        return self.schema["name"]
+
+    def definition(self) -> dict:
+        return {"type": "function", "function": self.schema}
+
+
+def format_sequence_output(sequence):
+    output = f"🧘‍♀️ **{sequence['sequence_name']}** ({sequence['style'].title()})\n\n"
+    for i, pose in enumerate(sequence["poses"], 1):
+        each_side = " on each side" if pose["sides"] > 1 else ""
+        output += f"- Step {i}: {pose['name']} — hold for {format_duration(pose['hold_seconds'])}{each_side}.\n"
+    output += f"\n🕒 Total Duration: {format_duration(sequence['total_seconds'])}"
+    if sequence["poses"] and sequence["transition_seconds"]:
+        output += f" (including {format_duration(sequence['transition_seconds'])} of transitions)"
+    if sequence["contraindications"]:
+        cautions = "; ".join(f"{condition} ({', '.join(names)})"
+                             for condition, names in sequence["contraindications"].items())
+        output += f"\n\n⚠️ Take care with: {cautions}"
+    return output
+
+
+def _requested_poses(arguments: dict, question: str, prefer_lexicon: bool) -> list:
+    names = arguments.get("pose_names") or []
+    if not isinstance(names, list):
+        names = []
+    if prefer_lexicon:
+        # The local pose lexicon is authoritative; the model's list is the fallback for unknown poses
+        return extract_pose_names(question)["pose_names"] or names
+    return names
+
+
+def _pose_benefits(prefer_lexicon: bool):
+    def run(arguments: dict, context: ToolContext) -> ToolResult:
+        pose_names = _requested_poses(arguments, context.question, prefer_lexicon)
+        if not pose_names:
+            section = "Please specify which pose(s) you want to know about."
+            context.show(0, section)
+            return ToolResult("No pose names were given.")
+        sections = {}
+        with telemetry.span("pose_summaries", poses=len(pose_names)):
+            for position, text in stream_pose_benefits(pose_names, context.stack.retriever, context.stack.llm,
+                                                       index_version=context.stack.index_version,
+                                                       filters=context.filters):
+                sections[position] = text
+                context.show(position, text)
+        failed = [pose_names[position] for position, text in sections.items()
+                  if text.endswith((POSE_ERROR_TEXT, POSE_TIMEOUT_TEXT))]
+        return ToolResult(f"Summaries of {', '.join(pose_names)} were shown to the user.", pose_names=pose_names,
+                          error=f"no summary for {', '.join(failed)}" if failed else None)
+
+    return run
+
+
+def _pose_count(prefer_lexicon: bool):
+    return lambda arguments, question: max(1, len(_requested_poses(arguments, question, prefer_lexicon)))
+
+
+def _create_sequence(arguments: dict, context: ToolContext) -> ToolResult:
+    with telemetry.span("sequence", style=context.style):
+        sequence = create_sequence(arguments, context.stack.vector_store, style=context.style,
+                                   index_version=context.stack.index_version, filters=context.filters)
+    section = format_sequence_output(sequence)
+    context.show(0, section)
+    if sequence.get("error"):
+        return ToolResult(f"The sequence could not be created: {sequence['error']}", error=sequence["error"])
+    return ToolResult(f"The sequence '{sequence['sequence_name']}' with {len(sequence['poses'])} poses "
+                      f"was shown to the user.")
+
+
+def _pose_image(arguments: dict, context: ToolContext) -> ToolResult:
+    pose_name = arguments.get("pose_name", "")
+    if not context.show_images:
+        return ToolResult("The user has turned images off; describe the pose without a link.")
+    return ToolResult(json.dumps({"pose_name": pose_name, "url": get_yogajournal_pose_image(pose_name)}))
+
+
+TOOLS = {
+    tool.name: tool
+    for tool in (
+        Tool(pose_detection_function, _pose_benefits(prefer_lexicon=True), timeout=POSE_BENEFITS_TIMEOUT + 5,
+             return_direct=True, section_count=_pose_count(prefer_lexicon=True)),
+        Tool(get_pose_benefits_function, _pose_benefits(prefer_lexicon=False), timeout=POSE_BENEFITS_TIMEOUT + 5,
+             return_direct=True, section_count=_pose_count(prefer_lexicon=False)),
+        Tool(create_sequence_function, _create_sequence, return_direct=True),
+        Tool(get_yogajournal_pose_image_function, _pose_image, timeout=5),
+    )
+}
+TOOL_DEFINITIONS = [tool.definition() for tool in TOOLS.values()]
+
+
+def parse_tool_calls(message) -> list:
+    """Tool calls of a (streamed and merged) model response."""
+    calls = []
+    for raw in message.additional_kwargs.get("tool_calls") or []:
+        function = raw.get("function", {})
+        try:
+            arguments = json.loads(function.get("arguments") or "{}")
+            error = None if isinstance(arguments, dict) else "arguments must be a JSON object"
+        except json.JSONDecodeError as e:
+            arguments, error = {}, f"invalid JSON arguments: {e}"
+        calls.append(ToolCall(raw.get("id"), function.get("name", ""), arguments if not error else {}, error))
+    return calls
+
+
+def is_direct(call: ToolCall, registry: dict = TOOLS) -> bool:
+    """Whether the call writes its own part of the reply, so it needs no follow-up call."""
+    tool = registry.get(call.name)
+    return tool is not None and tool.return_direct and not call.error
+
+
+def run_tool_calls(calls, context: ToolContext, reserve: int = 0, registry: dict = TOOLS,
+                   max_workers: int = TOOL_MAX_WORKERS):
+    """Run the calls of one response side by side, yielding pipeline events as sections fill in.
+
+    Every return_direct call owns a block of section positions, in call order, followed by
+    `reserve` positions the caller fills itself. Returns (one ToolResult per call, final section
+    texts) via `results, sections = yield from run_tool_calls(...)`. Calls that fail or run past
+    their tool's timeout get a result describing that; the others are not held up. A call's
+    timeout starts when a worker picks it up, not while it waits for a free worker. The whole
+    batch is bounded by the longest timeout for every round of calls the workers need; calls
+    still queued then (behind a stuck call, say) give up as well.
+    """
+    offsets, section_count = [], 0
+    for call in calls:
+        offsets.append(section_count)
+        if is_direct(call, registry):
+            section_count += registry[call.name].section_count(call.arguments, context.question)
+    sections = [""] * (section_count + reserve)
+    if sections:
+        yield {"event": "sections", "count": len(sections)}
+
+    results = [None] * len(calls)
+    updates = queue.Queue()
+    pending = set()  # submitted calls without a result yet
+    deadlines = {}  # started calls -> when they time out
+    workers = max(1, min(max_workers, len(calls)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def run(index, call, tool):
+        updates.put(("started", index, None, None))
+        with telemetry.span("tool", tool=call.name) as span:
+            show = lambda position, text: updates.put(("section", index, offsets[index] + position, text))
+            tool_context = replace(context, show=show)
+            try:
+                result = tool.run(call.arguments, tool_context)
+            except Exception as e:
+                span.error = f"{type(e).__name__}: {e}"
+                logger.exception(f"Tool '{call.name}' failed")
+                result = ToolResult(f"The tool failed: {e}", error=str(e))
+        updates.put(("done", index, None, result))
+
+    for index, call in enumerate(calls):
+        tool = registry.get(call.name)
+        if tool is None or call.error:
+            error = call.error or f"unknown tool '{call.name}'"
+            logger.warning(f"Skipping tool call: {error}")
+            results[index] = ToolResult(f"The call was not run: {error}", error=error)
+            continue
+        pending.add(index)
+        submit_with_context(executor, run, index, call, tool)
+    rounds = math.ceil(len(pending) / workers)
+    overall = time.monotonic() + rounds * max((registry[calls[index].name].timeout for index in pending), default=0)
+
+    try:
+        while pending:
+            remaining = max(min([overall, *deadlines.values()]) - time.monotonic(), 0)
+            try:
+                kind, index, position, payload = updates.get(timeout=remaining)
+            except queue.Empty:
+                # Every call past its deadline, or still queued at the overall one, gives up; the others keep running
+                now = time.monotonic()
+                for index in [index for index in pending if deadlines.get(index, overall) <= now]:
+                    call = calls[index]
+                    if index in deadlines:
+                        logger.warning(f"Tool '{call.name}' timed out after {registry[call.name].timeout}s")
+                    else:
+                        logger.warning(f"Tool '{call.name}' timed out waiting for a free worker")
+                    deadlines.pop(index, None)
+                    pending.discard(index)
+                    results[index] = ToolResult("The tool timed out.", error="timed out")
+                    if registry[call.name].return_direct:
+                        sections[offsets[index]] = TOOL_TIMEOUT_TEXT
+                        yield {"event": "section", "position": offsets[index], "text": sections[offsets[index]]}
+                continue
+            if index not in pending:
+                continue
+            if kind == "started":
+                deadlines[index] = min(time.monotonic() + registry[calls[index].name].timeout, overall)
+            elif kind == "section":
+                sections[position] = payload
+                yield {"event": "section", "position": position, "text": payload}
+            else:
+                pending.discard(index)
+                deadlines.pop(index, None)
+                results[index] = payload
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results, sections
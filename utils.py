@@ -4,10 +4,23 @@ import hashlib
 import logging
 import io
 import csv
+import queue
+import time
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.pagesizes import A4
+from pypdf import PdfWriter
+from pose_cache import PoseSummaryCache, POSE_CACHE_PATH
+from pose_lexicon import PoseLexicon
+from pose_store import PoseStore
+from indexer import INDEX_DIR
+from rate_limit import submit_with_context
+from shards import filter_key
+from telemetry import telemetry
 
 def parse_pose_names_from_function_call(function_call):
     try:
@@ -21,75 +34,72 @@ def parse_pose_names_from_function_call(function_call):
         logger.error(f"Error parsing pose names from function call: {e}")
         return []
 
+@lru_cache(maxsize=1)
+def get_pose_lexicon() -> PoseLexicon:
+    """Pose lexicon built by the indexer (seed list only until the index has been built)."""
+    return PoseLexicon.load(INDEX_DIR)
+
+@lru_cache(maxsize=1)
+def get_pose_store():
+    """Precomputed pose facts (see pose_store.py), or None when they have not been built."""
+    return PoseStore.open(INDEX_DIR)
+
+def canonical_pose_id(pose_name: str) -> str:
+    return get_pose_lexicon().canonical_id(pose_name)
+
 def get_yogajournal_pose_image(pose_name: str) -> str:
     """Returns a Yoga Journal URL for the given pose name."""
-    slug = re.sub(r'[^a-z0-9]+', '-', pose_name.lower()).strip('-')
+    pose = get_pose_lexicon().resolve(pose_name)
+    slug = pose.slug if pose else re.sub(r'[^a-z0-9]+', '-', pose_name.lower()).strip('-')
     base_url = f"https://www.yogajournal.com/poses/{slug}/"
     return base_url
 
 def extract_pose_names(text: str) -> dict:
     """Extract yoga pose names (English or Sanskrit) mentioned in the input text."""
-    # A placeholder simple regex example — you can replace this with something smarter
-    possible_poses = re.findall(r'\b[A-Za-z]+\b', text)
-    return {"pose_names": possible_poses}
-
-DEFAULT_HOLD_TIMES = {
-    "hatha": 30,
-    "yin": 180,
-    "vinyasa": 5 * 6  # ~5 breaths
-}
-
-def create_sequence(params, retriever=None, llm=None, style="hatha"):
-    try:
-        poses = params.get("poses", [])
-        sequence_name = params.get("sequence_name", None)
-
-        if not isinstance(poses, list) or not poses:
-            raise ValueError("Invalid or missing 'poses' list.")
+    return {"pose_names": [pose.name for pose in get_pose_lexicon().match(text)]}
 
-        default_hold_time = DEFAULT_HOLD_TIMES.get(style, 30)
+def mentions_known_pose(text: str) -> bool:
+    return bool(get_pose_lexicon().find(text))
 
-        sequence = {
-            "sequence_name": sequence_name or f"{style.title()} Yoga Sequence",
-            "style": style,
-            "poses": [
-                {"name": pose.title(), "duration": f"{default_hold_time} seconds"}
-                for pose in poses
-            ],
-            "total_duration": f"{default_hold_time * len(poses)} seconds"
-        }
+def pose_search_filter(pose: str, filters: dict = None):
+    """Search filter for chunks about one pose: its lexicon id on top of the turn's own filters."""
+    known = get_pose_lexicon().resolve(pose)
+    if known is None:
+        return filters or None
+    return {**(filters or {}), "pose_ids": [known.id]}
 
-        return sequence
-
-    except Exception as e:
-        logger.error(f"Error creating sequence: {e}")
-        return {
-            "sequence_name": "Error",
-            "style": style,
-            "poses": [],
-            "total_duration": "0 seconds",
-            "error": str(e)
-        }
-
-_pose_query_cache = set()
+# Shared by every session in the process; summaries only depend on the pose and the index version.
+# Keys use canonical pose ids so synonyms ("pigeon", "Eka Pada Rajakapotasana") share one entry.
+pose_summary_cache = PoseSummaryCache(path=POSE_CACHE_PATH or None, key_fn=canonical_pose_id)
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
-def get_pose_benefits(pose_names, retriever, base_llm):
-    if not pose_names:
-        return "Please specify which pose(s) you want to know about."
+POSE_BENEFITS_MAX_WORKERS = 4
+POSE_BENEFITS_TIMEOUT = 60  # seconds for the whole batch of poses
+# Shown in place of a summary that failed or timed out; such replies must not be cached
+POSE_ERROR_TEXT = "An error occurred while retrieving pose information."
+POSE_TIMEOUT_TEXT = "This pose took too long to look up. Please ask again."
 
-    results = []
+def summarise_pose(pose, retriever, base_llm, index_version=None, cache=pose_summary_cache, on_update=None,
+                   filters=None):
+    """Retrieve context for one pose and summarise it; errors are turned into a message for that pose only.
 
-    for pose in pose_names:
+    Only chunks tagged with the pose (and matching `filters`) are searched, if there are any.
+    When `on_update` is given the summary is streamed and the callback receives the section so far.
+    """
+    with telemetry.span("summarise", pose=pose) as span:
         try:
             query = f"Tell me the benefits and contraindications of the yoga pose '{pose}'."
-            docs = retriever.get_relevant_documents(query)
+            search_filter = pose_search_filter(pose, filters)
+            with telemetry.span("retrieve", filtered=bool(search_filter)):
+                docs = retriever.get_relevant_documents(query, filter=search_filter)
+                if not docs and search_filter != filters:
+                    # Nothing tagged with this pose, e.g. chunks indexed before it was in the lexicon
+                    docs = retriever.get_relevant_documents(query, filter=filters)
 
             if not docs:
                 logger.warning(f"No documents found for pose: {pose}")
-                results.append(f"### 🧘‍♀️ {pose.title()}\n\nNo information found.")
-                continue
+                return f"### 🧘‍♀️ {pose.title()}\n\nNo information found."
 
             combined_text = "\n\n".join([doc.page_content for doc in docs[:3]])
 
@@ -116,7 +126,15 @@ Text:
 {combined_text}
 """
 
-            response = base_llm.invoke(prompt)
+            header = f"### 🧘‍♀️ {pose.title()}\n\n"
+            if on_update is None:
+                content = base_llm.invoke(prompt).content
+            else:
+                content = ""
+                for chunk in base_llm.stream(prompt):
+                    content += chunk.content
+                    on_update(header + content)
+
             # Extract and deduplicate sources
             sources_set = {doc.metadata.get("source", "Unknown source") for doc in docs[:3]}
             sources_list = sorted(sources_set) 
@@ -124,37 +142,178 @@ Text:
             # Format for display
             sources_text = "\n\n**Sources:**\n" + "\n".join(f"- {src}" for src in sources_list)
 
-            results.append(f"### 🧘‍♀️ {pose.title()}\n\n{response.content.strip()}{sources_text}")
+            section = f"{header}{content.strip()}{sources_text}"
+            if cache is not None:
+                cache.set(pose, index_version, section)
+            return section
 
         except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
             logger.error(f"Failed to get benefits for pose '{pose}': {e}")
-            results.append(f"### 🧘‍♀️ {pose.title()}\n\nAn error occurred while retrieving pose information.")
+            return f"### 🧘‍♀️ {pose.title()}\n\n{POSE_ERROR_TEXT}"
+
+def stream_pose_benefits(pose_names, retriever, base_llm, index_version=None, cache=pose_summary_cache,
+                         max_workers=POSE_BENEFITS_MAX_WORKERS, timeout=POSE_BENEFITS_TIMEOUT, stream_tokens=True,
+                         use_store=True, filters=None):
+    """Yield (position, section so far) while the pose summaries are being written.
+
+    Poses found in the precomputed pose store are answered with a lookup. The others stream in
+    from a thread pool and are handed back on the calling thread, so the caller can render them
+    directly. The last update for each position is the final section.
+    With `stream_tokens=False` only final sections are yielded. With `filters` (e.g. a choice of
+    books) the store, which covers the whole corpus, is skipped and summaries are cached per filter.
+    """
+    store = get_pose_store() if use_store and not filters else None
+    if filters:
+        index_version = f"{index_version}|{filter_key(filters)}"
+
+    # Synonyms resolve to one canonical pose and are only looked up once
+    to_fetch = {}  # canonical id -> (pose name to look up, positions showing it)
+    for position, pose in enumerate(pose_names):
+        pose_id = canonical_pose_id(pose)
+        with telemetry.span("pose_lookup", pose=pose) as span:
+            facts = store.get(pose_id, index_version) if store is not None else None
+            cached = None
+            if store is not None:
+                span.cache("pose_store", facts is not None)
+            if facts is None and cache is not None:
+                cached = cache.get(pose, index_version)
+                span.cache("pose_cache", cached is not None)
+        if facts is not None:
+            yield position, facts.to_markdown(pose)
+            continue
+        if cached is not None:
+            yield position, cached
+            continue
+        if pose_id in to_fetch:
+            to_fetch[pose_id][1].append(position)
+        else:
+            to_fetch[pose_id] = (pose, [position])
+    if not to_fetch:
+        return
 
-    return "\n\n".join(results)
+    # Poses are independent, so retrieval and summarisation run side by side
+    updates = queue.Queue()
 
-# Exporting conversation functions
+    def run(pose_id, pose):
+        on_update = (lambda text: updates.put((pose_id, text, False))) if stream_tokens else None
+        section = summarise_pose(pose, retriever, base_llm, index_version, cache, on_update, filters)
+        updates.put((pose_id, section, True))
 
-def format_chat_plain_text(chat_history):
-    lines = []
-    for role, message in chat_history:
-        prefix = "You" if role == "user" else "Yoga GPT"
-        lines.append(f"{prefix}: {message}")
-    return "\n\n".join(lines)
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(to_fetch)))
+    for pose_id, (pose, _) in to_fetch.items():
+        submit_with_context(executor, run, pose_id, pose)
 
-def format_chat_json(chat_history):
-    return json.dumps([{"role": role, "message": message} for role, message in chat_history], indent=2)
+    pending = dict(to_fetch)
+    deadline = time.monotonic() + timeout
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pose_id, text, final = updates.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pose_id not in pending:
+                continue
+            positions = pending[pose_id][1]
+            if final:
+                pending.pop(pose_id)
+            for position in positions:
+                yield position, text
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for pose, positions in pending.values():
+        logger.warning(f"Timed out after {timeout}s getting benefits for pose '{pose}'")
+        for position in positions:
+            yield position, f"### 🧘‍♀️ {pose.title()}\n\n{POSE_TIMEOUT_TEXT}"
+
+def get_pose_benefits(pose_names, retriever, base_llm, index_version=None, cache=pose_summary_cache,
+                      max_workers=POSE_BENEFITS_MAX_WORKERS, timeout=POSE_BENEFITS_TIMEOUT, use_store=True,
+                      filters=None):
+    if not pose_names:
+        return "Please specify which pose(s) you want to know about."
 
-def format_chat_csv(chat_history):
+    sections = [""] * len(pose_names)
+    for position, text in stream_pose_benefits(pose_names, retriever, base_llm, index_version, cache,
+                                               max_workers, timeout, stream_tokens=False, use_store=use_store,
+                                               filters=filters):
+        sections[position] = text
+    return "\n\n".join(sections)
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads its BPE files on first use; without network fall back to a rough count
+        logger.warning(f"tiktoken encoding for '{model}' unavailable, estimating tokens from length: {e}")
+        return None
+
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return max(1, len(text) // 4) if text else 0
+    return len(encoding.encode(text))
+
+def estimate_token_usage(messages, completion: str, model: str = "gpt-4") -> dict:
+    """Approximate token counts with tiktoken, for streamed responses that carry no usage metadata."""
+    # ~4 tokens of framing per chat message plus 2 to prime the reply
+    prompt_tokens = sum(count_tokens(str(message.content), model) + 4 for message in messages) + 2
+    completion_tokens = count_tokens(completion, model)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+# Exporting conversation functions
+
+# Each format is produced turn by turn, so exports can be written straight into a file
+# instead of being assembled as one big string first.
+
+def iter_chat_plain_text(chat_history):
+    for i, (role, message) in enumerate(chat_history):
+        prefix = "You" if role == "user" else "Yoga GPT"
+        separator = "\n\n" if i else ""
+        yield f"{separator}{prefix}: {message}"
+
+def iter_chat_json(chat_history):
+    if not chat_history:
+        yield "[]"
+        return
+    yield "[\n"
+    for i, (role, message) in enumerate(chat_history):
+        entry = json.dumps({"role": role, "message": message}, indent=2).replace("\n", "\n  ")
+        separator = ",\n" if i else ""
+        yield f"{separator}  {entry}"
+    yield "\n]"
+
+def iter_chat_csv(chat_history):
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(["role", "message"])
     for role, message in chat_history:
         writer.writerow([role, message])
-    return output.getvalue()
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
 
-def format_chat_pdf(chat_history):
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
+def format_chat_plain_text(chat_history):
+    return "".join(iter_chat_plain_text(chat_history))
+
+def format_chat_json(chat_history):
+    return "".join(iter_chat_json(chat_history))
+
+def format_chat_csv(chat_history):
+    return "".join(iter_chat_csv(chat_history))
+
+def _pdf_flowables(chat_history):
     styles = getSampleStyleSheet()
 
     user_style = ParagraphStyle(
@@ -184,10 +343,73 @@ def format_chat_pdf(chat_history):
         flowables.append(para)
         flowables.append(Spacer(1, 8))
 
-    doc.build(flowables)
+    return flowables
+
+def format_chat_pdf(chat_history):
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    doc.build(_pdf_flowables(chat_history))
     buffer.seek(0)
     return buffer
 
+class IncrementalChatPdf:
+    """PDF export that only lays out turns added since the last build.
+
+    The history is rendered in fixed-size segments of turns. Completed segments are kept as
+    PDF bytes and only the trailing, still-growing segment is laid out again; the segments
+    are then concatenated page-wise with pypdf.
+    """
+
+    def __init__(self, turns_per_segment=20):
+        self.turns_per_segment = turns_per_segment
+        self._segments = []
+
+    def build(self, chat_history):
+        size = self.turns_per_segment
+        complete = len(chat_history) // size
+        if complete < len(self._segments):
+            # History was cleared or replaced, start over
+            self._segments = []
+        while len(self._segments) < complete:
+            start = len(self._segments) * size
+            self._segments.append(format_chat_pdf(chat_history[start:start + size]).getvalue())
+
+        parts = list(self._segments)
+        tail = chat_history[complete * size:]
+        if tail or not parts:
+            parts.append(format_chat_pdf(tail).getvalue())
+
+        if len(parts) == 1:
+            return BytesIO(parts[0])
+        writer = PdfWriter()
+        for part in parts:
+            writer.append(BytesIO(part))
+        buffer = BytesIO()
+        writer.write(buffer)
+        buffer.seek(0)
+        return buffer
+
+EXPORT_FORMATS = {
+    "TXT": ("yoga_gpt_chat_history.txt", "text/plain", iter_chat_plain_text),
+    "JSON": ("yoga_gpt_chat_history.json", "application/json", iter_chat_json),
+    "CSV": ("yoga_gpt_chat_history.csv", "text/csv", iter_chat_csv),
+    "PDF": ("yoga_gpt_chat_history.pdf", "application/pdf", None),
+}
+
+def export_chat(chat_history, export_format, pdf_builder=None):
+    """Build one export format, writing it turn by turn into a single buffer."""
+    _, _, iter_format = EXPORT_FORMATS[export_format]
+    with telemetry.span("export", format=export_format, turns=len(chat_history)) as span:
+        if iter_format is None:
+            output = (pdf_builder or IncrementalChatPdf()).build(chat_history)
+        else:
+            output = BytesIO()
+            for part in iter_format(chat_history):
+                output.write(part.encode("utf-8"))
+            output.seek(0)
+        span.attributes["bytes"] = output.getbuffer().nbytes
+    return output
+
 
 def clean_text_for_pdf(text):
     """Format raw AI output for nicer display in PDF."""